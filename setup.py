@@ -68,7 +68,9 @@ Project home: http://wsgidav.googlecode.com/
       extras_require = {},
       test_suite = "tests.test_all.run",
       entry_points = {
-          "console_scripts" : ["wsgidav = wsgidav.server.run_server:run"],
+          "console_scripts" : ["wsgidav = wsgidav.server.run_server:run",
+                               "wsgidav-storage = wsgidav.addons.storage_server:run",
+                               ],
           },
       # TODO: PP:
 #      entry_points = """
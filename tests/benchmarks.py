@@ -83,13 +83,312 @@ Test cases
         file10-10-1.txt -> 1k
 """
 import logging
-_benchmarks = [#"proppatch_many",
+import time
+_benchmarks = ["proppatch_many",
                #"proppatch_big",
                #"proppatch_deep",
                "test_scripted",
+               "lock_children",
+               "lock_contention",
+               "block_size",
+               "chunked_input",
                ]
 
 
+def _bench_lock_children(opts):
+    """Compare child lock lookup by index against a full key scan.
+    
+    Creates <lock_count> depth-0 locks (default 100k) spread over a tree of 
+    folders, then queries child locks for a couple of collections.
+    """
+    from wsgidav import util
+    from wsgidav.lock_storage import LockStorageDict
+    lockCount = opts.get("lock_count", 100000)
+    storage = LockStorageDict()
+    storage.open()
+    start = time.time()
+    for i in xrange(lockCount):
+        path = "/bench/folder%s/sub%s/file%s.txt" % (i % 100, i % 1000, i)
+        storage.create(path, {"root": path,
+                              "type": "write",
+                              "scope": "shared",
+                              "depth": "0",
+                              "owner": "bench",
+                              "timeout": 3600,
+                              "principal": "bench",
+                              })
+    logging.warning("Created %s locks in %.3f sec" % (lockCount, time.time() - start))
+
+    queries = ["/bench/folder7/sub7", "/bench/folder42", "/unlocked/folder"]
+    for path in queries:
+        start = time.time()
+        key = "URL2TOKEN:%s" % path
+        scanned = 0
+        for u, ltoks in storage._dict.items():
+            if util.isChildUri(key, u):
+                scanned += len(ltoks)
+        elapScan = time.time() - start
+
+        start = time.time()
+        found = storage.getLockList(path, includeRoot=False, 
+                                    includeChildren=True, tokenOnly=True)
+        elapIndex = time.time() - start
+        assert len(found) == scanned
+        logging.warning("Child locks of %s: %s, scan: %.6f sec, index: %.6f sec" 
+                        % (path, len(found), elapScan, elapIndex))
+    storage.close()
+
+
+def _bench_proppatch_many(opts):
+    """Compare PROPPATCH throughput of ShelvePropertyManager modes.
+    
+    Writes 20 properties for each of <resource_count> resources (default 100),
+    like a PROPPATCH with 20 properties, once with sync after every write and
+    once in write-behind mode.
+    """
+    import glob
+    import os
+    from tempfile import gettempdir
+    from wsgidav.property_manager import ShelvePropertyManager
+    resCount = opts.get("resource_count", 100)
+    path = os.path.join(gettempdir(), "wsgidav-bench-props.shelve")
+    for flushInterval in (0, 0.5):
+        for fp in glob.glob(path + "*"):
+            os.remove(fp)
+        pm = ShelvePropertyManager(path, flushInterval=flushInterval)
+        pm._verbose = 1
+        start = time.time()
+        for i in xrange(resCount):
+            url = "/bench/file%s.txt" % i
+            for j in xrange(20):
+                pm.writeProperty(url, "{bench:}prop%s" % j, "<value>%s</value>" % j)
+        pm._close()
+        elap = time.time() - start
+        logging.warning("PROPPATCH %s x 20 properties, flushInterval=%s: %.3f sec, %d writes/sec" 
+                        % (resCount, flushInterval, elap, 20 * resCount / elap))
+    for fp in glob.glob(path + "*"):
+        os.remove(fp)
+
+
+def _bench_lock_contention(opts):
+    """Compare a single global lock against striped locks with many threads.
+    
+    <thread_count> threads (default 32) each work on their own top-level 
+    folder and run <loop_count> iterations (default 200) of LOCK, write 
+    permission check, PROPPATCH and UNLOCK against LockManager, 
+    LockStorageDict and PropertyManager.
+    """
+    import threading
+    from wsgidav.lock_manager import LockManager
+    from wsgidav.lock_storage import LockStorageDict
+    from wsgidav.property_manager import PropertyManager
+    from wsgidav.striped_lock import StripedReadWriteLock
+    threadCount = opts.get("thread_count", 32)
+    loopCount = opts.get("loop_count", 200)
+
+    def _worker(lm, pm, folder):
+        for i in xrange(loopCount):
+            url = "/%s/res%s" % (folder, i % 10)
+            lock = lm.acquire(url, "write", "exclusive", "infinity", "bench", 
+                              3600, "bench", [])
+            lm.checkWritePermission(url, "0", [lock["token"]], "bench")
+            pm.writeProperty(url, "{bench:}prop", "<value>%s</value>" % i)
+            lm.release(lock["token"])
+
+    for stripeCount in (1, 16):
+        lm = LockManager(LockStorageDict())
+        pm = PropertyManager()
+        pm._verbose = 1
+        # Replace the default stripes (only used after construction)
+        lm._lock = StripedReadWriteLock(stripeCount)
+        lm.storage._lock = StripedReadWriteLock(stripeCount)
+        pm._lock = StripedReadWriteLock(stripeCount)
+        threads = [ threading.Thread(target=_worker, args=(lm, pm, "folder%s" % i)) 
+                    for i in xrange(threadCount) ]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elap = time.time() - start
+        logging.warning("%s threads x %s LOCK/PROPPATCH/UNLOCK, %s stripe(s): %.3f sec, %d ops/sec" 
+                        % (threadCount, loopCount, stripeCount, elap, 
+                           threadCount * loopCount / elap))
+
+
+def _bench_block_size(opts):
+    """Plot GET and PUT throughput against the block size on loopback.
+    
+    Runs a WsgiDAV server (bundled CherryPy) on 127.0.0.1 and transfers a file
+    of <file_size> bytes (default 64 MB) <loop_count> times (default 3) for 
+    every block size in <block_sizes>, and with adaptive block sizes (8 kB up 
+    to 1 MB). wsgi.file_wrapper is disabled, so GET responses are copied by 
+    RequestServer instead of sendfile().
+    """
+    import httplib
+    import os
+    import shutil
+    import threading
+    from tempfile import mkdtemp
+    from wsgidav.fs_dav_provider import FilesystemProvider
+    from wsgidav.server.cherrypy_wsgiserver import CherryPyWSGIServer
+    from wsgidav.wsgidav_app import DEFAULT_CONFIG, WsgiDAVApp
+    fileSize = opts.get("file_size", 64 * 1024 * 1024)
+    loopCount = opts.get("loop_count", 3)
+    blockSizes = opts.get("block_sizes", [4096, 8192, 32768, 131072, 
+                                          524288, 1048576, 4194304])
+    rootPath = mkdtemp(prefix="wsgidav-bench-")
+    config = DEFAULT_CONFIG.copy()
+    config.update({"provider_mapping": {"/": FilesystemProvider(rootPath)},
+                   "user_mapping": {},
+                   "verbose": 0,
+                   "enable_loggers": [],
+                   "propsmanager": None,
+                   "locksmanager": None,
+                   "domaincontroller": None,
+                   })
+    davApp = WsgiDAVApp(config)
+    def app(environ, start_response):
+        environ.pop("wsgi.file_wrapper", None)
+        return davApp(environ, start_response)
+    server = CherryPyWSGIServer(("127.0.0.1", 0), app)
+    thread = threading.Thread(target=server.start)
+    thread.setDaemon(True)
+    thread.start()
+    while not server.ready:
+        time.sleep(0.1)
+    port = server.socket.getsockname()[1]
+    data = os.urandom(1024 * 1024) * (fileSize // (1024 * 1024))
+
+    def _transfer(method, body=None):
+        conn = httplib.HTTPConnection("127.0.0.1", port)
+        conn.request(method, "/bench.bin", body)
+        resp = conn.getresponse()
+        while resp.read(1024 * 1024):
+            pass
+        conn.close()
+        assert resp.status in (200, 201, 204), resp.status
+
+    results = []
+    try:
+        for blockSize in blockSizes + [None]:
+            if blockSize is None:
+                label = "adaptive"
+                config["block_size"] = {"min": 8192, "max": 1024 * 1024}
+            else:
+                label = "%s kB" % (blockSize // 1024)
+                config["block_size"] = {"min": blockSize, "max": blockSize}
+            for method in ("PUT", "GET"):
+                start = time.time()
+                for _i in xrange(loopCount):
+                    _transfer(method, data if method == "PUT" else None)
+                elap = time.time() - start
+                results.append((label, method, 
+                                loopCount * len(data) / elap / (1024 * 1024)))
+    finally:
+        server.stop()
+        shutil.rmtree(rootPath, ignore_errors=True)
+
+    best = max([ r[2] for r in results ])
+    for label, method, mbPerSec in results:
+        logging.warning("%-8s %-3s %8.1f MB/sec %s" 
+                        % (label, method, mbPerSec, "#" * int(50 * mbPerSec / best)))
+
+
+def _bench_chunked_input(opts):
+    """Compare the former chunked PUT loop against ChunkedInput.
+    
+    Copies a chunked body of <body_size> bytes (default 64 MB) with 1 kB, 
+    64 kB and 1 MB chunks into a temporary file (opened like 
+    FilesystemProvider.beginWrite() does). The body is read 
+    
+    - from a socket pair (fed by a thread), through the input stream of the
+      bundled CherryPy server (ChunkedInput fills its buffer with read1()), 
+    - from a temporary file (ChunkedInput only reads what the body must 
+      still contain).
+    
+    The former loop read every chunk header and CRLF with readline(), and 
+    wrote every chunk (in blocks of up to 1 MB); ChunkedInput is read in 
+    blocks of 8 kB, growing to 1 MB.
+    """
+    import os
+    import socket
+    import tempfile
+    import threading
+    from wsgidav import util
+    from wsgidav.chunked_input import ChunkedInput
+    from wsgidav.server.cherrypy_wsgiserver import CP_fileobject, \
+        SizeCheckWrapper
+    bodySize = opts.get("body_size", 64 * 1024 * 1024)
+    chunkSizes = opts.get("chunk_sizes", [1024, 64 * 1024, 1024 * 1024])
+    sources = opts.get("sources", ["socket", "file"])
+    block = "x" * (1024 * 1024)
+
+    def _iterLegacy(rfile, blockSizes):
+        buf = rfile.readline()
+        l = buf and int(buf, 16) or 0
+        while l > 0:
+            while l > 0:
+                buf = rfile.read(min(l, blockSizes.next()))
+                yield buf
+                l -= len(buf)
+            rfile.readline()
+            buf = rfile.readline()
+            l = buf and int(buf, 16) or 0
+
+    def _iterChunkedInput(rfile, blockSizes):
+        body = ChunkedInput(rfile)
+        while True:
+            buf = body.read(blockSizes.next())
+            if not buf:
+                break
+            yield buf
+
+    fd, bodyPath = tempfile.mkstemp()
+    os.close(fd)
+    fd, filePath = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        for chunkSize in chunkSizes:
+            chunk = "%x\r\n%s\r\n" % (chunkSize, block[:chunkSize])
+            body = chunk * (bodySize // chunkSize) + "0\r\n\r\n"
+            bodyFile = file(bodyPath, "wb")
+            bodyFile.write(body)
+            bodyFile.close()
+            for source in sources:
+                for name, iterBody in (("readline loop", _iterLegacy), 
+                                       ("ChunkedInput", _iterChunkedInput)):
+                    if source == "socket":
+                        sock, peer = socket.socketpair()
+                        sender = threading.Thread(target=peer.sendall, 
+                                                  args=(body, ))
+                        sender.start()
+                        rfile = SizeCheckWrapper(CP_fileobject(sock, "rb", -1), 0)
+                    else:
+                        rfile = file(bodyPath, "rb")
+                    fileobj = file(filePath, "wb", 8192)
+                    blockSizes = util.iterBlockSizes(8192, 1024 * 1024)
+                    writes = 0
+                    start = time.time()
+                    for buf in iterBody(rfile, blockSizes):
+                        fileobj.write(buf)
+                        writes += 1
+                    fileobj.close()
+                    elap = time.time() - start
+                    rfile.close()
+                    if source == "socket":
+                        sender.join()
+                        sock.close()
+                        peer.close()
+                    assert os.path.getsize(filePath) == bodySize
+                    logging.warning("%7s kB chunks, %-6s, %-13s: %.3f sec, %6.1f MB/sec, %s writes" 
+                                    % (chunkSize // 1024, source, name, elap, 
+                                       bodySize / elap / (1024 * 1024), writes))
+    finally:
+        os.remove(bodyPath)
+        os.remove(filePath)
+
+
 def _real_run_bench(bench, opts):
     if bench == "*":
         for bench in _benchmarks:
@@ -100,6 +399,16 @@ def _real_run_bench(bench, opts):
     if bench == "test_scripted":
         from tests import test_scripted
         test_scripted.main()
+    elif bench == "lock_children":
+        _bench_lock_children(opts)
+    elif bench == "proppatch_many":
+        _bench_proppatch_many(opts)
+    elif bench == "lock_contention":
+        _bench_lock_contention(opts)
+    elif bench == "block_size":
+        _bench_block_size(opts)
+    elif bench == "chunked_input":
+        _bench_chunked_input(opts)
     else:
         raise ValueError()
 
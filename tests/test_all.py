@@ -6,7 +6,7 @@ Unit tests for the WsgiDAV package.
 """
 
 from tests import test_lock_manager, test_property_manager, test_wsgidav_app,\
-    test_util, test_scripted
+    test_util, test_scripted, test_storage_server, test_caching_provider
 from unittest import TestSuite, TextTestRunner
 import sys
 
@@ -16,6 +16,8 @@ def run():
                        test_lock_manager.suite(),
                        test_property_manager.suite(),
                        test_wsgidav_app.suite(),
+                       test_storage_server.suite(),
+                       test_caching_provider.suite(),
 #                       test_scripted.suite(),
                        ])
     failures = TextTestRunner(descriptions=0, verbosity=2).run(suite)
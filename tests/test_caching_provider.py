@@ -0,0 +1,230 @@
+# -*- coding: iso-8859-1 -*-
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""Unit test for caching_provider.py"""
+from tempfile import gettempdir
+from wsgidav.wsgidav_app import DEFAULT_CONFIG, WsgiDAVApp
+from wsgidav.fs_dav_provider import FilesystemProvider
+from wsgidav.caching_provider import CachingProvider
+import os
+import shutil
+import sys
+import time
+import unittest
+
+try:
+    from paste.fixture import TestApp  #@UnresolvedImport
+except:
+    print >>sys.stderr, "Could not import paste.fixture.TestApp: tests will fail"
+
+#===============================================================================
+# CachingProviderTest
+#===============================================================================
+class CachingProviderTest(unittest.TestCase):
+    """Test CachingProvider(FilesystemProvider) using paste.fixture."""
+
+    @classmethod
+    def suite(cls):
+        """Return test case suite (so we can control the order)."""
+        suite = unittest.TestSuite()
+        suite.addTest(cls("testHits"))
+        suite.addTest(cls("testInvalidation"))
+        suite.addTest(cls("testExpire"))
+        suite.addTest(cls("testLru"))
+        suite.addTest(cls("testInotify"))
+        suite.addTest(cls("testInotifyMovedTree"))
+        return suite
+
+
+    def _makeApp(self, **cacheOpts):
+        if self.provider:
+            self.provider.close()
+        self.provider = CachingProvider(FilesystemProvider(self.rootpath),
+                                        **cacheOpts)
+        config = DEFAULT_CONFIG.copy()
+        config.update({
+            "provider_mapping": {"/": self.provider},
+            "user_mapping": {},
+            "verbose": 1,
+            "enable_loggers": [],
+            "propsmanager": True,
+            "locksmanager": True,
+            "domaincontroller": None,
+            })
+        self.app = TestApp(WsgiDAVApp(config))
+
+
+    def setUp(self):
+        self.rootpath = os.path.join(gettempdir(), "wsgidav-test-cache")
+        if os.path.exists(self.rootpath):
+            shutil.rmtree(self.rootpath)
+        os.mkdir(self.rootpath)
+        self.provider = None
+        self._makeApp(ttl=1000)
+
+
+    def tearDown(self):
+        self.provider.close()
+        shutil.rmtree(self.rootpath)
+        self.app = None
+        self.provider = None
+
+
+    def _propfind(self, path, depth="1"):
+        return self.app._gen_request("PROPFIND", path,
+                                     headers={"Depth": depth},
+                                     status=207).body
+
+
+    def testHits(self):
+        """Repeated requests should be answered from the cache."""
+        app = self.app
+        app.put("/file1.txt", params="data", status=201)
+        app.head("/file1.txt", status=200)
+        stats = self.provider.getStats()
+        app.head("/file1.txt", status=200)
+        res = app.get("/file1.txt", status=200)
+        self.assertEqual(res.body, "data")
+        self.assertEqual(self.provider.getStats()["hits"], stats["hits"] + 2)
+        self.assertEqual(self.provider.getStats()["misses"], stats["misses"])
+
+        # A listing caches member names and members
+        body = self._propfind("/")
+        self.assertTrue("file1.txt" in body)
+        stats = self.provider.getStats()
+        self.assertEqual(self._propfind("/"), body)
+        self.assertEqual(self.provider.getStats()["misses"], stats["misses"])
+        # Unmapped paths are cached as well
+        app.get("/nofile.txt", status=404)
+        stats = self.provider.getStats()
+        app.get("/nofile.txt", status=404)
+        self.assertEqual(self.provider.getStats()["misses"], stats["misses"])
+
+
+    def testInvalidation(self):
+        """Modifications through WsgiDAV should be visible immediately."""
+        app = self.app
+        app._gen_request("MKCOL", "/folder", status=201)
+        app.put("/folder/file1.txt", params="data", status=201)
+        self.assertTrue("file1.txt" in self._propfind("/folder"))
+        app.get("/folder/file2.txt", status=404)
+
+        app.put("/folder/file1.txt", params="new data", status=204)
+        res = app.get("/folder/file1.txt", status=200)
+        self.assertEqual(res.body, "new data")
+        self.assertEqual(res.header("Content-Length"), "8")
+
+        app._gen_request("COPY", "/folder/file1.txt",
+                         headers={"Destination": "/folder/file2.txt"},
+                         status=201)
+        app.get("/folder/file2.txt", status=200)
+        self.assertTrue("file2.txt" in self._propfind("/folder"))
+
+        app._gen_request("MOVE", "/folder",
+                         headers={"Destination": "/moved"}, status=201)
+        app.get("/folder/file1.txt", status=404)
+        app.get("/moved/file2.txt", status=200)
+        self.assertFalse("folder" in self._propfind("/"))
+
+        app.delete("/moved/file2.txt", status=204)
+        app.get("/moved/file2.txt", status=404)
+        self.assertFalse("file2.txt" in self._propfind("/moved"))
+
+
+    def testExpire(self):
+        """External modifications should be visible after ttl."""
+        self._makeApp(ttl=0.2)
+        app = self.app
+        app.put("/file1.txt", params="data", status=201)
+        app.get("/file1.txt", status=200)
+        os.remove(os.path.join(self.rootpath, "file1.txt"))
+        app.head("/file1.txt", status=200)
+        time.sleep(0.3)
+        app.head("/file1.txt", status=404)
+
+
+    def testLru(self):
+        """The cache should be bounded."""
+        self._makeApp(ttl=1000, maxEntries=3)
+        for i in range(5):
+            self.app.get("/file%s.txt" % i, status=404)
+        self.assertEqual(self.provider.getStats()["entries"], 3)
+
+
+    def _waitFor(self, condition):
+        """Poll until the watcher thread has processed the events."""
+        for _i in range(100):
+            if condition():
+                return True
+            time.sleep(0.02)
+        return False
+
+
+    def testInotify(self):
+        """External modifications should be visible in watched folders."""
+        if not sys.platform.startswith("linux"):
+            return
+        self._makeApp(ttl=1000, useInotify=True)
+        app = self.app
+        app._gen_request("MKCOL", "/folder", status=201)
+        app.put("/folder/file1.txt", params="data", status=201)
+        self.assertEqual(app.head("/folder/file1.txt").header("Content-Length"), "4")
+        self.assertFalse("file2.txt" in self._propfind("/folder"))
+        app.get("/folder/file2.txt", status=404)
+        self.assertEqual(self.provider._watcher.isWatched(
+            os.path.join(self.rootpath, "folder")), True)
+
+        fp = os.path.join(self.rootpath, "folder", "file1.txt")
+        f = open(fp, "wb")
+        f.write("more data")
+        f.close()
+        self.assertTrue(self._waitFor(lambda: app.head("/folder/file1.txt")
+                                      .header("Content-Length") == "9"))
+        open(os.path.join(self.rootpath, "folder", "file2.txt"), "wb").close()
+        self.assertTrue(self._waitFor(lambda: "file2.txt" in self._propfind("/folder")))
+        app.get("/folder/file2.txt", status=200)
+        shutil.rmtree(os.path.join(self.rootpath, "folder"))
+        self.assertTrue(self._waitFor(
+            lambda: app.get("/folder/file1.txt", expect_errors=True).status == 404))
+        app._gen_request("PROPFIND", "/folder", status=404)
+
+
+    def testInotifyMovedTree(self):
+        """Watches below a moved directory should be removed."""
+        if not sys.platform.startswith("linux"):
+            return
+        from wsgidav.addons.inotify_watcher import InotifyWatcher
+        changed = []
+        watcher = InotifyWatcher(changed.append)
+        try:
+            a = os.path.join(self.rootpath, "a")
+            sub = os.path.join(a, "sub")
+            os.makedirs(sub)
+            for path in (self.rootpath, a, sub):
+                self.assertTrue(watcher.watch(path))
+            os.rename(a, os.path.join(self.rootpath, "b"))
+            self.assertTrue(self._waitFor(lambda: not watcher.isWatched(a)))
+            self.assertFalse(watcher.isWatched(sub))
+            # The new directory must get a new watch
+            os.makedirs(sub)
+            self.assertTrue(watcher.watch(sub))
+            open(os.path.join(sub, "f"), "wb").close()
+            self.assertTrue(self._waitFor(
+                lambda: os.path.join(sub, "f") in changed))
+        finally:
+            watcher.stop()
+
+
+#===============================================================================
+# suite
+#===============================================================================
+def suite():
+    """Return suites of all test cases."""
+    return unittest.TestSuite([CachingProviderTest.suite(),
+                               ])
+
+
+if __name__ == "__main__":
+    unittest.main()
+#    suite = suite()
+#    unittest.TextTestRunner(descriptions=1, verbosity=2).run(suite)
@@ -4,7 +4,11 @@
 """Unit test for lock_manager.py"""
 from tempfile import gettempdir
 from wsgidav.dav_error import DAVError
+import glob
 import os
+import subprocess
+import sys
+import threading
 from time import sleep
 from unittest import TestCase, TestSuite, TextTestRunner
 from wsgidav import lock_manager, lock_storage
@@ -29,6 +33,10 @@ class BasicTest(TestCase):
         suite.addTest(cls("testLock"))
         suite.addTest(cls("testTimeout"))
         suite.addTest(cls("testConflict"))
+        suite.addTest(cls("testChildLocks"))
+        suite.addTest(cls("testReaper"))
+        suite.addTest(cls("testConcurrency"))
+        suite.addTest(cls("testLockCount"))
         return suite
 
             
@@ -233,6 +241,136 @@ class BasicTest(TestCase):
         assert l is None, "Could acquire a conflicting child lock (same principal)"
 
 
+    def testChildLocks(self):                          
+        """Storage should find child locks, but not siblings or parents."""
+        storage = self.lm.storage
+        tokenList = []
+        for url in ("/dav/a/b", "/dav/a/b/c/d", "/dav/ab", "/dav"):
+            l = self._acquire(url, "write", "shared", "0",
+                              self.owner, self.timeout, 
+                              self.principal, tokenList)
+            assert l, "Could not acquire lock on %s" % url
+
+        def _roots(path, includeRoot=False):
+            return sorted(l["root"] for l in storage.getLockList(path, 
+                                                                 includeRoot=includeRoot, 
+                                                                 includeChildren=True, 
+                                                                 tokenOnly=False))
+
+        self.assertEqual(_roots("/dav/a"), ["/dav/a/b", "/dav/a/b/c/d"])
+        self.assertEqual(_roots("/dav/a/b", True), ["/dav/a/b", "/dav/a/b/c/d"])
+        self.assertEqual(_roots("/dav/a/b/c/d"), [])
+        self.assertEqual(_roots("/"), ["/dav", "/dav/a/b", "/dav/a/b/c/d", "/dav/ab"])
+
+        # Released locks must also vanish from the child lookup
+        for lock in self.lm.getUrlLockList("/dav/a/b/c/d"):
+            self.lm.release(lock["token"])
+        self.assertEqual(_roots("/dav/a"), ["/dav/a/b"])
+
+
+    def testReaper(self):                          
+        """Expired locks should be purged by cleanup() and on writes."""
+        lm = self.lm
+        storage = lm.storage
+        for i in range(3):
+            lm._generateLock(self.principal, "write", "exclusive", "0", 
+                             self.owner, "/dav/expire%s" % i, 0.1)
+        lm._generateLock(self.principal, "write", "exclusive", "0", 
+                         self.owner, "/dav/keep", self.timeout)
+        self.assertEqual(storage.getStats(), {"live": 4, "reaped": 0})
+
+        sleep(0.2)
+        # A write purges expired locks as a side effect 
+        lm._generateLock(self.principal, "write", "exclusive", "0", 
+                         self.owner, "/dav/new", 0.1)
+        self.assertEqual(storage.getStats(), {"live": 2, "reaped": 3})
+        self.assertEqual(lm.getUrlLockList("/dav/expire0"), [])
+
+        sleep(0.2)
+        self.assertEqual(storage.cleanup(), 1)
+        self.assertEqual(storage.getStats(), {"live": 1, "reaped": 4})
+        roots = [ l["root"] for l in storage.getLockList("/", includeRoot=True, 
+                                                         includeChildren=True,
+                                                         tokenOnly=False) ]
+        self.assertEqual(roots, ["/dav/keep"])
+
+
+    def testConcurrency(self):                          
+        """Threads locking different folders and the root should not deadlock."""
+        lm = self.lm
+        errors = []
+        def _worker(folder):
+            try:
+                for i in range(20):
+                    url = "%s/res%s" % (folder, i)
+                    l = lm.acquire(url, "write", "exclusive", "infinity", 
+                                   self.owner, self.timeout, self.principal, [])
+                    lm.checkWritePermission(url, "0", [l["token"]], self.principal)
+                    lm.release(l["token"])
+            except Exception, e:
+                errors.append(e)
+        def _rootWorker():
+            # Depth-infinity checks on '/' span all stripes
+            try:
+                for i in range(20):
+                    try:
+                        lm.checkWritePermission("/", "infinity", [], self.principal)
+                    except DAVError:
+                        pass
+            except Exception, e:
+                errors.append(e)
+        threads = [ threading.Thread(target=_worker, args=("/folder%s" % i, )) 
+                    for i in range(4) ]
+        threads.append(threading.Thread(target=_rootWorker))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+            assert not t.isAlive(), "Deadlock"
+        self.assertEqual(errors, [])
+        self.assertEqual(lm.storage.getLockList("/", includeRoot=True, 
+                                                includeChildren=True, 
+                                                tokenOnly=True), [])
+
+
+    def testLockCount(self):                          
+        """Lock counters should allow to skip checks, if no locks exist."""
+        lm = self.lm
+        storage = lm.storage
+        assert storage.getLockCount() == 0
+        assert not lm.hasLocks("/dav/res")
+
+        l = self._acquire("/dav/res", "write", "exclusive", "infinity",
+                          self.owner, self.timeout, self.principal, [])
+        assert storage.getLockCount() == 1
+        assert storage.getLockCount("/dav/other") == 1
+        assert storage.getLockCount("/other") == 0
+        assert storage.getLockCount("/") == 0
+        assert lm.hasLocks("/dav/res/sub")
+        assert not lm.hasLocks("/other/res")
+        assert lm.hasLocks("/", "infinity"), "Root sub tree contains locks"
+        assert lm.hasLocks("/dav", "infinity")
+        assert not lm.hasLocks("/dav"), "Child locks do not affect depth 0"
+        assert not lm.hasLocks("/dav/other"), "Sibling locks do not affect url"
+        assert not lm.hasLocks("/dav/resource", "infinity")
+        assert lm.getUrlLockList("/other/res") == []
+        # Not locked by us: the fast path must not skip the check
+        self.assertRaises(DAVError, lm.checkWritePermission, 
+                          "/", "infinity", [], "another principal")
+        lm.checkWritePermission("/other", "infinity", [], "another principal")
+
+        lm.release(l["token"])
+        assert storage.getLockCount() == 0
+        assert storage.getLockCount("/dav/res") == 0
+        assert not lm.hasLocks(None)
+
+        l = self._acquire("/", "write", "shared", "infinity",
+                          self.owner, self.timeout, self.principal, [])
+        assert lm.hasLocks("/other/res"), "Root locks affect every url"
+        assert lm.hasLocks(None)
+        lm.release(l["token"])
+
+
 #===============================================================================
 # ShelveTest
 #===============================================================================
@@ -241,8 +379,9 @@ class ShelveTest(BasicTest):
     
     def setUp(self):
         self.path = os.path.join(gettempdir(), "wsgidav-locks.shelve")
-        if os.path.exists(self.path):
-            os.remove(self.path)
+        # Depending on the dbm module, shelve may create *.db, *.dat, ... files
+        for fp in glob.glob(self.path + "*"):
+            os.remove(fp)
         storage = lock_storage.LockStorageShelve(self.path)
         self.lm = lock_manager.LockManager(storage)
         self.lm._verbose = 1
@@ -253,6 +392,122 @@ class ShelveTest(BasicTest):
 #        os.remove(self.path)
 
 
+#===============================================================================
+# WriteBehindTest
+#===============================================================================
+class WriteBehindTest(ShelveTest):                          
+    """Test lock_storage.LockStorageShelve() in write-behind mode."""
+    
+    def setUp(self):
+        self.path = os.path.join(gettempdir(), "wsgidav-locks.shelve")
+        for fp in glob.glob(self.path + "*"):
+            os.remove(fp)
+        storage = lock_storage.LockStorageShelve(self.path, flushInterval=0.2)
+        self.lm = lock_manager.LockManager(storage)
+        self.lm._verbose = 1
+
+    def tearDown(self):
+        self.lm.storage.close()
+        self.lm = None
+
+    @classmethod
+    def suite(cls):
+        suite = super(WriteBehindTest, cls).suite()
+        suite.addTest(cls("testFlushAtExit"))
+        return suite
+
+
+    def testFlushAtExit(self):                          
+        """Pending mutations should be written, when the process exits."""
+        self.lm.storage.close()
+        # Acquire a lock in another process, that exits before flushInterval
+        # (storage is not closed, like in a server that is shut down)
+        script = ("from wsgidav import lock_storage\n"
+                  "storage = lock_storage.LockStorageShelve(%r, flushInterval=60)\n"
+                  "storage.open()\n"
+                  "storage.create('/dav/res', {'type': 'write', 'scope': 'exclusive',\n"
+                  "    'depth': '0', 'owner': 'owner', 'timeout': 100,\n"
+                  "    'principal': 'principal'})\n" % self.path)
+        rootPath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        assert subprocess.call([sys.executable, "-c", script], cwd=rootPath) == 0
+
+        self.lm.storage.open()
+        assert len(self.lm.getUrlLockList("/dav/res")) == 1, "Lock was not flushed"
+
+
+#===============================================================================
+# SQLiteTest
+#===============================================================================
+class SQLiteTest(BasicTest):                          
+    """Test lock_storage.LockStorageSQLite()."""
+    
+    def setUp(self):
+        self.path = os.path.join(gettempdir(), "wsgidav-locks.sqlite")
+        # WAL mode creates *-wal and *-shm files
+        for fp in glob.glob(self.path + "*"):
+            os.remove(fp)
+        storage = lock_storage.LockStorageSQLite(self.path)
+        self.lm = lock_manager.LockManager(storage)
+        self.lm._verbose = 1
+
+    def tearDown(self):
+        self.lm.storage.close()
+        self.lm = None
+
+    @classmethod
+    def suite(cls):
+        suite = super(SQLiteTest, cls).suite()
+        suite.addTest(cls("testSharedStorage"))
+        suite.addTest(cls("testRootChildLocks"))
+        return suite
+
+
+    def testSharedStorage(self):                          
+        """Two storages on the same file should see each other's locks."""
+        other = lock_manager.LockManager(lock_storage.LockStorageSQLite(self.path))
+        try:
+            l = self._acquire("/dav/res", "write", "exclusive", "infinity",
+                              self.owner, self.timeout, self.principal, [])
+            assert l, "Could not acquire lock"
+            assert other.getLock(l["token"], "root") == "/dav/res"
+
+            try:
+                other.acquire("/dav/res/sub", "write", "exclusive", "0",
+                              self.owner, self.timeout, "another principal", [])
+                self.fail("Could acquire a conflicting child lock")
+            except DAVError:
+                pass
+
+            other.release(l["token"])
+            assert self.lm.getLock(l["token"]) is None
+        finally:
+            other.storage.close()
+
+
+    def testRootChildLocks(self):                          
+        """A lock on "/" must not be reported as its own child."""
+        dictStorage = lock_storage.LockStorageDict()
+        dictStorage.open()
+        for url in ("/", "/a", "/a/b"):
+            for storage in (self.lm.storage, dictStorage):
+                storage.create(url, {"root": url,
+                                     "type": "write",
+                                     "scope": "shared",
+                                     "depth": "infinity",
+                                     "owner": self.owner,
+                                     "timeout": self.timeout,
+                                     "principal": self.principal,
+                                     })
+        for storage in (self.lm.storage, dictStorage):
+            children = storage.getLockList("/", includeRoot=False, 
+                                           includeChildren=True, tokenOnly=False)
+            self.assertEqual(sorted(l["root"] for l in children), ["/a", "/a/b"])
+            self.assertEqual(len(storage.getLockList("/", includeRoot=True, 
+                                                     includeChildren=True, 
+                                                     tokenOnly=True)), 3)
+        dictStorage.close()
+
+
 #===============================================================================
 # suite
 #===============================================================================
@@ -260,6 +515,8 @@ def suite():
     """Return suites of all test cases."""
     return TestSuite([BasicTest.suite(), 
                       ShelveTest.suite(),
+                      WriteBehindTest.suite(),
+                      SQLiteTest.suite(),
                       ])  
 
 
@@ -3,8 +3,11 @@
 # Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
 """Unit test for property_manager.py"""
 from tempfile import gettempdir
+from time import sleep
 from unittest import TestCase, TestSuite, TextTestRunner
+import glob
 import os
+import sqlite3
 from wsgidav import property_manager
 
 #===============================================================================
@@ -22,6 +25,8 @@ class BasicTest(TestCase):
         suite.addTest(cls("testOpen"))
         suite.addTest(cls("testValidation"))
         suite.addTest(cls("testReadWrite"))
+        suite.addTest(cls("testCopyMove"))
+        suite.addTest(cls("testSubtree"))
         return suite
 
             
@@ -72,6 +77,46 @@ class BasicTest(TestCase):
         assert pm.getProperty(url, "foo") == "my name is joe" 
 
 
+    def testCopyMove(self):                          
+        """Property manager should copy and move resources and sub trees."""
+        pm = self.pm
+        for url in ("/dav/a/", "/dav/a/b", "/dav/a/b/c", "/dav/ab"):
+            pm.writeProperty(url, "foo", "foo of %s" % url)
+
+        pm.copyProperties("/dav/ab", "/dav/ac")
+        assert pm.getProperty("/dav/ac", "foo") == "foo of /dav/ab" 
+
+        pm.moveProperties("/dav/a/", "/dav/x/", withChildren=True)
+        assert pm.getProperty("/dav/x/", "foo") == "foo of /dav/a/" 
+        assert pm.getProperty("/dav/x/b/c", "foo") == "foo of /dav/a/b/c" 
+        assert pm.getProperty("/dav/a/b", "foo") is None 
+        assert pm.getProperty("/dav/ab", "foo") == "foo of /dav/ab", "Sibling must not be moved" 
+
+        pm.moveProperties("/dav/ac", "/dav/ad", withChildren=False)
+        assert pm.getProperties("/dav/ac") == []
+        assert pm.getProperties("/dav/ad") == ["foo"]
+
+        pm.removeProperties("/dav/ad")
+        assert pm.getProperties("/dav/ad") == []
+
+
+    def testSubtree(self):                          
+        """Copy and remove should optionally process sub trees."""
+        pm = self.pm
+        for url in ("/dav/a/", "/dav/a/b", "/dav/ab"):
+            pm.writeProperty(url, "foo", "foo of %s" % url)
+
+        pm.copyProperties("/dav/a/", "/dav/x/", withChildren=True)
+        assert pm.getProperty("/dav/x/", "foo") == "foo of /dav/a/" 
+        assert pm.getProperty("/dav/x/b", "foo") == "foo of /dav/a/b" 
+        assert pm.getProperty("/dav/a/b", "foo") == "foo of /dav/a/b" 
+        assert pm.getProperties("/dav/xb") == []
+
+        pm.removeProperties("/dav/a", withChildren=True)
+        assert pm.getProperties("/dav/a/") == []
+        assert pm.getProperties("/dav/a/b") == []
+        assert pm.getProperty("/dav/ab", "foo") == "foo of /dav/ab", "Sibling must not be removed"
+
 
 #===============================================================================
 # ShelveTest
@@ -81,8 +126,9 @@ class ShelveTest(BasicTest):
     
     def setUp(self):
         self.path = os.path.join(gettempdir(), "wsgidav-props.shelve")
-        if os.path.exists(self.path):
-            os.remove(self.path)
+        # Depending on the dbm module, shelve may create *.db, *.dat, ... files
+        for fp in glob.glob(self.path + "*"):
+            os.remove(fp)
         self.pm = property_manager.ShelvePropertyManager(self.path)
         self.pm._verbose = 1
 
@@ -91,6 +137,128 @@ class ShelveTest(BasicTest):
         self.pm = None
 #        os.remove(self.path)
 
+#===============================================================================
+# WriteBehindTest
+#===============================================================================
+class WriteBehindTest(ShelveTest):                          
+    """Test property_manager.ShelvePropertyManager() in write-behind mode."""
+    
+    def setUp(self):
+        super(WriteBehindTest, self).setUp()
+        self.pm = property_manager.ShelvePropertyManager(self.path, 
+                                                         flushInterval=0.2,
+                                                         maxDirty=10)
+        self.pm._verbose = 1
+
+    @classmethod
+    def suite(cls):
+        suite = super(WriteBehindTest, cls).suite()
+        suite.addTest(cls("testFlush"))
+        return suite
+
+
+    def testFlush(self):                          
+        """Mutations should be written after a delay, N mutations, or on close."""
+        pm = self.pm
+        pm.writeProperty("/dav/res", "foo", "1")
+        pm.writeProperty("/dav/res", "foo", "2")
+        self.assertEqual(pm._dict.getStats(), {"pending": 2, "flushes": 0})
+        sleep(0.4)
+        self.assertEqual(pm._dict.getStats(), {"pending": 0, "flushes": 1})
+
+        for i in range(10):
+            pm.writeProperty("/dav/res%s" % i, "foo", "3")
+        self.assertEqual(pm._dict.getStats(), {"pending": 0, "flushes": 2})
+
+        pm.removeProperties("/dav/res0")
+        pm._close()
+        pm = property_manager.ShelvePropertyManager(self.path)
+        try:
+            assert pm.getProperty("/dav/res", "foo") == "2" 
+            assert pm.getProperty("/dav/res9", "foo") == "3" 
+            assert pm.getProperties("/dav/res0") == [], "Delete was not flushed" 
+        finally:
+            pm._close()
+
+
+#===============================================================================
+# SQLiteTest
+#===============================================================================
+class SQLiteTest(BasicTest):                          
+    """Test property_manager.SQLitePropertyManager()."""
+    
+    def setUp(self):
+        self.path = os.path.join(gettempdir(), "wsgidav-props.sqlite")
+        # WAL mode creates *-wal and *-shm files
+        for fp in glob.glob(self.path + "*"):
+            os.remove(fp)
+        self.pm = property_manager.SQLitePropertyManager(self.path)
+        self.pm._verbose = 1
+
+    def tearDown(self):
+        self.pm._close()
+        self.pm = None
+
+    @classmethod
+    def suite(cls):
+        suite = super(SQLiteTest, cls).suite()
+        suite.addTest(cls("testNonAsciiSubtree"))
+        suite.addTest(cls("testGroupCommit"))
+        return suite
+
+
+    def testNonAsciiSubtree(self):                          
+        """Copy and move sub trees with utf8 encoded (multi-byte) URLs."""
+        pm = self.pm
+        # '/dav/\xe4\xf6' (a-umlaut, o-umlaut), utf8 encoded
+        src = "/dav/\xc3\xa4\xc3\xb6"
+        pm.writeProperty(src, "foo", "foo of src")
+        pm.writeProperty(src + "/x", "foo", "foo of x")
+
+        pm.copyProperties(src, "/dav/\xc3\xbc", withChildren=True)
+        assert pm.getProperty("/dav/\xc3\xbc", "foo") == "foo of src"
+        assert pm.getProperty("/dav/\xc3\xbc/x", "foo") == "foo of x"
+
+        pm.moveProperties(src, "/dav/new", withChildren=True)
+        assert pm.getProperty("/dav/new", "foo") == "foo of src"
+        assert pm.getProperty("/dav/new/x", "foo") == "foo of x"
+        assert pm.getProperties(src) == []
+        assert pm.getProperties(src + "/x") == []
+
+
+    def testGroupCommit(self):                          
+        """Writes should be visible to other processes after the group commit."""
+        pm = property_manager.SQLitePropertyManager(self.path, 
+                                                    commitInterval=0.2,
+                                                    commitBatch=3)
+        other = property_manager.SQLitePropertyManager(self.path)
+        try:
+            pm.writeProperty("/dav/res", "foo", "1")
+            assert other.getProperty("/dav/res", "foo") is None
+            # Commit after commitInterval
+            sleep(0.4)
+            assert other.getProperty("/dav/res", "foo") == "1"
+            assert pm.getProperty("/dav/res", "foo") == "1"
+            # Commit after commitBatch writes
+            for i in range(3):
+                pm.writeProperty("/dav/res", "bar%s" % i, "2")
+            assert other.getProperty("/dav/res", "bar2") == "2"
+            # Pending writes must not lock the database for other processes
+            pm.writeProperty("/dav/res", "baz", "3")
+            conn = sqlite3.connect(self.path, timeout=0)
+            try:
+                conn.execute("INSERT INTO props VALUES ('/dav/other', 'foo', '4')")
+                conn.commit()
+            finally:
+                conn.close()
+            assert other.getProperty("/dav/res", "baz") is None
+            assert pm.getProperty("/dav/other", "foo") == "4"
+            assert other.getProperty("/dav/res", "baz") == "3", "Commit before read"
+        finally:
+            pm._close()
+            other._close()
+
+
 #===============================================================================
 # suite
 #===============================================================================
@@ -98,6 +266,8 @@ def suite():
     """Return suites of all test cases."""
     return TestSuite([BasicTest.suite(), 
                       ShelveTest.suite(),
+                      WriteBehindTest.suite(),
+                      SQLiteTest.suite(),
                       ])  
 
 
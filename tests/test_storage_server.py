@@ -0,0 +1,246 @@
+# -*- coding: iso-8859-1 -*-
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""Unit test for addons/storage_server.py (runs a server on localhost)"""
+from tempfile import gettempdir
+from unittest import TestSuite, TextTestRunner
+from wsgidav import lock_manager, lock_storage, property_manager
+from wsgidav.addons import storage_server
+from tests import test_lock_manager, test_property_manager
+import os
+import threading
+
+
+def _startServer(address):
+    server = storage_server.StorageServer(address, 
+                                          lock_storage.LockStorageDict(),
+                                          property_manager.PropertyManager())
+    thread = threading.Thread(target=server.serve_forever, args=(0.05, ))
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+
+#===============================================================================
+# LockClientTest
+#===============================================================================
+class LockClientTest(test_lock_manager.BasicTest):                          
+    """Run lock manager tests against storage_server.LockStorageClient()."""
+
+    def setUp(self):
+        self.server = _startServer(("127.0.0.1", 0))
+        storage = storage_server.LockStorageClient(self.server.getAddress())
+        self.lm = lock_manager.LockManager(storage)
+        self.lm._verbose = 1
+
+    def tearDown(self):
+        self.lm.storage.close()
+        self.lm = None
+        self.server.shutdown()
+
+    @classmethod
+    def suite(cls):
+        suite = super(LockClientTest, cls).suite()
+        suite.addTest(cls("testSharedLocks"))
+        suite.addTest(cls("testBatch"))
+        suite.addTest(cls("testHasLocksRoundTrip"))
+        suite.addTest(cls("testLockCheckRoundTrips"))
+        suite.addTest(cls("testMalformedFrames"))
+        return suite
+
+
+    def testSharedLocks(self):                          
+        """Locks should be visible and conflicting across clients."""
+        other = lock_manager.LockManager(storage_server.LockStorageClient(self.server.getAddress()))
+        try:
+            l = self._acquire("/dav/res", "write", "exclusive", "infinity",
+                              self.owner, self.timeout, self.principal, [])
+            assert l and l["token"], "Could not acquire lock"
+            assert other.getLock(l["token"], "root") == "/dav/res"
+            l2 = None
+            try:
+                l2 = other.acquire("/dav/res/sub", "write", "exclusive", "0",
+                                   self.owner, self.timeout, "another principal", [])
+            except lock_manager.DAVError:
+                pass
+            assert l2 is None, "Could acquire a conflicting child lock"
+            other.release(l["token"])
+            assert self.lm.getLock(l["token"]) is None
+        finally:
+            other.storage.close()
+
+
+    def testBatch(self):                          
+        """Pipelined calls should return results in order and re-raise errors."""
+        storage = self.lm.storage
+        res = storage.callBatch([("server", "ping", ()),
+                                 ("locks", "getLockCount", (None, )),
+                                 ("locks", "getStats", ()),
+                                 ])
+        self.assertEqual(res, [None, 0, {"live": 0, "reaped": 0}])
+        self.assertRaises(ValueError, storage.call, "locks", "_dump")
+        # The connection must still be usable after an error
+        self.assertEqual(storage.call("locks", "getLockCount"), 0)
+
+
+    def testHasLocksRoundTrip(self):                          
+        """hasLocks() should need a single call to the storage server."""
+        storage = self.lm.storage
+        calls = []
+        call = storage.call
+        def countingCall(*args):
+            calls.append(args)
+            return call(*args)
+        storage.call = countingCall
+        l = self._acquire("/dav/res", "write", "exclusive", "0",
+                          self.owner, self.timeout, self.principal, [])
+        for url, depth, res in (("/dav/res/sub", "0", True),
+                                ("/dav/other", "infinity", False),
+                                ("/dav", "infinity", True),
+                                ):
+            del calls[:]
+            self.assertEqual(self.lm.hasLocks(url, depth), res)
+            self.assertEqual(len(calls), 1)
+        self.lm.release(l["token"])
+
+
+    def testLockCheckRoundTrips(self):                          
+        """Lock checks should query a URL, its parents and children in one 
+        round trip."""
+        storage = self.lm.storage
+        batches = []
+        callBatch = storage.callBatch
+        def countingCallBatch(requests):
+            batches.append(len(requests))
+            return callBatch(requests)
+        storage.callBatch = countingCallBatch
+        l = self._acquire("/dav/a", "write", "exclusive", "infinity",
+                          self.owner, self.timeout, self.principal, [])
+        del batches[:]
+        self.assertRaises(lock_manager.DAVError, self.lm.checkWritePermission, 
+                          "/dav/a/b/c", "infinity", [], "another principal")
+        # hasLocks(), then '/dav/a/b/c' and 4 parents, and the children
+        self.assertEqual(batches, [1, 6])
+        del batches[:]
+        self.assertEqual(len(self.lm.getIndirectUrlLockList("/dav/a/b")), 1)
+        self.assertEqual(batches, [1, 4])
+        self.lm.release(l["token"])
+
+
+    def testMalformedFrames(self):                          
+        """Invalid frames should close the connection, not crash the server."""
+        for data, closed in (("\x00\x01garbage", True),
+                             ("c\x00\x00\x00\x00\x00\x00\x00\x00", True),
+                             ("[\"locks\", \"getLockCount\", 42]", False),
+                             ("{\"locks\": 1}", False),
+                             ):
+            conn = self.lm.storage._connect()
+            try:
+                conn.sock.sendall(storage_server._FRAME_HEADER.pack(len(data)) + data)
+                reader = conn.reader
+                if closed:
+                    self.assertRaises(EOFError, reader.readFrames)
+                else:
+                    frame = reader.readFrames()[0]
+                    ok, res = storage_server._unpackFrame(frame)
+                    self.assertEqual((ok, res[0]), (False, "ValueError"))
+            finally:
+                conn.close()
+        # The server must still serve other connections
+        self.assertEqual(self.lm.storage.call("locks", "getLockCount"), 0)
+
+
+#===============================================================================
+# UnixSocketTest
+#===============================================================================
+class UnixSocketTest(LockClientTest):                          
+    """Run lock manager tests over a Unix socket."""
+
+    def setUp(self):
+        self.path = os.path.join(gettempdir(), "wsgidav-storage.sock")
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = _startServer(self.path)
+        storage = storage_server.LockStorageClient(self.path)
+        self.lm = lock_manager.LockManager(storage)
+        self.lm._verbose = 1
+
+    @classmethod
+    def suite(cls):
+        suite = TestSuite()
+        suite.addTest(cls("testLock"))
+        suite.addTest(cls("testConflict"))
+        suite.addTest(cls("testSharedLocks"))
+        return suite
+
+
+#===============================================================================
+# PropClientTest
+#===============================================================================
+class PropClientTest(test_property_manager.BasicTest):                          
+    """Run property manager tests against storage_server.PropertyManagerClient()."""
+
+    def setUp(self):
+        self.server = _startServer(("127.0.0.1", 0))
+        self.pm = storage_server.PropertyManagerClient(self.server.getAddress())
+
+    def tearDown(self):
+        self.pm._close()
+        self.pm = None
+        self.server.shutdown()
+
+    @classmethod
+    def suite(cls):
+        suite = super(PropClientTest, cls).suite()
+        suite.addTest(cls("testNonAscii"))
+        return suite
+
+
+    def testOpen(self):                          
+        """Client should connect lazily on first access."""
+        pm = self.pm
+        assert pm._pool.qsize() == 0, "Client must not connect until first access"
+        pm.getProperties(self.respath)
+        assert pm._pool.qsize() == 1, "Connection must be pooled after first access"
+
+
+    def testValidation(self):                          
+        """Client should raise errors on bad args, before calling the server."""
+        pm = self.pm
+        self.assertRaises(AssertionError, 
+                          pm.writeProperty, None, "{ns1:}foo", "hurz", False)
+        self.assertRaises(AssertionError, 
+                          pm.writeProperty, "/dav/res", None, "hurz", False)
+        self.assertRaises(AssertionError, 
+                          pm.writeProperty, "/dav/res", "{ns1:}foo", None, False)
+        assert pm.getProperties("/dav/res") == [], "No properties should have been created by this test" 
+
+
+    def testNonAscii(self):                          
+        """UTF-8 encoded names and values should be returned as str."""
+        pm = self.pm
+        url = "/dav/r\xc3\xa9s"
+        value = "<ns1:foo xmlns:ns1='ns1:'>\xe2\x82\xac</ns1:foo>"
+        pm.writeProperty(url, "{ns1:}foo", value)
+        res = pm.getProperty(url, "{ns1:}foo")
+        self.assertEqual(res, value)
+        assert isinstance(res, str)
+        self.assertEqual(pm.getProperties(url), ["{ns1:}foo"])
+        pm.removeProperties(url)
+
+
+#===============================================================================
+# suite
+#===============================================================================
+def suite():
+    """Return suites of all test cases."""
+    return TestSuite([LockClientTest.suite(), 
+                      UnixSocketTest.suite(),
+                      PropClientTest.suite(),
+                      ])  
+
+
+if __name__ == "__main__":
+#    unittest.main()   
+    suite = suite()
+    TextTestRunner(descriptions=0, verbosity=2).run(suite)
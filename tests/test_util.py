@@ -15,6 +15,8 @@ class BasicTest(TestCase):
         suite = TestSuite()
         suite.addTest(cls("testPreconditions"))
         suite.addTest(cls("testBasics"))
+        suite.addTest(cls("testRanges"))
+        suite.addTest(cls("testBlockSizes"))
         return suite
 
             
@@ -79,6 +81,49 @@ class BasicTest(TestCase):
                          ("", "/a/b/c", ""))
 
 
+    def testRanges(self):                          
+        """Test Range header parsing and multipart/byteranges."""
+        self.assertEqual(obtainContentRanges("bytes=0-9", 100), 
+                         ([(0, 9, 10)], 10))
+        self.assertEqual(obtainContentRanges("bytes=-10", 100), 
+                         ([(90, 99, 10)], 10))
+        self.assertEqual(obtainContentRanges("bytes=90-200", 100), 
+                         ([(90, 99, 10)], 10))
+        self.assertEqual(obtainContentRanges("bytes=100-", 100), ([], 0))
+        self.assertEqual(obtainContentRanges("bytes=-0", 100), ([], 0))
+        # Sorted, overlapping and adjacent ranges are coalesced
+        self.assertEqual(obtainContentRanges("bytes=50-59,0-9,5-19,20-29", 100), 
+                         ([(0, 29, 30), (50, 59, 10)], 40))
+        self.assertEqual(obtainContentRanges("bytes=0-9,15-19,50-59", 100, 10), 
+                         ([(0, 19, 20), (50, 59, 10)], 30))
+        self.assertEqual(obtainContentRanges("bytes=0-9,5-5,0-0", 100), 
+                         ([(0, 9, 10)], 10))
+
+        listRanges, _ = obtainContentRanges("bytes=0-1,-2", 10)
+        contentType, parts, contentLength = getMultipartByteranges(
+            listRanges, 10, "text/plain", "XyZ")
+        self.assertEqual(contentType, "multipart/byteranges; boundary=XyZ")
+        self.assertEqual(parts, 
+            ["\r\n--XyZ\r\nContent-Type: text/plain\r\n"
+             "Content-Range: bytes 0-1/10\r\n\r\n",
+             (0, 2),
+             "\r\n--XyZ\r\nContent-Type: text/plain\r\n"
+             "Content-Range: bytes 8-9/10\r\n\r\n",
+             (8, 2),
+             "\r\n--XyZ--\r\n"])
+        self.assertEqual(contentLength, 
+                         sum([ len(p) for p in parts if isinstance(p, str) ]) + 4)
+
+
+    def testBlockSizes(self):                          
+        """Test adaptive block sizes."""
+        blockSizes = iterBlockSizes(8192, 65536)
+        self.assertEqual([ blockSizes.next() for _i in range(6) ], 
+                         [8192, 16384, 32768, 65536, 65536, 65536])
+        blockSizes = iterBlockSizes(8192, 1000)
+        self.assertEqual([ blockSizes.next() for _i in range(2) ], [1000, 1000])
+
+
 #===============================================================================
 # suite
 #===============================================================================
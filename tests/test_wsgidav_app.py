@@ -13,16 +13,38 @@
 from tempfile import gettempdir
 from wsgidav.wsgidav_app import DEFAULT_CONFIG, WsgiDAVApp
 from wsgidav.fs_dav_provider import FilesystemProvider
-#from wsgidav import util
+from wsgidav import util
+from wsgidav.file_wrapper import FileWrapper
+from wsgidav.content_cache import ContentCache
+from wsgidav.file_handle_cache import FileHandleCache
+from wsgidav import page_cache
+from wsgidav import compression
+from wsgidav.chunked_input import ChunkedInput
+from wsgidav.server.cherrypy_wsgiserver import HTTPConnection
+from wsgidav.dav_error import DAVError
+from wsgidav.property_manager import SQLitePropertyManager
 import os
+import socket
+import threading
+import time
 import unittest
+import urllib
 import sys
+import zlib
+from cStringIO import StringIO
 
 try:
     from paste.fixture import TestApp  #@UnresolvedImport
 except:
     print >>sys.stderr, "Could not import paste.fixture.TestApp: tests will fail"
 
+class _SendallOnly(object):
+    """Wrap a socket like an SSL connection, that must not use sendfile()."""
+    def __init__(self, sock):
+        self.sendall = sock.sendall
+
+
+
 #===============================================================================
 # ServerTest
 #===============================================================================
@@ -36,6 +58,18 @@ class ServerTest(unittest.TestCase):
         suite.addTest(cls("testPreconditions"))
         suite.addTest(cls("testDirBrowser"))
         suite.addTest(cls("testGetPut"))
+        suite.addTest(cls("testResourceCache"))
+        suite.addTest(cls("testSubtreeProperties"))
+        suite.addTest(cls("testStatCache"))
+        suite.addTest(cls("testStatPrefetch"))
+        suite.addTest(cls("testFileWrapper"))
+        suite.addTest(cls("testFileOffload"))
+        suite.addTest(cls("testContentCache"))
+        suite.addTest(cls("testFileHandleCache"))
+        suite.addTest(cls("testPageCacheHints"))
+        suite.addTest(cls("testCompression"))
+        suite.addTest(cls("testEncodedPut"))
+        suite.addTest(cls("testChunkedPut"))
         suite.addTest(cls("testEncoding"))
         suite.addTest(cls("testAuthentication"))
         return suite
@@ -155,6 +189,703 @@ class ServerTest(unittest.TestCase):
         app.put("/file1.txt", params=data1, status=201)
         
 
+    def testResourceCache(self):
+        """Memoize resource instances per request."""
+        app = self.app
+        provider = FilesystemProvider(self.rootpath)
+        environ = {"wsgidav.provider": provider}
+
+        app.put("/file1.txt", params="data", status=[201, 204])
+        res = provider.getResourceInst("/file1.txt", environ)
+        self.assertTrue(provider.getResourceInst("/file1.txt", environ) is res)
+        self.assertEqual(provider.getResourceInst("/nofile.txt", environ), None)
+        self.assertEqual(provider.getResourceInst("/nofile.txt", environ), None)
+        self.assertEqual(provider._count_resourceCacheHits, 2)
+        # Other requests don't share the cache
+        self.assertFalse(provider.getResourceInst("/file1.txt", 
+                         {"wsgidav.provider": provider}) is res)
+        # Invalidating a path drops its parent and descendants
+        provider.getResourceInst("/", environ)
+        provider.invalidateResourceCache(environ, "/file1.txt")
+        self.assertEqual(environ["wsgidav.resourceCache"].keys(), 
+                         ["/nofile.txt"])
+        self.assertFalse(provider.getResourceInst("/file1.txt", environ) is res)
+
+        # Handlers must not see stale instances after modifying a path
+        app.delete("/cache", expect_errors=True)
+        app.delete("/cache2", expect_errors=True)
+        app._gen_request("MKCOL", "/cache", status=201)
+        app.put("/cache/file1.txt", params="data", status=201)
+        app._gen_request("COPY", "/cache", 
+                         headers={"Destination": "/cache2"}, status=201)
+        app._gen_request("COPY", "/cache", 
+                         headers={"Destination": "/cache2"}, status=204)
+        app.delete("/cache", status=204)
+        app._gen_request("MOVE", "/cache2", 
+                         headers={"Destination": "/cache"}, status=201)
+        res = app.get("/cache/file1.txt", status=200)
+        self.assertEqual(res.body, "data")
+        app.delete("/cache", status=204)
+        app.get("/cache/file1.txt", status=404)
+
+
+    def testSubtreeProperties(self):
+        """COPY and DELETE of collections should process dead properties with 
+        a single property manager call."""
+        wsgi_app = self._makeWsgiDAVApp(False)
+        app = TestApp(wsgi_app)
+        path = os.path.join(gettempdir(), "wsgidav-subtree-props.sqlite")
+        if os.path.exists(path):
+            os.remove(path)
+        propMan = SQLitePropertyManager(path)
+        wsgi_app.providerMap["/"].setPropManager(propMan)
+        calls = []
+        def counting(name):
+            method = getattr(propMan, name)
+            def wrapper(*args, **kwargs):
+                calls.append((name, kwargs.get("withChildren", False)))
+                return method(*args, **kwargs)
+            setattr(propMan, name, wrapper)
+        counting("copyProperties")
+        counting("removeProperties")
+        body = ('<?xml version="1.0"?><D:propertyupdate xmlns:D="DAV:" '
+                'xmlns:Z="http://example.com/ns"><D:set><D:prop>'
+                '<Z:color>red</Z:color></D:prop></D:set></D:propertyupdate>')
+        try:
+            app.delete("/tree", expect_errors=True)
+            app.delete("/copy", expect_errors=True)
+            del calls[:]
+            app._gen_request("MKCOL", "/tree", status=201)
+            app._gen_request("MKCOL", "/tree/sub", status=201)
+            app.put("/tree/sub/a.txt", params="data", status=201)
+            for url in ("/tree", "/tree/sub", "/tree/sub/a.txt"):
+                app._gen_request("PROPPATCH", url, params=body, status=207)
+            app._gen_request("COPY", "/tree", 
+                             headers={"Destination": "/copy"}, status=201)
+            self.assertEqual(calls, [("copyProperties", True)])
+            self.assertEqual(propMan.getProperties("/copy/sub/a.txt"), 
+                             ["{http://example.com/ns}color"])
+            self.assertEqual(propMan.getProperties("/copy/sub/"), 
+                             ["{http://example.com/ns}color"])
+            del calls[:]
+            app.delete("/copy", status=204)
+            self.assertEqual(calls, [("removeProperties", True)])
+            self.assertEqual(propMan.getProperties("/copy/sub/a.txt"), [])
+            self.assertEqual(propMan.getProperties("/tree/sub/a.txt"), 
+                             ["{http://example.com/ns}color"])
+            app.delete("/tree", status=204)
+            self.assertEqual(propMan.getProperties("/tree/sub/a.txt"), [])
+        finally:
+            propMan._close()
+
+
+    def testStatCache(self):
+        """Stat every file only once per request."""
+        app = self.app
+        provider = FilesystemProvider(self.rootpath)
+        statCache = provider.statCache
+        environ = {"wsgidav.provider": provider}
+        fp = os.path.join(self.rootpath, "stat", "file1.txt")
+        app.delete("/stat", expect_errors=True)
+        app._gen_request("MKCOL", "/stat", status=201)
+        app.put("/stat/file1.txt", params="data", status=201)
+
+        folder = provider.getResourceInst("/stat", environ)
+        # Listing a folder takes the member types from the directory entries
+        self.assertEqual(folder.getMemberNames(), ["file1.txt"])
+        self.assertEqual(statCache._count_stat, 1)
+        # Members are stat'ed on first property access
+        res = folder.getMember("file1.txt")
+        self.assertEqual(res.getPreferredPath(), "/stat/file1.txt")
+        self.assertEqual(statCache._count_stat, 1)
+        self.assertEqual(res.getContentLength(), 4)
+        count = statCache._count_stat
+        self.assertEqual(count, 2)
+        self.assertFalse(hasattr(res, "__dict__"))
+        self.assertEqual(res.getEtag(), util.getETag(fp))
+        self.assertEqual(statCache._count_stat, count)
+        # Other requests don't share the results (ttl is 0)
+        provider.getResourceInst("/stat/file1.txt", {"wsgidav.provider": provider})
+        self.assertEqual(statCache._count_stat, count + 1)
+
+        # Modifications invalidate the path and its parent
+        app.put("/stat/file1.txt", params="more data", status=204)
+        provider.invalidateResourceCache(environ, "/stat/file1.txt")
+        self.assertEqual(environ["wsgidav.statCache"], {})
+        res = provider.getResourceInst("/stat/file1.txt", environ)
+        self.assertEqual(res.getContentLength(), 9)
+
+        # Results are shared across requests for statCacheTtl seconds
+        provider = FilesystemProvider(self.rootpath, statCacheTtl=1000)
+        statCache = provider.statCache
+        provider.getResourceInst("/stat/file1.txt", {"wsgidav.provider": provider})
+        os.remove(fp)
+        res = provider.getResourceInst("/stat/file1.txt", {"wsgidav.provider": provider})
+        self.assertEqual(res.getContentLength(), 9)
+        self.assertEqual(statCache._count_stat, 1)
+        statCache.invalidate(fp)
+        self.assertEqual(provider.getResourceInst("/stat/file1.txt", {}), None)
+
+        # Links are followed, other entries are skipped
+        if hasattr(os, "symlink"):
+            folderPath = os.path.join(self.rootpath, "stat")
+            app._gen_request("MKCOL", "/stat/folder", status=201)
+            app.put("/stat/file2.txt", params="data", status=201)
+            os.symlink(os.path.join(folderPath, "folder"), 
+                       os.path.join(folderPath, "link1"))
+            os.symlink(os.path.join(folderPath, "file2.txt"), 
+                       os.path.join(folderPath, "link2.txt"))
+            os.symlink(os.path.join(folderPath, "missing"), 
+                       os.path.join(folderPath, "link3"))
+            self.assertEqual(sorted(statCache.listDir(folderPath)), 
+                             [(u"file2.txt", False), (u"folder", True), 
+                              (u"link1", True), (u"link2.txt", False)])
+            # Don't let DELETE recurse into the linked folder
+            os.remove(os.path.join(folderPath, "link1"))
+        app.delete("/stat", status=204)
+
+
+    def testStatPrefetch(self):
+        """Stat folder members concurrently."""
+        app = self.app
+        provider = FilesystemProvider(self.rootpath, prefetchThreads=2,
+                                      prefetchThreadsPerRequest=3)
+        statCache = provider.statCache
+        environ = {"wsgidav.provider": provider}
+        app.delete("/prefetch", expect_errors=True)
+        app._gen_request("MKCOL", "/prefetch", status=201)
+        for i in range(20):
+            app.put("/prefetch/file%s.txt" % i, params="x" * i, status=201)
+
+        folder = provider.getResourceInst("/prefetch", environ)
+        names = folder.getMemberNames()
+        members = folder.getMemberList()
+        self.assertEqual([m.name for m in members], names)
+        for member in members:
+            self.assertEqual(member.getContentLength(),
+                             int(member.name[4:-4]))
+        # Every member was stat'ed once
+        self.assertEqual(statCache._count_stat, 21)
+        self.assertEqual(len(environ["wsgidav.statCache"]), 21)
+        self.assertTrue(len(statCache._pool._threads) <= 2)
+        app.delete("/prefetch", status=204)
+
+
+    def testFileWrapper(self):
+        """Return wsgi.file_wrapper for files and send it with sendfile()."""
+        wsgi_app = self._makeWsgiDAVApp(False)
+        results = []
+        def recording_app(environ, start_response):
+            results.append(wsgi_app(environ, start_response))
+            return results[-1]
+        app = TestApp(recording_app,
+                      extra_environ={"wsgi.file_wrapper": FileWrapper})
+        data = "".join(["%06i\n" % i for i in xrange(50000)])
+        app.delete("/wrapped.txt", expect_errors=True)
+        app.put("/wrapped.txt", params=data, status=201)
+
+        res = app.get("/wrapped.txt", status=200)
+        self.assertEqual(res.body, data)
+        self.assertTrue(isinstance(results[-1], FileWrapper))
+        res = app.get("/wrapped.txt", headers={"Range": "bytes=7-13"}, 
+                      status=206)
+        self.assertEqual(res.body, "000001\n")
+        self.assertEqual(results[-1].length, 7)
+
+        # Several ranges: multipart/byteranges with and without file wrapper
+        for extra_environ in ({}, {"wsgi.file_wrapper": None}):
+            res = app.get("/wrapped.txt", 
+                          headers={"Range": "bytes=0-6,-7,14-20,7-13"}, 
+                          extra_environ=extra_environ, status=206)
+            self.assertEqual(res.header("Content-Length"), str(len(res.body)))
+            contentType, boundary = res.header("Content-Type").split("; boundary=")
+            self.assertEqual(contentType, "multipart/byteranges")
+            parts = res.body.split("\r\n--%s" % boundary)
+            self.assertEqual(parts[0], "")
+            self.assertEqual(parts[-1], "--\r\n")
+            self.assertEqual(parts[1:-1], 
+                             ["\r\nContent-Type: text/plain\r\n"
+                              "Content-Range: bytes 0-20/%s\r\n\r\n%s" 
+                              % (len(data), data[0:21]),
+                              "\r\nContent-Type: text/plain\r\n"
+                              "Content-Range: bytes %s-%s/%s\r\n\r\n%s" 
+                              % (len(data) - 7, len(data) - 1, len(data),
+                                 data[-7:]),
+                              ])
+        self.assertTrue(isinstance(results[-2], FileWrapper))
+        self.assertFalse(isinstance(results[-1], FileWrapper))
+
+        # Send with sendfile() (or large blocks)
+        received = []
+        def receive(sock):
+            while True:
+                buf = sock.recv(65536)
+                if not buf:
+                    break
+                received.append(buf)
+        for useSocket in (True, False):
+            received[:] = []
+            sock, peer = socket.socketpair()
+            reader = threading.Thread(target=receive, args=(peer, ))
+            reader.start()
+            f = open(os.path.join(self.rootpath, "wrapped.txt"), "rb")
+            f.seek(10)
+            wrapper = FileWrapper(f, length=300000)
+            if useSocket:
+                self.assertEqual(wrapper.sendTo(sock, 200000), 200000)
+            else:
+                # No plain socket: send in blocks
+                self.assertEqual(wrapper.sendTo(_SendallOnly(sock)), 300000)
+            sock.close()
+            reader.join()
+            peer.close()
+            self.assertEqual(f.tell(), 200010 if useSocket else 300010)
+            wrapper.close()
+            self.assertEqual("".join(received), 
+                             data[10:200010] if useSocket else data[10:300010])
+
+        app.delete("/wrapped.txt", status=204)
+
+
+    def testFileOffload(self):
+        """Let a front-end server send files (X-Accel-Redirect, X-Sendfile)."""
+        wsgi_app = self._makeWsgiDAVApp(False)
+        app = TestApp(wsgi_app)
+        app.delete("/offload", expect_errors=True)
+        app._gen_request("MKCOL", "/offload", status=201)
+        app.put("/offload/a file.txt", params="data", status=201)
+
+        wsgi_app.config["file_offload"] = {
+            "": {"header": "X-Accel-Redirect", "location": "/internal/"}}
+        res = app.get("/offload/a%20file.txt", 
+                      headers={"Range": "bytes=1-2"}, status=200)
+        self.assertEqual(res.body, "")
+        self.assertEqual(res.header("X-Accel-Redirect"), 
+                         "/internal/offload/a%20file.txt")
+        self.assertEqual(res.header("Content-Type"), "text/plain")
+        # Conditional headers are still evaluated by WsgiDAV
+        app.get("/offload/a%20file.txt", 
+                headers={"If-None-Match": res.header("ETag")}, status=304)
+        # Not for collections, HEAD, or other shares
+        app.get("/offload/", status=200)
+        self.assertEqual(app.head("/offload/a%20file.txt")
+                         .header("Content-Length"), "4")
+        wsgi_app.config["file_offload"] = {
+            "other": {"header": "X-Sendfile"}}
+        self.assertEqual(app.get("/offload/a%20file.txt").body, "data")
+
+        wsgi_app.config["file_offload"] = {"/": {"header": "X-Sendfile"}}
+        res = app.get("/offload/a%20file.txt", status=200)
+        self.assertEqual(res.header("X-Sendfile"), 
+                         os.path.join(self.rootpath, "offload", "a file.txt"))
+        # nginx parses X-Accel-Redirect as URI, so the path must be quoted
+        wsgi_app.config["file_offload"] = {"/": {"header": "X-Accel-Redirect"}}
+        app.put("/offload/x%3Fy%20z", params="data", status=201)
+        res = app.get("/offload/x%3Fy%20z", status=200)
+        self.assertEqual(res.header("X-Accel-Redirect"), 
+                         urllib.quote(os.path.join(self.rootpath, "offload", 
+                                                   "x?y z")))
+        assert "?" not in res.header("X-Accel-Redirect")
+        
+        wsgi_app.config["file_offload"] = {}
+        app.delete("/offload", status=204)
+
+
+    def testContentCache(self):
+        """Serve small files from memory."""
+        wsgi_app = self._makeWsgiDAVApp(False)
+        app = TestApp(wsgi_app)
+        provider = wsgi_app.providerMap["/"]
+        cache = provider.contentCache = ContentCache(maxBytes=100, maxFileSize=50)
+        app.delete("/cache", expect_errors=True)
+        app._gen_request("MKCOL", "/cache", status=201)
+        app.put("/cache/small.txt", params="0123456789", status=201)
+        app.put("/cache/big.txt", params="x" * 51, status=201)
+
+        self.assertEqual(app.get("/cache/small.txt").body, "0123456789")
+        self.assertEqual(app.get("/cache/small.txt").body, "0123456789")
+        res = app.get("/cache/small.txt", headers={"Range": "bytes=2-4"}, 
+                      status=206)
+        self.assertEqual(res.body, "234")
+        self.assertEqual(app.get("/cache/big.txt").body, "x" * 51)
+        stats = cache.getStats()
+        self.assertEqual((stats["entries"], stats["bytes"], stats["hits"], 
+                          stats["misses"]), (1, 10, 2, 1))
+
+        # Modifications through WsgiDAV and by other processes
+        app.put("/cache/small.txt", params="abcdefghij", status=204)
+        self.assertEqual(app.get("/cache/small.txt").body, "abcdefghij")
+        f = open(os.path.join(self.rootpath, "cache", "small.txt"), "wb")
+        f.write("changed")
+        f.close()
+        self.assertEqual(app.get("/cache/small.txt").body, "changed")
+        self.assertEqual(app.get("/cache/small.txt").body, "changed")
+        self.assertEqual(cache.getStats()["hits"], 3)
+
+        # Least recently used files are discarded
+        for i in range(12):
+            app.put("/cache/file%s.txt" % i, params="%010i" % i, status=201)
+            app.get("/cache/file%s.txt" % i, status=200)
+        self.assertEqual(cache.getStats()["bytes"], 100)
+        self.assertEqual(cache.getStats()["entries"], 10)
+        self.assertEqual(app.get("/cache/file11.txt").body, "%010i" % 11)
+        self.assertEqual(cache.getStats()["hits"], 4)
+
+        app.delete("/cache", status=204)
+        self.assertEqual(cache.getStats()["entries"], 0)
+        provider.contentCache = None
+
+
+    def testFileHandleCache(self):
+        """Reuse open files for sequential range requests."""
+        wsgi_app = self._makeWsgiDAVApp(False)
+        app = TestApp(wsgi_app)
+        provider = wsgi_app.providerMap["/"]
+        cache = provider.fileHandleCache = FileHandleCache(maxHandles=2, 
+                                                           idleTimeout=0.2)
+        data = "".join(["%06i\n" % i for i in xrange(10000)])
+        app.delete("/handles", expect_errors=True)
+        app._gen_request("MKCOL", "/handles", status=201)
+        app.put("/handles/file1.txt", params=data, status=201)
+
+        for i in range(10):
+            res = app.get("/handles/file1.txt", 
+                          headers={"Range": "bytes=%s-%s" % (i * 7000, i * 7000 + 6999)}, 
+                          status=206)
+            self.assertEqual(res.body, data[i * 7000:(i + 1) * 7000])
+        self.assertEqual(cache.getStats(), {"open": 1, "hits": 9, "opens": 1})
+
+        # Descriptors are shared, positions are not
+        environ = {"wsgidav.provider": provider}
+        res = provider.getResourceInst("/handles/file1.txt", environ)
+        f1 = res.getContent()
+        f2 = res.getContent()
+        self.assertEqual(f1.fileno(), f2.fileno())
+        f1.seek(7)
+        self.assertEqual(f1.read(7), "000001\n")
+        self.assertEqual(f2.read(7), "000000\n")
+        self.assertEqual(f1.tell(), 14)
+        f1.close()
+        f2.close()
+
+        # Modified files are opened again
+        app.put("/handles/file1.txt", params="new data", status=204)
+        self.assertEqual(app.get("/handles/file1.txt").body, "new data")
+        for i in range(2, 5):
+            app.put("/handles/file%s.txt" % i, params="data", status=201)
+            app.get("/handles/file%s.txt" % i, status=200)
+        self.assertEqual(cache.getStats()["open"], 2)
+        time.sleep(0.5)
+        self.assertEqual(cache.getStats()["open"], 0)
+        
+        app.delete("/handles", status=204)
+        provider.fileHandleCache = None
+
+
+    def testPageCacheHints(self):
+        """Read ahead of streamed files and drop the pages behind them."""
+        wsgi_app = self._makeWsgiDAVApp(False)
+        app = TestApp(wsgi_app)
+        provider = wsgi_app.providerMap["/"]
+        calls = []
+        def recording_fadvise(fd, offset, length, advice):
+            calls.append((offset, length, advice))
+            return True
+        def covered(advice):
+            return sum([ c[1] for c in calls if c[2] == advice ])
+        data = "".join(["%06i\n" % i for i in xrange(100000)])
+        app.delete("/hints.txt", expect_errors=True)
+        app.put("/hints.txt", params=data, status=201)
+
+        orgFadvise = page_cache.fadvise
+        page_cache.fadvise = recording_fadvise
+        try:
+            # Advice is given in windows, while the range is read
+            f = open(os.path.join(self.rootpath, "hints.txt"), "rb")
+            advisor = page_cache.StreamAdvisor(f.fileno(), dropBehind=True, 
+                                               window=64 * 1024)
+            advisor.begin(0, len(data))
+            pos = 0
+            while pos < len(data):
+                pos += len(f.read(8192))
+                advisor.update(pos)
+            advisor.end(pos)
+            f.close()
+            self.assertEqual(calls[0], (0, 64 * 1024, page_cache.POSIX_FADV_WILLNEED))
+            self.assertEqual(covered(page_cache.POSIX_FADV_WILLNEED), len(data))
+            self.assertEqual(covered(page_cache.POSIX_FADV_DONTNEED), len(data))
+
+            # Small ranges are left to the kernel
+            del calls[:]
+            advisor.begin(0, 1000)
+            advisor.update(1000)
+            advisor.end(1000)
+            self.assertEqual(calls, [])
+
+            if page_cache.isAvailable():
+                # Pages are only dropped for files larger than dropBehindSize
+                for dropBehindSize, dropped in ((0, 0), (len(data) - 1, len(data))):
+                    provider.dropBehindSize = dropBehindSize
+                    del calls[:]
+                    res = app.get("/hints.txt", status=200)
+                    self.assertEqual(res.body, data)
+                    self.assertEqual(covered(page_cache.POSIX_FADV_WILLNEED), len(data))
+                    self.assertEqual(covered(page_cache.POSIX_FADV_DONTNEED), dropped)
+        finally:
+            page_cache.fadvise = orgFadvise
+            provider.dropBehindSize = 0
+
+        # Files are prefetched in a background thread
+        prefetcher = page_cache.FilePrefetcher(maxBytes=1024)
+        prefetcher.prefetch([os.path.join(self.rootpath, "hints.txt"),
+                             os.path.join(self.rootpath, "missing.txt")])
+        for _i in range(50):
+            if prefetcher.getStats()["pending"] == 0:
+                break
+            time.sleep(0.1)
+        time.sleep(0.1)
+        self.assertEqual(prefetcher.getStats()["prefetched"], 1)
+        app.delete("/hints.txt", status=204)
+
+
+    def testCompression(self):
+        """gzip multistatus, directory listings and text GET responses."""
+        wsgi_app = self._makeWsgiDAVApp(False)
+        app = TestApp(wsgi_app)
+        gzip = {"Accept-Encoding": "gzip, deflate"}
+        def gunzip(res):
+            self.assertEqual(res.header("Content-Encoding"), "gzip")
+            self.assertEqual(res.header("Content-Length", str(len(res.body))), 
+                             str(len(res.body)))
+            return zlib.decompress(res.body, 16 + zlib.MAX_WBITS)
+
+        self.assertTrue(compression.acceptsGzip({"HTTP_ACCEPT_ENCODING": "deflate, gzip;q=0.5"}))
+        self.assertFalse(compression.acceptsGzip({"HTTP_ACCEPT_ENCODING": "gzip;q=0, *"}))
+        self.assertTrue(compression.acceptsGzip({"HTTP_ACCEPT_ENCODING": "*"}))
+        self.assertFalse(compression.acceptsGzip({"HTTP_ACCEPT_ENCODING": "identity"}))
+        # Off by default, omitted options keep their defaults
+        def getEncoding(opts, size=4096, isTextGet=False):
+            environ = {"HTTP_ACCEPT_ENCODING": "gzip", 
+                       "wsgidav.config": {"compression": opts}}
+            return compression.getContentEncoding(environ, size, isTextGet)
+        self.assertEqual(getEncoding(DEFAULT_CONFIG["compression"]), None)
+        self.assertEqual(getEncoding({"text_get": True}, isTextGet=True), None)
+        self.assertEqual(getEncoding({"enable": True}), "gzip")
+        self.assertEqual(getEncoding({"enable": True}, size=1000), None)
+        self.assertEqual(getEncoding({"enable": True}, isTextGet=True), None)
+
+        app.delete("/gzip", expect_errors=True)
+        app._gen_request("MKCOL", "/gzip", status=201)
+        for i in range(20):
+            app.put("/gzip/file%s.txt" % i, params="data", status=201)
+        data = "".join(["line %06i\n" % i for i in xrange(10000)])
+        app.put("/gzip/big.txt", params=data, status=201)
+        res = app.get("/gzip/", headers=gzip, status=200)
+        self.assertEqual(res.header("Content-Encoding", None), None)
+        wsgi_app.config["compression"] = {"enable": True}
+
+        # Multistatus and directory listings
+        plain = app._gen_request("PROPFIND", "/gzip", headers={"Depth": "1"}, 
+                                 status=207)
+        self.assertEqual(plain.header("Content-Encoding", None), None)
+        res = app._gen_request("PROPFIND", "/gzip", 
+                               headers=dict(gzip, Depth="1"), status=207)
+        self.assertEqual(gunzip(res), plain.body)
+        self.assertTrue(len(res.body) < len(plain.body) / 4)
+        plain = app.get("/gzip/", status=200)
+        res = app.get("/gzip/", headers=gzip, status=200)
+        self.assertEqual(gunzip(res), plain.body)
+        # Small responses are not compressed
+        res = app._gen_request("PROPFIND", "/gzip/file1.txt", 
+                               headers=dict(gzip, Depth="0"), status=207)
+        self.assertEqual(res.header("Content-Encoding", None), None)
+
+        # Text GET responses only, if enabled
+        res = app.get("/gzip/big.txt", headers=gzip, status=200)
+        self.assertEqual(res.header("Content-Encoding", None), None)
+        config = wsgi_app.config
+        orgOpts = config["compression"]
+        config["compression"] = dict(orgOpts, text_get=True)
+        try:
+            res = app.get("/gzip/big.txt", headers=gzip, status=200)
+            self.assertEqual(gunzip(res), data)
+            self.assertTrue(res.header("ETag").endswith('-gzip"'))
+            res = app.get("/gzip/big.txt", status=200)
+            self.assertEqual(res.body, data)
+            # Ranges are sent uncompressed
+            res = app.get("/gzip/big.txt", headers=dict(gzip, Range="bytes=0-11"), 
+                          status=206)
+            self.assertEqual(res.body, "line 000000\n")
+            # Servers without chunked responses must close the connection
+            self.assertEqual(res.header("Connection", None), None)
+            res = app.get("/gzip/big.txt", headers=gzip, status=200)
+            self.assertEqual(res.header("Connection"), "close")
+            res = app.get("/gzip/big.txt", headers=gzip, status=200, 
+                          extra_environ={"wsgidav.chunked_response_support": True})
+            self.assertEqual(res.header("Connection", None), None)
+            # Revalidation with the entity tag of the compressed response
+            etag = res.header("ETag")
+            app.get("/gzip/big.txt", headers=dict(gzip, **{"If-None-Match": etag}), 
+                    status=304)
+            app.get("/gzip/big.txt", headers={"If-None-Match": etag}, status=304)
+            # If-Range needs the tag of the uncompressed representation
+            res = app.get("/gzip/big.txt", headers=dict(gzip, Range="bytes=0-11", 
+                                                        **{"If-Range": etag}), 
+                          status=200)
+            self.assertEqual(gunzip(res), data)
+            app.put("/gzip/big.txt", params=data, headers={"If-Match": etag}, 
+                    status=204)
+        finally:
+            config["compression"] = orgOpts
+
+        app.delete("/gzip", status=204)
+
+
+    def testEncodedPut(self):
+        """Decode gzip and deflate PUT bodies, reject decompression bombs."""
+        wsgi_app = self._makeWsgiDAVApp(False)
+        app = TestApp(wsgi_app)
+        data = "".join(["line %06i\n" % i for i in xrange(100000)])
+        def gzip(s):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return compressor.compress(s) + compressor.flush()
+        def rawDeflate(s):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            return compressor.compress(s) + compressor.flush()
+        def chunked(s):
+            return "".join([ "%x\r\n%s\r\n" % (len(s[i:i + 4096]), s[i:i + 4096]) 
+                             for i in xrange(0, len(s), 4096) ]) + "0\r\n\r\n"
+        app.delete("/encoded.txt", expect_errors=True)
+
+        for encoding, body in (("gzip", gzip(data)), 
+                               ("deflate", zlib.compress(data)),
+                               ("deflate", rawDeflate(data))):
+            app.delete("/encoded.txt", expect_errors=True)
+            app.put("/encoded.txt", params=body, 
+                    headers={"Content-Encoding": encoding}, status=201)
+            self.assertEqual(app.get("/encoded.txt").body, data)
+        app.put("/encoded.txt", params=chunked(gzip(data)), 
+                headers={"Content-Encoding": "gzip",
+                         "Transfer-Encoding": "chunked"}, status=204)
+        self.assertEqual(app.get("/encoded.txt").body, data)
+
+        app.put("/encoded.txt", params=data, 
+                headers={"Content-Encoding": "br"}, status=415)
+        app.put("/encoded.txt", params=data, 
+                headers={"Content-Encoding": "gzip"}, status=400)
+        # Truncated bodies must not be stored
+        for encoding, body in (("gzip", gzip(data)), 
+                               ("deflate", zlib.compress(data))):
+            app.put("/encoded.txt", params=body[:len(body) // 2], 
+                    headers={"Content-Encoding": encoding}, status=400)
+            app.put("/encoded.txt", params=body[:-1], 
+                    headers={"Content-Encoding": encoding}, status=400)
+        app.put("/encoded.txt", params=chunked(gzip(data)[:-4]), 
+                headers={"Content-Encoding": "gzip",
+                         "Transfer-Encoding": "chunked"}, status=400)
+        self.assertRaises(DAVError, list, 
+                          compression.decodeIter({}, ["", ""], "gzip"))
+        # Decompression bombs
+        app.put("/encoded.txt", params=gzip("\0" * (16 * 1024 * 1024)), 
+                headers={"Content-Encoding": "gzip"}, status=413)
+        config = wsgi_app.config
+        orgOpts = config["compression"]
+        config["compression"] = dict(orgOpts, max_decoded_size=len(data) - 1)
+        try:
+            app.put("/encoded.txt", params=gzip(data), 
+                    headers={"Content-Encoding": "gzip"}, status=413)
+        finally:
+            config["compression"] = orgOpts
+        app.delete("/encoded.txt", status=204)
+
+
+    def testChunkedPut(self):
+        """Decode chunked PUT bodies and coalesce small chunks."""
+        wsgi_app = self._makeWsgiDAVApp(False)
+        app = TestApp(wsgi_app)
+        data = "".join(["line %06i\n" % i for i in xrange(10000)])
+        def chunked(s, chunkSize, extension="", trailer=""):
+            return "".join([ "%x%s\r\n%s\r\n" % (len(s[i:i + chunkSize]), extension, 
+                                                  s[i:i + chunkSize]) 
+                             for i in xrange(0, len(s), chunkSize) ]) \
+                   + "0\r\n%s\r\n" % trailer
+
+        # Small chunks are returned as large blocks
+        body = ChunkedInput(StringIO(chunked(data, 1000, ';ext="a b";flag', 
+                                             "X-Checksum: abc\r\n")),
+                            blockSize=4096)
+        self.assertEqual(body.read(50000), data[:50000])
+        self.assertEqual(body.extensions, [("ext", "a b"), ("flag", None)])
+        self.assertEqual(body.read(), data[50000:])
+        self.assertEqual(body.read(), "")
+        self.assertTrue(body.eof)
+        self.assertEqual(body.trailers, [("X-Checksum", "abc")])
+        self.assertEqual(body.bytesRead, len(data))
+        # Nothing is read after the last chunk
+        rfile = StringIO(chunked(data, 4096) + "GET / HTTP/1.1\r\n")
+        self.assertEqual("".join(ChunkedInput(rfile, blockSize=1024)), data)
+        self.assertEqual(rfile.read(), "GET / HTTP/1.1\r\n")
+
+        for invalid in ("0x10\r\n", "-1\r\n", " \r\n", "10\n", 
+                        "2\r\nabc\r\n0\r\n\r\n", "5\r\nab", 
+                        "1" * 17 + "\r\n", "1;a b\r\nx\r\n0\r\n\r\n", 
+                        "0\r\nno-colon\r\n\r\n", "f" * 10000):
+            self.assertRaises(DAVError, ChunkedInput(StringIO(invalid)).read)
+        self.assertRaises(DAVError, 
+                          ChunkedInput(StringIO(chunked(data, 1000)), maxSize=1000).read)
+
+        app.delete("/chunked.txt", expect_errors=True)
+        for chunkSize in (1, 1000, 100000):
+            app.put("/chunked.txt", params=chunked(data[:20000], chunkSize), 
+                    headers={"Transfer-Encoding": "chunked"})
+            self.assertEqual(app.get("/chunked.txt").body, data[:20000])
+
+        # The bundled CherryPy server passes chunked bodies to WsgiDAV, which
+        # reads them in blocks and gives back the start of the next request
+        received = []
+        def receive(sock):
+            while True:
+                buf = sock.recv(65536)
+                if not buf:
+                    break
+                received.append(buf)
+        transferCodings = []
+        def recording_app(environ, start_response):
+            transferCodings.append(environ.get("HTTP_TRANSFER_ENCODING"))
+            return wsgi_app(environ, start_response)
+        sock, peer = socket.socketpair()
+        conn = HTTPConnection(sock, recording_app, 
+                              {"SERVER_NAME": "localhost", "SERVER_PORT": "80",
+                               "SERVER_SOFTWARE": "test", 
+                               "ACTUAL_SERVER_PROTOCOL": "HTTP/1.1"})
+        server = threading.Thread(target=conn.communicate)
+        server.start()
+        reader = threading.Thread(target=receive, args=(peer, ))
+        reader.start()
+        peer.sendall("PUT /chunked.txt HTTP/1.1\r\nHost: localhost\r\n"
+                     "Transfer-Encoding: chunked\r\n\r\n" + chunked(data, 1000)
+                     + "PROPFIND /chunked.txt HTTP/1.1\r\nHost: localhost\r\n"
+                     "Depth: 0\r\nTransfer-Encoding: chunked\r\n\r\n"
+                     + chunked("<?xml version='1.0'?><propfind xmlns='DAV:'>"
+                               "<prop><getcontentlength/></prop></propfind>", 10)
+                     + "GET /chunked.txt HTTP/1.1\r\nHost: localhost\r\n"
+                     "Connection: close\r\n\r\n")
+        server.join()
+        sock.close()
+        reader.join()
+        peer.close()
+        response = "".join(received)
+        self.assertEqual(transferCodings, ["chunked", "chunked", None])
+        self.assertTrue(response.startswith("HTTP/1.1 204 "), response[:100])
+        self.assertTrue("HTTP/1.1 207 " in response)
+        self.assertTrue("<ns0:getcontentlength>%s<" % len(data) in response)
+        self.assertTrue(response.endswith("\r\n\r\n" + data))
+
+        app.put("/chunked.txt", params="5\r\nab", 
+                headers={"Transfer-Encoding": "chunked"}, status=400)
+        app.delete("/chunked.txt", status=204)
+
+
     def testEncoding(self):                          
         """Handle special characters."""
         app = self.app
@@ -0,0 +1,265 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Implements `InotifyWatcher`, which reports file system changes to a callback
+using the Linux inotify API (used by CachingProvider).
+
+CachingProvider expires its entries after a TTL, because files may be
+modified by other processes (e.g. the MyTardis ingestion pipeline writes
+datafiles directly into the store). With a watcher, CachingProvider is
+notified about these changes, so entries in watched directories can be kept
+until they are invalidated.
+
+Usage::
+
+    from wsgidav.caching_provider import CachingProvider
+    addShare("", CachingProvider(MyTardisProvider("/var/lib/mytardis/store/"),
+                                 ttl=10, useInotify=True))
+
+Directories are watched on demand, i.e. when a cached resource lives in them.
+No watch is added (so the TTL applies), if
+
+- the directory is on a network file system (NFS, CIFS, ...), where inotify
+  does not see changes made by other hosts,
+- `maxWatches` directories are watched already, or the kernel limit
+  (/proc/sys/fs/inotify/max_user_watches) is reached.
+
+The inotify functions are called through ctypes, so no additional package is
+required. On other platforms, creating an InotifyWatcher raises OSError.
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html
+"""
+from wsgidav import util
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+# Event masks (see <sys/inotify.h>)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+              | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+              | IN_MOVE_SELF | IN_ONLYDIR)
+
+# File systems, where inotify does not report changes made by other hosts
+NETWORK_FS_TYPES = ("nfs", "nfs4", "cifs", "smbfs", "smb3", "ncpfs", "afs",
+                    "coda", "9p", "fuse.sshfs", "glusterfs", "fuse.glusterfs",
+                    "lustre", "gpfs", "ceph", "fuse.ceph")
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _getMountTypes():
+    """Return list of (mountPoint, fsType) tuples, longest mount point first."""
+    mounts = []
+    try:
+        f = open("/proc/mounts")
+        try:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 3:
+                    # Mount points encode spaces etc. as octal escapes
+                    mountPoint = parts[1].decode("string_escape")
+                    mounts.append((mountPoint, parts[2]))
+        finally:
+            f.close()
+    except IOError:
+        pass
+    mounts.sort(key=lambda m: len(m[0]), reverse=True)
+    return mounts
+
+
+
+#===============================================================================
+# InotifyWatcher
+#===============================================================================
+class InotifyWatcher(object):
+    """
+    Watch directories and call `callback(filePath)` for every change.
+
+    callback:
+        Called with the absolute path of a changed file or directory (unicode,
+        if the watched path was unicode), or None if events were lost.
+        The callback runs on the watcher thread.
+    maxWatches:
+        Max. number of watched directories.
+    """
+    def __init__(self, callback, maxWatches=8192):
+        libName = ctypes.util.find_library("c")
+        if not sys.platform.startswith("linux") or not libName:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._libc = ctypes.CDLL(libName, use_errno=True)
+        if not hasattr(self._libc, "inotify_init"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._callback = callback
+        self.maxWatches = maxWatches
+        self._mounts = _getMountTypes()
+        self._pathToWd = {}
+        self._wdToPath = {}
+        self._unwatchable = set()
+        self._exhausted = False
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="InotifyWatcher")
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+
+    def __repr__(self):
+        return "InotifyWatcher(%s watches)" % len(self._pathToWd)
+
+
+    def _isNetworkPath(self, path):
+        for mountPoint, fsType in self._mounts:
+            if path == mountPoint or path.startswith(mountPoint.rstrip("/") + "/"):
+                return fsType in NETWORK_FS_TYPES
+        return False
+
+
+    def watch(self, dirPath):
+        """Watch a directory (if possible) and return True, if it is watched.
+
+        Changes that happen after this call returned True are reported.
+        """
+        dirPath = dirPath.rstrip(os.sep) or os.sep
+        self._lock.acquire()
+        try:
+            if dirPath in self._pathToWd:
+                return True
+            if (self._stopped or self._exhausted or dirPath in self._unwatchable
+                or len(self._pathToWd) >= self.maxWatches):
+                return False
+            if isinstance(dirPath, unicode):
+                encodedPath = dirPath.encode(sys.getfilesystemencoding())
+            else:
+                encodedPath = dirPath
+            if self._isNetworkPath(encodedPath):
+                _logger.info("Not watching %r (network file system)" % dirPath)
+                self._unwatchable.add(dirPath)
+                return False
+            wd = self._libc.inotify_add_watch(self._fd, encodedPath, WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e == errno.ENOSPC:
+                    util.warn("inotify watch limit reached: falling back to TTL")
+                    self._exhausted = True
+                # ENOENT, ENOTDIR (no directory), EACCES, ...
+                return False
+            self._pathToWd[dirPath] = wd
+            self._wdToPath[wd] = dirPath
+            return True
+        finally:
+            self._lock.release()
+
+
+    def isWatched(self, dirPath):
+        """Return True, if dirPath is watched."""
+        return (dirPath.rstrip(os.sep) or os.sep) in self._pathToWd
+
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                r, _w, _x = select.select([self._fd], [], [], 0.5)
+                if not r:
+                    continue
+                buf = os.read(self._fd, 65536)
+            except (OSError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                if not self._stopped:
+                    _logger.exception("InotifyWatcher stopped")
+                break
+            try:
+                self._handleEvents(buf)
+            except Exception:
+                _logger.exception("InotifyWatcher callback failed")
+
+
+    def _handleEvents(self, buf):
+        pos = 0
+        while pos < len(buf):
+            wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(buf, pos)
+            pos += _EVENT_HEADER.size
+            name = buf[pos:pos + length].rstrip("\0")
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                _logger.warning("inotify queue overflow: invalidating all")
+                self._callback(None)
+                continue
+            self._lock.acquire()
+            try:
+                dirPath = self._wdToPath.get(wd)
+                if mask & (IN_IGNORED | IN_MOVE_SELF) and dirPath is not None:
+                    # Watch was removed (directory deleted, ...), or would
+                    # report events for the old path after a move
+                    if mask & IN_MOVE_SELF:
+                        self._libc.inotify_rm_watch(self._fd, wd)
+                    del self._wdToPath[wd]
+                    if self._pathToWd.get(dirPath) == wd:
+                        del self._pathToWd[dirPath]
+                    self._removeSubWatches(dirPath)
+            finally:
+                self._lock.release()
+            if dirPath is None:
+                continue
+            if name:
+                if isinstance(dirPath, unicode):
+                    name = name.decode(sys.getfilesystemencoding(), "replace")
+                self._callback(os.path.join(dirPath, name))
+            else:
+                self._callback(dirPath)
+
+
+    def _removeSubWatches(self, dirPath):
+        """Remove the watches below dirPath (must hold self._lock).
+
+        Only the moved directory itself receives IN_MOVE_SELF, so the watches
+        of its subdirectories would stay registered under their old paths.
+        """
+        prefix = dirPath.rstrip(os.sep) + os.sep
+        for path in [ p for p in self._pathToWd if p.startswith(prefix) ]:
+            wd = self._pathToWd.pop(path)
+            self._wdToPath.pop(wd, None)
+            # Also discards pending events of this watch (path is unknown)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+
+    def stop(self):
+        """Stop the watcher thread and release all watches."""
+        self._stopped = True
+        self._thread.join()
+        self._lock.acquire()
+        try:
+            os.close(self._fd)
+            self._pathToWd.clear()
+            self._wdToPath.clear()
+        finally:
+            self._lock.release()
@@ -0,0 +1,613 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Implements a storage server that shares locks and dead properties between
+several WsgiDAV nodes (e.g. multiple hosts behind a load balancer).
+
+The server holds one lock storage and one property manager. The client
+classes implement the lock storage and property manager interfaces by
+forwarding all calls to the server.
+
+Start the daemon (run with ``--help`` for all options)::
+
+    python -m wsgidav.addons.storage_server --host 0.0.0.0 --port 8089 \\
+        --locks shelve:/var/lib/wsgidav/locks.shelve \\
+        --props sqlite:/var/lib/wsgidav/props.sqlite
+
+(or pass ``--unix /var/run/wsgidav-storage.sock`` to listen on a Unix socket).
+
+Then add this lines to wsgidav.conf on every node::
+
+    from wsgidav.addons.storage_server import LockStorageClient, PropertyManagerClient
+    locksmanager = LockStorageClient(("storagehost", 8089))
+    propsmanager = PropertyManagerClient(("storagehost", 8089))
+
+Protocol
+--------
+Messages are frames: a 4 byte length (network byte order), followed by a
+JSON encoded list.
+Requests are ``[target, method, args]``, where target is 'locks', 'props' or
+'server'. Replies are ``[true, result]`` or
+``[false, [exception class name, message]]``.
+Strings are sent as UTF-8 and decoded to (UTF-8 encoded) str, tuples are
+decoded as lists. Frames, that are no valid JSON or requests, that are not
+well-formed, close the connection.
+
+Requests are pipelined: a client may send several requests before reading
+the replies, which are returned in order. The server processes all requests
+that arrived together and sends their replies with a single write.
+`StorageClient.callBatch()` uses this to run a list of calls in one round
+trip, e.g. LockStorageClient.getLockLists() checks a URL, its parents and
+its children for LockManager with one batch.
+
+Clients keep a pool of idle connections, so concurrent request threads don't
+have to wait for each other or connect for every call.
+
+LockManager.acquire() calls beginExclusive() / endExclusive() on the lock
+storage. The client pins a connection to the calling thread meanwhile, and
+the server blocks lock storage calls from other connections, so checking for
+conflicts and creating the lock is atomic across all nodes.
+
+**Note:** The server does not authenticate clients: run it on a private
+network or on a Unix socket.
+"""
+from wsgidav import util
+from wsgidav.lock_manager import normalizeLockRoot, validateLock
+from wsgidav.lock_storage import LockStorageDict, LockStorageShelve,\
+    LockStorageSQLite
+from wsgidav.property_manager import PropertyManager, ShelvePropertyManager,\
+    SQLitePropertyManager
+from optparse import OptionParser
+import Queue
+import SocketServer
+import json
+import socket
+import struct
+import threading
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+DEFAULT_PORT = 8089
+RECV_SIZE = 65536
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+_FRAME_HEADER = struct.Struct("!I")
+
+LOCK_METHODS = ("cleanup", "get", "create", "refresh", "delete",
+                "getLockList", "getLockCount", "hasAffectingLocks", "getStats")
+PROP_METHODS = ("getProperties", "getProperty", "writeProperty",
+                "removeProperty", "removeProperties", "copyProperties",
+                "moveProperties")
+
+# Exceptions that are re-raised by the client with the same class
+_REMOTE_EXCEPTIONS = {"AssertionError": AssertionError,
+                      "KeyError": KeyError,
+                      "TypeError": TypeError,
+                      "ValueError": ValueError,
+                      }
+
+
+def _toStr(obj):
+    """Convert the unicode strings of a decoded JSON value to UTF-8 str."""
+    if isinstance(obj, unicode):
+        return obj.encode("utf8")
+    elif isinstance(obj, list):
+        return [ _toStr(o) for o in obj ]
+    elif isinstance(obj, dict):
+        return dict([ (_toStr(k), _toStr(v)) for k, v in obj.iteritems() ])
+    return obj
+
+
+def _packFrame(obj):
+    data = json.dumps(obj, separators=(",", ":"))
+    return _FRAME_HEADER.pack(len(data)) + data
+
+
+def _unpackFrame(data):
+    """Decode a frame (raises ValueError for invalid data)."""
+    return _toStr(json.loads(data))
+
+
+#===============================================================================
+# _FrameReader
+#===============================================================================
+class _FrameReader(object):
+    """Split the byte stream of a socket into frames."""
+    def __init__(self, sock):
+        self._sock = sock
+        self._buf = ""
+
+
+    def _parseFrames(self):
+        frames = []
+        buf = self._buf
+        ofs = 0
+        headerSize = _FRAME_HEADER.size
+        while len(buf) - ofs >= headerSize:
+            (size, ) = _FRAME_HEADER.unpack_from(buf, ofs)
+            if size > MAX_FRAME_SIZE:
+                raise IOError("Frame too large: %s bytes" % size)
+            if len(buf) - ofs - headerSize < size:
+                break
+            ofs += headerSize
+            frames.append(buf[ofs:ofs + size])
+            ofs += size
+        self._buf = buf[ofs:]
+        return frames
+
+
+    def readFrames(self, minCount=1):
+        """Return all complete frames, blocking until there are minCount.
+
+        Raises EOFError, if the peer closed the connection.
+        """
+        frames = self._parseFrames()
+        while len(frames) < minCount:
+            data = self._sock.recv(RECV_SIZE)
+            if not data:
+                raise EOFError("Connection closed by peer")
+            self._buf += data
+            frames.extend(self._parseFrames())
+        return frames
+
+
+#===============================================================================
+# StorageServer
+#===============================================================================
+class _StorageRequestHandler(SocketServer.BaseRequestHandler):
+    """Serve one client connection."""
+    def setup(self):
+        if self.request.family in (socket.AF_INET, socket.AF_INET6):
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.exclusiveDepth = 0
+
+
+    def handle(self):
+        storageServer = self.server.storageServer
+        reader = _FrameReader(self.request)
+        try:
+            while True:
+                try:
+                    frames = reader.readFrames()
+                except EOFError:
+                    break
+                replies = [ _packFrame(storageServer.dispatch(self, _unpackFrame(f)))
+                            for f in frames ]
+                self.request.sendall("".join(replies))
+        except (socket.error, IOError, ValueError), e:
+            _logger.warn("Connection %s aborted: %s" % (self.client_address, e))
+        finally:
+            # Don't block other nodes, if a client died inside acquire()
+            while self.exclusiveDepth > 0:
+                storageServer._exclusiveLock.release()
+                self.exclusiveDepth -= 1
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class StorageServer(object):
+    """
+    Serve a lock storage and a property manager to StorageClient objects.
+
+    address:
+        (host, port) tuple for TCP or a file name for a Unix socket.
+        Pass port 0 to use a free port (see getAddress()).
+    lockStorage:
+        Lock storage object (e.g. lock_storage.LockStorageDict()), or None.
+    propManager:
+        Property manager object (e.g. property_manager.PropertyManager()),
+        or None.
+    """
+    def __init__(self, address, lockStorage, propManager):
+        self.lockStorage = lockStorage
+        self.propManager = propManager
+        # Lock storage calls are serialized, so beginExclusive() can block
+        # other connections
+        self._exclusiveLock = threading.RLock()
+        if isinstance(address, basestring):
+            self._server = _ThreadingUnixServer(address, _StorageRequestHandler)
+        else:
+            self._server = _ThreadingTCPServer(address, _StorageRequestHandler)
+        self._server.storageServer = self
+        if self.lockStorage is not None:
+            self.lockStorage.open()
+
+
+    def __repr__(self):
+        return "StorageServer(%r, %r, %r)" % (self.getAddress(),
+                                              self.lockStorage,
+                                              self.propManager)
+
+
+    def getAddress(self):
+        """Return the address that clients should connect to."""
+        return self._server.server_address
+
+
+    def serve_forever(self, pollInterval=0.5):
+        _logger.info("Serving %r" % self)
+        self._server.serve_forever(pollInterval)
+
+
+    def shutdown(self):
+        """Stop serve_forever() (called from another thread) and close storages."""
+        self._server.shutdown()
+        self._server.server_close()
+        if self.lockStorage is not None:
+            self.lockStorage.close()
+        if self.propManager is not None and hasattr(self.propManager, "_close"):
+            self.propManager._close()
+
+
+    def dispatch(self, handler, request):
+        """Execute a request and return the reply tuple."""
+        try:
+            if not isinstance(request, list) or len(request) != 3 \
+                    or not isinstance(request[2], list):
+                raise ValueError("Malformed request")
+            target, method, args = request
+            if target == "locks" and method in LOCK_METHODS and self.lockStorage:
+                self._exclusiveLock.acquire()
+                try:
+                    return (True, getattr(self.lockStorage, method)(*args))
+                finally:
+                    self._exclusiveLock.release()
+            elif target == "props" and method in PROP_METHODS and self.propManager:
+                return (True, getattr(self.propManager, method)(*args))
+            elif target == "server" and method == "ping":
+                return (True, None)
+            elif target == "server" and method == "beginExclusive":
+                self._exclusiveLock.acquire()
+                handler.exclusiveDepth += 1
+                return (True, None)
+            elif target == "server" and method == "endExclusive":
+                if handler.exclusiveDepth < 1:
+                    raise AssertionError("endExclusive() without beginExclusive()")
+                handler.exclusiveDepth -= 1
+                self._exclusiveLock.release()
+                return (True, None)
+            raise ValueError("Invalid request: %s.%s" % (target, method))
+        except Exception, e:
+            _logger.debug("dispatch(%r) failed: %r" % (request, e))
+            return (False, (e.__class__.__name__, str(e)))
+
+
+#===============================================================================
+# StorageClient
+#===============================================================================
+class _Connection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = _FrameReader(sock)
+
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class StorageClient(object):
+    """
+    Pooled, pipelined connections to a StorageServer.
+
+    address:
+        (host, port) tuple for TCP or a file name for a Unix socket.
+    poolSize:
+        Max. number of idle connections that are kept open.
+    timeout:
+        Socket timeout in seconds.
+    """
+    def __init__(self, address, poolSize=8, timeout=30):
+        self._address = address
+        self._timeout = timeout
+        self._pool = Queue.Queue(poolSize)
+        self._local = threading.local()
+
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self._address)
+
+
+    def _connect(self):
+        if isinstance(self._address, basestring):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self._timeout)
+        sock.connect(self._address)
+        _logger.debug("Connected to %r" % (self._address, ))
+        return _Connection(sock)
+
+
+    def _getConnection(self):
+        conn = getattr(self._local, "pinned", None)
+        if conn is not None:
+            return conn
+        try:
+            return self._pool.get_nowait()
+        except Queue.Empty:
+            return self._connect()
+
+
+    def _putConnection(self, conn):
+        if conn is getattr(self._local, "pinned", None):
+            return
+        try:
+            self._pool.put_nowait(conn)
+        except Queue.Full:
+            conn.close()
+
+
+    def callBatch(self, requests):
+        """Run a list of (target, method, args) requests in one round trip.
+
+        Returns the list of results. If a request failed, its exception is
+        re-raised (after all requests were executed).
+        """
+        conn = self._getConnection()
+        try:
+            conn.sock.sendall("".join([ _packFrame(r) for r in requests ]))
+            frames = conn.reader.readFrames(len(requests))
+        except (socket.error, EOFError, IOError):
+            # The connection is in an undefined state: don't re-use it
+            conn.close()
+            if conn is getattr(self._local, "pinned", None):
+                self._local.pinned = None
+                self._local.depth = 0
+            raise
+        self._putConnection(conn)
+        results = []
+        for frame in frames:
+            ok, res = _unpackFrame(frame)
+            if not ok:
+                name, msg = res
+                if name in _REMOTE_EXCEPTIONS:
+                    raise _REMOTE_EXCEPTIONS[name](msg)
+                raise RuntimeError("%s: %s" % (name, msg))
+            results.append(res)
+        return results
+
+
+    def call(self, target, method, *args):
+        """Run a single request and return the result."""
+        return self.callBatch([(target, method, args)])[0]
+
+
+    def beginExclusive(self):
+        """Block lock storage calls of other connections (nestable).
+
+        The calling thread uses the same connection until endExclusive().
+        """
+        if getattr(self._local, "pinned", None) is None:
+            self._local.pinned = self._getConnection()
+            self._local.depth = 0
+        self._local.depth += 1
+        self.call("server", "beginExclusive")
+
+
+    def endExclusive(self, commit=True):
+        """Finish a beginExclusive() block (commit is ignored)."""
+        try:
+            self.call("server", "endExclusive")
+        finally:
+            conn = getattr(self._local, "pinned", None)
+            if conn is not None:
+                self._local.depth -= 1
+                if self._local.depth < 1:
+                    self._local.pinned = None
+                    self._putConnection(conn)
+
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except Queue.Empty:
+                break
+
+
+#===============================================================================
+# LockStorageClient
+#===============================================================================
+class LockStorageClient(StorageClient):
+    """Implements the lock storage interface (see LockStorageDict) remotely."""
+
+    def open(self):
+        """Called before first use (we connect lazily)."""
+        pass
+
+
+    def cleanup(self):
+        return self.call("locks", "cleanup")
+
+
+    def getLockCount(self, path=None):
+        return self.call("locks", "getLockCount", path)
+
+
+    def hasAffectingLocks(self, path, includeChildren=False):
+        return self.call("locks", "hasAffectingLocks", path, includeChildren)
+
+
+    def getStats(self):
+        return self.call("locks", "getStats")
+
+
+    def get(self, token):
+        return self.call("locks", "get", token)
+
+
+    def create(self, path, lock):
+        # Validate locally, so bad arguments raise AssertionError (instead of
+        # failing to encode)
+        assert lock.get("token") is None
+        assert path and "/" in path
+        check = lock.copy()
+        check["root"] = normalizeLockRoot(path)
+        if check.get("timeout") is None:
+            check["timeout"] = -1
+        validateLock(check)
+        res = self.call("locks", "create", path, lock)
+        # Callers expect the lock dictionary to be updated in place
+        lock.update(res)
+        return lock
+
+
+    def refresh(self, token, timeout):
+        return self.call("locks", "refresh", token, timeout)
+
+
+    def delete(self, token):
+        return self.call("locks", "delete", token)
+
+
+    def getLockList(self, path, includeRoot, includeChildren, tokenOnly):
+        return self.call("locks", "getLockList",
+                         path, includeRoot, includeChildren, tokenOnly)
+
+
+    def getLockLists(self, queries):
+        """Return [getLockList(*args), ...] for a list of argument tuples.
+
+        Used by LockManager to check a URL and all its parents (and children)
+        in one round trip.
+        """
+        return self.callBatch([ ("locks", "getLockList", args) 
+                                for args in queries ])
+
+
+#===============================================================================
+# PropertyManagerClient
+#===============================================================================
+class PropertyManagerClient(StorageClient):
+    """Implements the property manager interface (see PropertyManager) remotely."""
+    SUBTREE_OPERATIONS = True
+
+    def _close(self):
+        self.close()
+
+
+    def getProperties(self, normurl):
+        return self.call("props", "getProperties", normurl)
+
+
+    def getProperty(self, normurl, propname):
+        return self.call("props", "getProperty", normurl, propname)
+
+
+    def writeProperty(self, normurl, propname, propertyvalue, dryRun=False):
+        assert normurl and normurl.startswith("/")
+        assert propname
+        assert propertyvalue is not None
+        if dryRun:
+            return
+        return self.call("props", "writeProperty", normurl, propname, propertyvalue)
+
+
+    def removeProperty(self, normurl, propname, dryRun=False):
+        if dryRun:
+            return
+        return self.call("props", "removeProperty", normurl, propname)
+
+
+    def removeProperties(self, normurl, withChildren=False):
+        return self.call("props", "removeProperties", normurl, withChildren)
+
+
+    def copyProperties(self, srcurl, desturl, withChildren=False):
+        return self.call("props", "copyProperties", srcurl, desturl, withChildren)
+
+
+    def moveProperties(self, srcurl, desturl, withChildren):
+        return self.call("props", "moveProperties", srcurl, desturl, withChildren)
+
+
+#===============================================================================
+# Daemon
+#===============================================================================
+def _makeLockStorage(spec):
+    """Create lock storage from 'dict', 'shelve:<path>' or 'sqlite:<path>'."""
+    kind, _, path = spec.partition(":")
+    if kind == "dict":
+        return LockStorageDict()
+    elif kind == "shelve" and path:
+        return LockStorageShelve(path)
+    elif kind == "sqlite" and path:
+        return LockStorageSQLite(path)
+    raise ValueError("Invalid lock storage: %r" % spec)
+
+
+def _makePropManager(spec):
+    """Create property manager from 'dict', 'shelve:<path>' or 'sqlite:<path>'."""
+    kind, _, path = spec.partition(":")
+    if kind == "dict":
+        return PropertyManager()
+    elif kind == "shelve" and path:
+        return ShelvePropertyManager(path)
+    elif kind == "sqlite" and path:
+        return SQLitePropertyManager(path)
+    raise ValueError("Invalid property manager: %r" % spec)
+
+
+def run():
+    parser = OptionParser(usage="usage: %prog [options]",
+                          description="Storage server for WsgiDAV locks and properties.")
+    parser.add_option("-p", "--port",
+                      dest="port", type="int", default=DEFAULT_PORT,
+                      help="port to serve on (default: %default)")
+    parser.add_option("-H", "--host",
+                      dest="host", default="localhost",
+                      help="host to serve from (default: %default)")
+    parser.add_option("-u", "--unix",
+                      dest="unix",
+                      help="serve on this Unix socket instead of TCP")
+    parser.add_option("", "--locks",
+                      dest="locks", default="dict",
+                      help="lock storage: dict, shelve:<path> or sqlite:<path> (default: %default)")
+    parser.add_option("", "--props",
+                      dest="props", default="dict",
+                      help="property manager: dict, shelve:<path> or sqlite:<path> (default: %default)")
+    parser.add_option("-v", "--verbose",
+                      action="store_const", const=2, dest="verbose", default=1,
+                      help="print informational output")
+    (options, args) = parser.parse_args()
+    if args:
+        parser.error("Too many arguments")
+
+    util.initLogging(options.verbose, [])
+    try:
+        lockStorage = _makeLockStorage(options.locks)
+        propManager = _makePropManager(options.props)
+    except ValueError, e:
+        parser.error(str(e))
+    if options.unix:
+        address = options.unix
+    else:
+        address = (options.host, options.port)
+    server = StorageServer(address, lockStorage, propManager)
+    print "Serving %r" % server
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print "Caught Ctrl-C, shutting down..."
+    finally:
+        if lockStorage is not None:
+            lockStorage.close()
+        if propManager is not None:
+            propManager._close()
+
+
+if __name__ == "__main__":
+    run()
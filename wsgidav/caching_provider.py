@@ -0,0 +1,587 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Implements `CachingProvider`, a DAV provider that caches the resource metadata
+of another provider across requests.
+
+Every request creates new resource instances, so a PROPFIND or HEAD request
+repeats the provider's lookups (os.stat(), database queries, ACL checks, ...)
+even if nothing changed since the last request.
+
+CachingProvider wraps an existing provider and remembers for every path
+
+- if it exists, and if it is a collection,
+- the standard live properties (length, type, dates, ETag, display name, ...),
+- the member names of collections.
+
+Resources returned by CachingProvider answer these queries from the cache.
+All other methods (getContent(), beginWrite(), delete(), ...) are delegated to
+a resource instance of the wrapped provider, which is created on demand.
+
+Entries expire after `ttl` seconds; the least recently used entries are
+discarded, if there are more than `maxEntries`.
+PUT, DELETE, COPY, MOVE, MKCOL, PROPPATCH and LOCK requests invalidate the
+modified paths (see DAVProvider.invalidateResourceCache()). Changes that don't
+pass through WsgiDAV become visible when the entries expire, unless
+`useInotify` is set: then file system based providers (FilesystemProvider,
+MyTardisProvider) are notified about changes by an
+wsgidav.addons.inotify_watcher.InotifyWatcher, and entries in watched
+directories don't expire.
+
+Usage: wrap the provider of a share in wsgidav.conf::
+
+    from wsgidav.fs_dav_provider import FilesystemProvider
+    from wsgidav.caching_provider import CachingProvider
+    addShare("dav", CachingProvider(FilesystemProvider("/data"), ttl=10))
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html
+"""
+from wsgidav import util
+from wsgidav.dav_error import DAVError, HTTP_NOT_FOUND
+from wsgidav.dav_provider import DAVProvider, DAVCollection, DAVNonCollection
+from collections import OrderedDict
+import os
+import threading
+import time
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+# Getters, that are answered from the cache
+_CACHED_GETTERS = ("getContentLength",
+                   "getContentType",
+                   "getCreationDate",
+                   "getDisplayName",
+                   "getDisplayInfo",
+                   "getEtag",
+                   "getLastModified",
+                   "getPreferredPath",
+                   "getRefUrl",
+                   "supportRanges",
+                   "supportContentLength",
+                   "supportEtag",
+                   "supportModified",
+                   )
+
+# Methods, that use the default implementation on top of the cached getters,
+# unless the wrapped resource class overrides them
+_OVERRIDABLE = ("getPropertyNames",
+                "getPropertyValue",
+                "getProperties",
+                "getHref",
+                "getDescendants",
+                "preventLocking",
+                )
+
+# Methods, that are always delegated to the wrapped resource
+_DELEGATED = ("getContent",
+              "getFilePath",
+              "beginWrite",
+              "endWrite",
+              "handleDelete",
+              "supportRecursiveDelete",
+              "delete",
+              "handleCopy",
+              "copyMoveSingle",
+              "handleMove",
+              "supportRecursiveMove",
+              "moveRecursive",
+              "createEmptyResource",
+              "createCollection",
+              "setPropertyValue",
+              "removeAllProperties",
+              "removeAllLocks",
+              "isLocked",
+              "resolve",
+              )
+
+# Marks getters that raised NotImplementedError
+_NOT_IMPLEMENTED = object()
+
+
+def _normPath(path):
+    """Return path without trailing '/' (root is '')."""
+    return path.rstrip("/")
+
+
+def _isInvalidated(trees, nodes, path, sep, generation):
+    """Return True, if normalized path or an ancestor was invalidated.
+
+    trees and nodes map paths to the generation of their last invalidation.
+    Entries of `trees` apply to all descendants.
+    """
+    if nodes.get(path, 0) > generation:
+        return True
+    if not trees:
+        return False
+    while True:
+        if trees.get(path, 0) > generation:
+            return True
+        i = path.rfind(sep)
+        if i < 0:
+            return False
+        path = path[:i]
+
+
+#===============================================================================
+# _CachedResourceMixin
+#===============================================================================
+class _CachedResourceMixin(object):
+    """Answers metadata queries from a cache entry (see CachingProvider).
+
+    Other methods and attributes are delegated to the wrapped resource.
+    """
+    def _initCached(self, key, entry, target):
+        self._key = key
+        self._entry = entry
+        self._target = target
+        self.name = entry["name"]
+
+
+    def _getTarget(self):
+        """Return the resource instance of the wrapped provider."""
+        if self._target is None:
+            self._target = self.provider._getWrappedResourceInst(self.path,
+                                                                 self.environ)
+            if self._target is None:
+                self.provider.invalidateResourceCache(self.environ, self.path)
+                raise DAVError(HTTP_NOT_FOUND)
+        return self._target
+
+
+    def _getCached(self, name):
+        value = self._entry["values"][name]
+        if value is _NOT_IMPLEMENTED:
+            raise NotImplementedError()
+        return value
+
+
+    def _callOverridable(self, name, *args, **kwargs):
+        if name in self._entry["overridden"]:
+            return getattr(self._getTarget(), name)(*args, **kwargs)
+        return getattr(self._baseClass, name)(self, *args, **kwargs)
+
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not defined by the proxy
+        # (e.g. '_filePath')
+        if name.startswith("__") or name in ("_key", "_entry", "_target"):
+            raise AttributeError(name)
+        return getattr(self._getTarget(), name)
+
+
+    def getMemberNames(self):
+        if self._entry["memberNames"] is None:
+            names = self._getTarget().getMemberNames()
+            self.provider._storeMemberNames(self.environ, self._key,
+                                            self._entry, names)
+            return names
+        return list(self._entry["memberNames"])
+
+
+def _makeCachedGetter(name):
+    def getter(self):
+        return self._getCached(name)
+    getter.__name__ = name
+    return getter
+
+
+def _makeOverridable(name):
+    def method(self, *args, **kwargs):
+        return self._callOverridable(name, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+def _makeDelegate(name):
+    def delegate(self, *args, **kwargs):
+        return getattr(self._getTarget(), name)(*args, **kwargs)
+    delegate.__name__ = name
+    return delegate
+
+
+for _name in _CACHED_GETTERS:
+    setattr(_CachedResourceMixin, _name, _makeCachedGetter(_name))
+for _name in _OVERRIDABLE:
+    setattr(_CachedResourceMixin, _name, _makeOverridable(_name))
+for _name in _DELEGATED:
+    setattr(_CachedResourceMixin, _name, _makeDelegate(_name))
+
+
+
+#===============================================================================
+# CachedNonCollection, CachedCollection
+#===============================================================================
+class CachedNonCollection(_CachedResourceMixin, DAVNonCollection):
+    """Non-collection resource that is returned by CachingProvider."""
+    _baseClass = DAVNonCollection
+
+    def __init__(self, path, environ, key, entry, target):
+        DAVNonCollection.__init__(self, path, environ)
+        self._initCached(key, entry, target)
+
+
+
+class CachedCollection(_CachedResourceMixin, DAVCollection):
+    """Collection resource that is returned by CachingProvider.
+
+    Members are resolved through CachingProvider.getResourceInst(), so they
+    are cached as well.
+    """
+    _baseClass = DAVCollection
+
+    def __init__(self, path, environ, key, entry, target):
+        DAVCollection.__init__(self, path, environ)
+        self._initCached(key, entry, target)
+
+
+    def getDirectoryInfo(self):
+        return self._getCached("getDirectoryInfo")
+
+
+    def getMember(self, name):
+        return self.provider.getResourceInst(util.joinUri(self.path, name),
+                                             self.environ)
+
+
+    def getMemberList(self):
+        # Always use the default implementation, because the wrapped
+        # collection's getMemberList() would bypass the cache
+        return DAVCollection.getMemberList(self)
+
+
+
+#===============================================================================
+# CachingProvider
+#===============================================================================
+class CachingProvider(DAVProvider):
+    """
+    Caches resource metadata of another DAVProvider across requests.
+
+    provider:
+        The wrapped DAVProvider instance.
+    ttl:
+        Seconds until a cache entry expires.
+    maxEntries:
+        Max. number of cached paths. The least recently used entries are
+        discarded first.
+    perUser:
+        Cache entries separately for every authenticated user. This is
+        required, if the wrapped provider returns different results for
+        different users (e.g. MyTardisProvider filters by ACL).
+    useInotify:
+        Watch the directories of cached resources for changes (Linux only;
+        the provider must implement _locToFilePath()). Falls back to ttl, if
+        inotify is not available.
+    watchedTtl:
+        Seconds until entries in watched directories expire (None: never).
+    """
+    def __init__(self, provider, ttl=10, maxEntries=10000, perUser=True,
+                 useInotify=False, watchedTtl=None):
+        assert isinstance(provider, DAVProvider)
+        super(CachingProvider, self).__init__()
+        self._provider = provider
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.perUser = perUser
+        # {key: entry} in LRU order
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # Incremented on every invalidation. Entries that were created before
+        # an invalidation of their path (or an ancestor) are stale.
+        self._generation = 0
+        self._clearGeneration = 0
+        self._invalidTrees = {}  # {normPath: generation}
+        self._invalidNodes = {}  # {normPath: generation}
+        self._invalidFileTrees = {}  # {filePath: generation}
+        self._invalidFileNodes = {}  # {filePath: generation}
+        self._hits = 0
+        self._misses = 0
+        self.watchedTtl = watchedTtl
+        self._watcher = None
+        if useInotify:
+            if not hasattr(provider, "_locToFilePath"):
+                raise ValueError("useInotify requires a file system based provider")
+            try:
+                from wsgidav.addons.inotify_watcher import InotifyWatcher
+                self._watcher = InotifyWatcher(self.invalidateFilePath)
+            except OSError, e:
+                util.warn("inotify is not available (%s): using ttl" % e)
+
+
+    def __repr__(self):
+        return "%s(%r, ttl=%s)" % (self.__class__.__name__, self._provider,
+                                   self.ttl)
+
+
+    def __getattr__(self, name):
+        # Resources of the wrapped provider reference this provider through
+        # environ["wsgidav.provider"], so we forward provider specific
+        # attributes (e.g. 'readonly', '_locToFilePath')
+        if name.startswith("__") or name == "_provider":
+            raise AttributeError(name)
+        return getattr(self._provider, name)
+
+
+    def setMountPath(self, mountPath):
+        super(CachingProvider, self).setMountPath(mountPath)
+        self._provider.setMountPath(mountPath)
+
+
+    def setSharePath(self, sharePath):
+        super(CachingProvider, self).setSharePath(sharePath)
+        self._provider.setSharePath(sharePath)
+
+
+    def setLockManager(self, lockManager):
+        super(CachingProvider, self).setLockManager(lockManager)
+        self._provider.setLockManager(lockManager)
+
+
+    def setPropManager(self, propManager):
+        super(CachingProvider, self).setPropManager(propManager)
+        self._provider.setPropManager(propManager)
+
+
+    def close(self):
+        """Stop the file system watcher (if any)."""
+        if self._watcher:
+            self._watcher.stop()
+            self._watcher = None
+
+
+    def getStats(self):
+        """Return a dictionary with 'hits', 'misses' and number of 'entries'."""
+        self._lock.acquire()
+        try:
+            return {"hits": self._hits,
+                    "misses": self._misses,
+                    "entries": len(self._cache),
+                    }
+        finally:
+            self._lock.release()
+
+
+    def _getKey(self, path, environ):
+        if self.perUser:
+            return (environ.get("http_authenticator.username"), path)
+        return path
+
+
+    def _isStale(self, entry):
+        """Return True, if entry was invalidated after it was created."""
+        generation = entry["generation"]
+        if _isInvalidated(self._invalidTrees, self._invalidNodes,
+                          _normPath(entry["path"]), "/", generation):
+            return True
+        filePath = entry["filePath"]
+        if filePath is None or not (self._invalidFileTrees
+                                    or self._invalidFileNodes):
+            return False
+        return _isInvalidated(self._invalidFileTrees, self._invalidFileNodes,
+                              filePath, os.sep, generation)
+
+
+    def _getWrappedResourceInst(self, path, environ):
+        return self._provider.getResourceInst(path, environ)
+
+
+    def _makeEntry(self, path, res, generation, now, filePath, watched):
+        """Return a cache entry with the metadata of res (may be None)."""
+        if not watched:
+            expire = now + self.ttl
+        elif self.watchedTtl is None:
+            expire = float("inf")
+        else:
+            expire = now + self.watchedTtl
+        entry = {"path": path,
+                 "generation": generation,
+                 "expire": expire,
+                 "exists": res is not None,
+                 "filePath": filePath,
+                 }
+        if res is None:
+            return entry
+        values = {}
+        for name in _CACHED_GETTERS:
+            try:
+                values[name] = getattr(res, name)()
+            except NotImplementedError:
+                values[name] = _NOT_IMPLEMENTED
+        if res.isCollection:
+            values["getDirectoryInfo"] = res.getDirectoryInfo()
+            base = DAVCollection
+        else:
+            base = DAVNonCollection
+        resClass = type(res)
+        overridden = set([ name for name in _OVERRIDABLE
+                           if getattr(resClass, name).im_func
+                           is not getattr(base, name).im_func ])
+        entry.update({"name": res.name,
+                      "isCollection": res.isCollection,
+                      "values": values,
+                      "overridden": overridden,
+                      "memberNames": None,
+                      })
+        return entry
+
+
+    def _makeResource(self, path, environ, key, entry, target):
+        if entry["isCollection"]:
+            return CachedCollection(path, environ, key, entry, target)
+        return CachedNonCollection(path, environ, key, entry, target)
+
+
+    def getResourceInst(self, path, environ):
+        """Return a cached resource instance for path.
+
+        See DAVProvider.getResourceInst()
+        """
+        if environ.get("caching_provider.modified"):
+            # This request modified resources: bypass the cache, so we don't
+            # store intermediate states
+            return self._getWrappedResourceInst(path, environ)
+
+        key = self._getKey(path, environ)
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._cache.pop(key, None)
+            if entry is not None and (entry["expire"] < now or
+                                      self._isStale(entry)):
+                entry = None
+            if entry is None:
+                self._misses += 1
+            else:
+                # Re-insert as most recently used
+                self._cache[key] = entry
+                self._hits += 1
+            generation = self._generation
+        finally:
+            self._lock.release()
+
+        if entry is not None:
+            if not entry["exists"]:
+                return None
+            return self._makeResource(path, environ, key, entry, None)
+
+        filePath = watched = None
+        if self._watcher:
+            filePath = self._provider._locToFilePath(path).rstrip(os.sep)
+            # Watch the parent folder before we query the resource, so we
+            # don't miss changes
+            watched = self._watcher.watch(os.path.dirname(filePath))
+        res = self._getWrappedResourceInst(path, environ)
+        if watched and res is not None and res.isCollection:
+            # Member names are only read later, so we can start watching now
+            watched = self._watcher.watch(filePath)
+        entry = self._makeEntry(path, res, generation, now, filePath, watched)
+        self._lock.acquire()
+        try:
+            if generation >= self._clearGeneration:
+                self._cache[key] = entry
+                while len(self._cache) > self.maxEntries:
+                    self._cache.popitem(last=False)
+        finally:
+            self._lock.release()
+        if res is None:
+            return None
+        return self._makeResource(path, environ, key, entry, res)
+
+
+    def _storeMemberNames(self, environ, key, entry, names):
+        """Add the member names of a collection to its cache entry."""
+        if environ.get("caching_provider.modified"):
+            return
+        self._lock.acquire()
+        try:
+            if self._cache.get(key) is entry:
+                entry["memberNames"] = list(names)
+        finally:
+            self._lock.release()
+
+
+    def _recordInvalidation(self, trees, nodes, path, parent):
+        """Mark path (and descendants) and parent as invalid (lock must be held)."""
+        trees[path] = self._generation
+        if parent is not None:
+            nodes[parent] = self._generation
+        allDicts = (self._invalidTrees, self._invalidNodes,
+                    self._invalidFileTrees, self._invalidFileNodes)
+        if sum([ len(d) for d in allDicts ]) > 1000:
+            # Discard all stale entries, so we can forget the invalidations.
+            # Lookups that are in progress must not store their results.
+            for key, entry in self._cache.items():
+                if self._isStale(entry):
+                    del self._cache[key]
+            self._clearGeneration = self._generation
+            for d in allDicts:
+                d.clear()
+
+
+    def _clear(self):
+        """Discard all entries (lock must be held)."""
+        self._clearGeneration = self._generation
+        self._cache.clear()
+        self._invalidTrees.clear()
+        self._invalidNodes.clear()
+        self._invalidFileTrees.clear()
+        self._invalidFileNodes.clear()
+
+
+    def invalidateResourceCache(self, environ, path=None):
+        """Discard cached entries for path, its descendants and its parent.
+
+        Also disables the cache for the rest of the current request.
+        See DAVProvider.invalidateResourceCache().
+        """
+        super(CachingProvider, self).invalidateResourceCache(environ, path)
+        # The wrapped provider may cache as well (e.g. stat results)
+        self._provider.invalidateResourceCache(environ, path)
+        environ["caching_provider.modified"] = True
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            if path is None:
+                self._clear()
+                return
+            parent = util.getUriParent(path)
+            if parent is not None:
+                parent = _normPath(parent)
+            self._recordInvalidation(self._invalidTrees, self._invalidNodes,
+                                     _normPath(path), parent)
+        finally:
+            self._lock.release()
+
+
+    def invalidateFilePath(self, filePath):
+        """Discard cached entries for a file system path, its descendants and
+        its parent folder.
+
+        This is called by the file system watcher. If filePath is None, all
+        entries are discarded.
+        """
+        statCache = getattr(self._provider, "statCache", None)
+        if statCache is not None:
+            statCache.invalidate(filePath)
+        contentCache = getattr(self._provider, "contentCache", None)
+        if contentCache is not None:
+            contentCache.invalidate(filePath)
+        fileHandleCache = getattr(self._provider, "fileHandleCache", None)
+        if fileHandleCache is not None:
+            fileHandleCache.invalidate(filePath)
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            if filePath is None:
+                self._clear()
+                return
+            filePath = filePath.rstrip(os.sep)
+            self._recordInvalidation(self._invalidFileTrees,
+                                     self._invalidFileNodes,
+                                     filePath, os.path.dirname(filePath))
+        finally:
+            self._lock.release()
@@ -0,0 +1,353 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Implements `ChunkedInput`, a file-like object that decodes a request body
+with chunked transfer coding (RFC 7230, 4.1).
+
+Some clients (e.g. sync tools) send PUT bodies in small chunks of a few kB.
+Reading every chunk header with readline() and every chunk with read() costs
+two calls into the input stream per chunk. ChunkedInput reads the input into
+a buffer and parses chunk headers, data and CRLFs from there, so a block of
+many small chunks costs a single read call. read(size) returns the data of as
+many chunks as needed for `size` bytes, so the caller writes large blocks.
+Large chunks are read from the input stream directly (if nothing is
+buffered).
+
+The buffer must never wait for input after the end of the body (the client
+waits for the response), and must not keep the start of a pipelined request:
+
+- If the input stream has ``read1(size)`` (return up to size bytes with at
+  most one system call) and ``unread(data)`` (return data to the stream),
+  blocks of up to FILL_SIZE bytes are read. Whatever follows the last chunk
+  is passed back with unread(). The bundled CherryPy server provides these.
+- Otherwise only as many bytes are read as the body must still contain (e.g.
+  a chunk, its CRLF and the shortest last chunk "0\\r\\n\\r\\n"), and header
+  lines are completed with readline(). This still saves one call per chunk.
+
+The syntax is checked strictly: chunk sizes must consist of 1-16 hex digits,
+chunk data must be followed by CRLF, and header and trailer lines are limited
+to `maxLineLength` bytes. Violations raise DAVError(HTTP_BAD_REQUEST), bodies
+larger than `maxSize` raise DAVError(HTTP_REQUEST_ENTITY_TOO_LARGE).
+Chunk extensions are parsed (see `extensions`) and trailer fields are
+collected (see `trailers`).
+
+Usage::
+
+    body = ChunkedInput(environ["wsgi.input"])
+    while True:
+        data = body.read(1024 * 1024)
+        if not data:
+            break
+        fileobj.write(data)
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html
+"""
+from wsgidav.dav_error import DAVError, HTTP_BAD_REQUEST, \
+    HTTP_REQUEST_ENTITY_TOO_LARGE
+import re
+
+__docformat__ = "reStructuredText"
+
+# Block size used for iteration
+DEFAULT_BLOCK_SIZE = 256 * 1024
+# Max. length of chunk header and trailer lines
+DEFAULT_MAX_LINE_LENGTH = 8192
+# Size of the partial reads that fill the buffer (see read1())
+FILL_SIZE = 64 * 1024
+# Length of the shortest rest of a body after chunk data ("\r\n0\r\n\r\n")
+_MIN_TAIL = 7
+# Chunks up to this size are parsed from the buffer by the inner loop
+_MAX_MERGED_READ = 32 * 1024
+
+# Chunk size (1-16 hex digits) and extensions of a chunk header line
+_chunkHeaderRE = re.compile(r"^([0-9a-fA-F]{1,16})[ \t]*(;.*)?\r\n\Z")
+# CRLF after chunk data, followed by a chunk header without extensions
+_nextChunkRE = re.compile(r"\r\n([0-9a-fA-F]{1,16})\r\n")
+_tokenRE = re.compile(r"^[!#$%&'*+.^_`|~0-9A-Za-z-]+$")
+
+
+def _parseExtensions(text):
+    """Return [(name, value), ...] for a chunk extension string (';a=b;c')."""
+    extensions = []
+    for ext in text.split(";")[1:]:
+        name, sep, value = ext.partition("=")
+        name = name.strip()
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = value[1:-1]
+        elif sep and not _tokenRE.match(value):
+            raise DAVError(HTTP_BAD_REQUEST, "Invalid chunk extension: %r" % ext)
+        if not _tokenRE.match(name):
+            raise DAVError(HTTP_BAD_REQUEST, "Invalid chunk extension: %r" % ext)
+        extensions.append((name, sep and value or None))
+    return extensions
+
+
+
+#===============================================================================
+# ChunkedInput
+#===============================================================================
+class ChunkedInput(object):
+    """
+    Read-only file-like object for the decoded body of a chunked request.
+
+    rfile:
+        Input stream, positioned at the first chunk header (e.g. wsgi.input).
+    blockSize:
+        Size of the blocks returned by iteration.
+    maxLineLength:
+        Max. length of chunk header and trailer lines.
+    maxSize:
+        Max. size of the decoded body (0: unlimited).
+    """
+    def __init__(self, rfile, blockSize=DEFAULT_BLOCK_SIZE,
+                 maxLineLength=DEFAULT_MAX_LINE_LENGTH, maxSize=0):
+        self.rfile = rfile
+        self.blockSize = blockSize
+        self.maxLineLength = maxLineLength
+        self.maxSize = maxSize
+        # Partial reads are only used, if we can pass back what follows the body
+        self._read1 = None
+        if getattr(rfile, "unread", None) is not None:
+            self._read1 = getattr(rfile, "read1", None)
+        # Input that was read, but not parsed yet: self._buf[self._pos:]
+        self._buf = ""
+        self._pos = 0
+        # Bytes left in the current chunk (None: expect a chunk header)
+        self._chunkLeft = None
+        # Sum of the chunk sizes so far
+        self._bodySize = 0
+        self.eof = False
+        # Number of decoded bytes, that were returned by read()
+        self.bytesRead = 0
+        # [(name, value), ...] of the current chunk (value is None for 'name')
+        self.extensions = []
+        # [(name, value), ...] of the trailer fields (available at EOF)
+        self.trailers = []
+
+
+    def __repr__(self):
+        return "ChunkedInput(%s bytes read, eof=%s)" % (self.bytesRead, self.eof)
+
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.blockSize)
+            if not data:
+                break
+            yield data
+
+
+    def _fill(self, known=None):
+        """Append input to the buffer.
+
+        `known` is the number of bytes, that a valid body must still contain
+        (counted from the current buffer position). None means, that the
+        buffer ends with an incomplete header or trailer line.
+        """
+        buf = self._buf[self._pos:]
+        if self._read1 is not None:
+            data = self._read1(FILL_SIZE)
+        elif known is None:
+            data = self.rfile.readline(self.maxLineLength + 1 - len(buf))
+        else:
+            data = self.rfile.read(min(max(known - len(buf), 1), FILL_SIZE))
+        if not data:
+            raise DAVError(HTTP_BAD_REQUEST, "Unexpected end of chunked body.")
+        self._buf = buf + data
+        self._pos = 0
+
+
+    def _checkLine(self, line):
+        """Raise DAVError, if line is not a complete CRLF terminated line."""
+        if not line:
+            raise DAVError(HTTP_BAD_REQUEST, "Unexpected end of chunked body.")
+        elif line[-2:] != "\r\n":
+            if len(line) > self.maxLineLength:
+                raise DAVError(HTTP_BAD_REQUEST, "Chunk header line too long.")
+            raise DAVError(HTTP_BAD_REQUEST, "Invalid chunk header line: %r"
+                           % line[:100])
+
+
+    def _readLine(self):
+        """Return the next line from the buffer (including the LF).
+
+        Lines are limited to maxLineLength bytes (plus LF); the caller checks
+        the CRLF.
+        """
+        maxLen = self.maxLineLength + 1
+        while True:
+            end = self._buf.find("\n", self._pos, self._pos + maxLen)
+            if end >= 0:
+                line = self._buf[self._pos:end + 1]
+                self._pos = end + 1
+                return line
+            elif len(self._buf) - self._pos >= maxLen:
+                line = self._buf[self._pos:self._pos + maxLen]
+                self._pos += maxLen
+                return line
+            self._fill()
+
+
+    def _readChunkHeader(self, line):
+        """Parse a chunk header line."""
+        match = _chunkHeaderRE.match(line)
+        if not match:
+            # Raise the appropriate error
+            self._checkLine(line)
+            raise DAVError(HTTP_BAD_REQUEST, "Invalid chunk header: %r" % line[:100])
+        size = int(match.group(1), 16)
+        if match.group(2):
+            self.extensions = _parseExtensions(match.group(2))
+        elif self.extensions:
+            self.extensions = []
+        self._bodySize += size
+        if self.maxSize and self._bodySize > self.maxSize:
+            raise DAVError(HTTP_REQUEST_ENTITY_TOO_LARGE,
+                           "Chunked body exceeds %s bytes." % self.maxSize)
+        self._chunkLeft = size
+        if size == 0:
+            self._readTrailers()
+
+
+    def _readTrailers(self):
+        """Parse the trailer section and pass back unused input."""
+        while True:
+            line = self._readLine()
+            self._checkLine(line)
+            line = line[:-2]
+            if not line:
+                break
+            name, sep, value = line.partition(":")
+            if not sep or not _tokenRE.match(name):
+                raise DAVError(HTTP_BAD_REQUEST, "Invalid trailer field: %r"
+                               % line[:100])
+            self.trailers.append((name, value.strip()))
+        self.eof = True
+        rest = self._buf[self._pos:]
+        self._buf = ""
+        self._pos = 0
+        if rest:
+            # Only read1() reads past the body (the next pipelined request)
+            self.rfile.unread(rest)
+
+
+    def _readCRLF(self):
+        """Consume the CRLF after the data of the current chunk."""
+        while len(self._buf) - self._pos < 2:
+            self._fill(_MIN_TAIL)
+        if self._buf[self._pos:self._pos + 2] != "\r\n":
+            raise DAVError(HTTP_BAD_REQUEST, "Chunk data not followed by CRLF.")
+        self._pos += 2
+        self._chunkLeft = None
+
+
+    def _readBufferedChunks(self, parts, remaining):
+        """Append whole chunks of up to _MAX_MERGED_READ bytes to parts, while
+        they fit into remaining bytes (< 0: unlimited); return the new value
+        of remaining.
+
+        This is the inner loop for bodies with many small chunks: data, CRLF
+        and headers without extensions are parsed from the buffer, which is
+        refilled inline (other headers are left to read()).
+        """
+        buf = self._buf
+        pos = self._pos
+        n = self._chunkLeft
+        matchNext = _nextChunkRE.match
+        read1 = self._read1
+        read = self.rfile.read
+        bodySize = self._bodySize
+        maxSize = self.maxSize
+        while n <= _MAX_MERGED_READ and (remaining < 0 or n <= remaining):
+            end = pos + n
+            if len(buf) < end + 2:
+                buf = buf[pos:]
+                end = n
+                pos = 0
+                while len(buf) < end + 2:
+                    if read1 is not None:
+                        data = read1(FILL_SIZE)
+                    else:
+                        data = read(end + _MIN_TAIL - len(buf))
+                    if not data:
+                        raise DAVError(HTTP_BAD_REQUEST, 
+                                       "Unexpected end of chunked body.")
+                    buf += data
+            match = matchNext(buf, end)
+            if match is None:
+                # A header with extensions, or an incomplete header follows
+                if buf[end:end + 2] != "\r\n":
+                    raise DAVError(HTTP_BAD_REQUEST,
+                                   "Chunk data not followed by CRLF.")
+                parts.append(buf[pos:end])
+                if remaining > 0:
+                    remaining -= n
+                pos = end + 2
+                n = None
+                break
+            parts.append(buf[pos:end])
+            if remaining > 0:
+                remaining -= n
+            pos = match.end()
+            n = int(match.group(1), 16)
+            bodySize += n
+            if maxSize and bodySize > maxSize:
+                raise DAVError(HTTP_REQUEST_ENTITY_TOO_LARGE,
+                               "Chunked body exceeds %s bytes." % maxSize)
+            if self.extensions:
+                self.extensions = []
+            if n == 0:
+                break
+        self._buf = buf
+        self._pos = pos
+        self._bodySize = bodySize
+        self._chunkLeft = n
+        if n == 0:
+            self._readTrailers()
+        return remaining
+
+
+    def read(self, size=-1):
+        """Return up to size bytes (all, if size < 0) of the decoded body.
+
+        Returns less than size bytes only at the end of the body ("" at EOF).
+        """
+        parts = []
+        remaining = size
+        while not self.eof and remaining != 0:
+            n = self._chunkLeft
+            if n is None:
+                self._readChunkHeader(self._readLine())
+                continue
+            if n <= _MAX_MERGED_READ and (remaining < 0 or n <= remaining):
+                remaining = self._readBufferedChunks(parts, remaining)
+                continue
+            avail = len(self._buf) - self._pos
+            if 0 < remaining < n:
+                n = remaining
+            if avail:
+                # Part of the chunk is buffered
+                n = min(n, avail)
+                parts.append(self._buf[self._pos:self._pos + n])
+                self._pos += n
+            elif n > _MAX_MERGED_READ:
+                # Large chunks are read directly (not copied through the buffer)
+                data = self.rfile.read(n)
+                if not data:
+                    raise DAVError(HTTP_BAD_REQUEST, "Unexpected end of chunked body.")
+                parts.append(data)
+                n = len(data)
+            else:
+                self._fill(self._chunkLeft + _MIN_TAIL)
+                continue
+            if remaining > 0:
+                remaining -= n
+            self._chunkLeft -= n
+            if self._chunkLeft == 0:
+                self._readCRLF()
+        data = "".join(parts)
+        self.bytesRead += len(data)
+        return data
@@ -0,0 +1,262 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+gzip Content-Encoding of responses, and decoding of PUT request bodies.
+
+PROPFIND multistatus XML and directory listings are very repetitive, and
+Depth-1 listings of large folders run to megabytes. They are compressed
+(util.sendMultiStatusResponse(), WsgiDavDirBrowser), if the client sends
+``Accept-Encoding: gzip``. RequestServer compresses GET responses of text/*
+resources as well, if `text_get` is enabled. These are streamed through
+gzipIter(), which compresses block by block, so large files are never held in
+memory.
+
+PUT request bodies with ``Content-Encoding: gzip`` or ``deflate`` are
+decompressed by decodeIter() while they are copied (with Content-Length or
+chunked transfer coding). The output of every decompression step is limited,
+so a small body that expands to gigabytes never has to be held in memory.
+Bodies that expand beyond `max_decoded_size` bytes, or by more than
+`max_ratio`, are rejected with 413 Request Entity Too Large (decompression
+bombs).
+
+Options (`compression` in wsgidav.conf). Every option that is omitted keeps
+its default (see DEFAULT_OPTIONS):
+
+enable
+    Compress multistatus and directory listing responses. Off by default, so
+    existing deployments (and clients that mishandle gzip) see no change.
+text_get
+    Also compress GET responses of text/* resources (these have no
+    Content-Length, and are not sent with sendfile()).
+min_size
+    Responses smaller than this are sent as they are.
+level
+    zlib compression level (CPU budget): 1 is fastest, 9 gives the smallest
+    responses.
+decode_put
+    Accept gzip and deflate encoded PUT request bodies (otherwise they are
+    rejected with 415 Unsupported Media Type).
+max_decoded_size
+    Max. size of a decoded PUT request body (0: unlimited).
+max_ratio
+    Max. ratio of decoded to encoded size of a PUT request body (0:
+    unlimited). It is checked after the first MB.
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html
+"""
+from wsgidav.dav_error import DAVError, HTTP_BAD_REQUEST, \
+    HTTP_MEDIATYPE_NOT_SUPPORTED, HTTP_REQUEST_ENTITY_TOO_LARGE
+import zlib
+
+__docformat__ = "reStructuredText"
+
+DEFAULT_OPTIONS = {
+    "enable": False,
+    "text_get": False,
+    "min_size": 1024,
+    "level": 1,
+    "decode_put": True,
+    "max_decoded_size": 4 * 1024 * 1024 * 1024,
+    "max_ratio": 200,
+}
+# The ratio of a request body is checked after this many decoded bytes
+RATIO_CHECK_SIZE = 1024 * 1024
+# Content codings of request bodies, that are decoded
+REQUEST_ENCODINGS = ("gzip", "x-gzip", "deflate")
+# wbits for zlib.compressobj(), that make it write a gzip header and trailer
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def _getOption(environ, name):
+    """Return a `compression` option, or its default, if it is not configured."""
+    opts = environ.get("wsgidav.config", {}).get("compression") or {}
+    return opts.get(name, DEFAULT_OPTIONS[name])
+
+
+def acceptsGzip(environ):
+    """Return True, if the Accept-Encoding header of the request allows gzip."""
+    accept = environ.get("HTTP_ACCEPT_ENCODING")
+    if not accept:
+        return False
+    qGzip = qAny = None
+    for item in accept.split(","):
+        params = item.split(";")
+        coding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if coding in ("gzip", "x-gzip"):
+            qGzip = q
+        elif coding == "*":
+            qAny = q
+    if qGzip is None:
+        qGzip = qAny
+    return bool(qGzip)
+
+
+def getContentEncoding(environ, size=None, isTextGet=False):
+    """Return "gzip", if a response of size bytes should be compressed (else None).
+
+    size:
+        Length of the uncompressed response (None: unknown).
+    isTextGet:
+        The response is the content of a text/* resource (only compressed, if
+        the `text_get` option is set).
+    """
+    if not _getOption(environ, "enable"):
+        return None
+    elif isTextGet and not _getOption(environ, "text_get"):
+        return None
+    elif size is not None and size < _getOption(environ, "min_size"):
+        return None
+    elif not acceptsGzip(environ):
+        return None
+    return "gzip"
+
+
+def _getCompressor(environ):
+    level = _getOption(environ, "level")
+    return zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+
+
+def gzipString(environ, data):
+    """Return data compressed as a gzip stream."""
+    compressor = _getCompressor(environ)
+    return compressor.compress(data) + compressor.flush()
+
+
+def gzipIter(environ, appIter):
+    """Yield the blocks of appIter compressed as a gzip stream.
+
+    appIter is closed, when the iteration is done.
+    """
+    compressor = _getCompressor(environ)
+    try:
+        for data in appIter:
+            data = compressor.compress(data)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(appIter, "close"):
+            appIter.close()
+
+
+def getEncodedEtag(entitytag, encoding):
+    """Return the entity tag of the encoded representation (RFC 7232, 2.3.3)."""
+    return "%s-%s" % (entitytag, encoding)
+
+
+def getIdentityEtag(entitytag):
+    """Return entitytag without the suffix added by getEncodedEtag().
+
+    Used to evaluate If-Match and If-None-Match, since clients send back the
+    entity tag of the representation they received.
+    """
+    if entitytag.endswith("-gzip"):
+        return entitytag[:-len("-gzip")]
+    return entitytag
+
+
+
+def getRequestEncoding(environ):
+    """Return the content coding of the request body (None: not encoded).
+
+    Raises DAVError(HTTP_MEDIATYPE_NOT_SUPPORTED), if the coding is not
+    supported or decoding is disabled (RFC 7231, 3.1.2.2).
+    """
+    encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+    if encoding in ("", "identity"):
+        return None
+    if encoding not in REQUEST_ENCODINGS or not _getOption(environ, "decode_put"):
+        raise DAVError(HTTP_MEDIATYPE_NOT_SUPPORTED,
+                       "Content-Encoding %r is not supported." % encoding)
+    return encoding
+
+
+def _getWbits(encoding, data):
+    """Return wbits for zlib.decompressobj(), given the first bytes of a body."""
+    if encoding != "deflate":
+        return _GZIP_WBITS
+    # 'deflate' should be a zlib stream (RFC 7230, 4.2.2), but some clients
+    # send raw deflate data
+    if len(data) >= 2 and ord(data[0]) & 0x0f == 8 \
+            and (ord(data[0]) * 256 + ord(data[1])) % 31 == 0:
+        return zlib.MAX_WBITS
+    return -zlib.MAX_WBITS
+
+
+def decodeIter(environ, blocks, encoding, maxBlockSize=1024*1024):
+    """Yield the decoded data of a request body.
+
+    blocks:
+        Iterable over the encoded body.
+    encoding:
+        Content coding (see getRequestEncoding()).
+    maxBlockSize:
+        Max. size of the yielded blocks.
+
+    Raises DAVError(HTTP_BAD_REQUEST) for invalid or incomplete data, and
+    DAVError(HTTP_REQUEST_ENTITY_TOO_LARGE), if the decoded body exceeds
+    `max_decoded_size` or `max_ratio`.
+    """
+    maxSize = _getOption(environ, "max_decoded_size")
+    maxRatio = _getOption(environ, "max_ratio")
+    decompressor = None
+    sizes = [0, 0]  # encoded, decoded
+
+    def _checkSize(out):
+        sizes[1] += len(out)
+        if maxSize and sizes[1] > maxSize:
+            raise DAVError(HTTP_REQUEST_ENTITY_TOO_LARGE,
+                           "Decoded request body exceeds %s bytes." % maxSize)
+        elif (maxRatio and sizes[1] > RATIO_CHECK_SIZE 
+              and sizes[1] > maxRatio * sizes[0]):
+            raise DAVError(HTTP_REQUEST_ENTITY_TOO_LARGE,
+                           "Request body expands by more than %s:1." % maxRatio)
+        return out
+
+    for data in blocks:
+        if not data:
+            continue
+        sizes[0] += len(data)
+        if decompressor is None:
+            decompressor = zlib.decompressobj(_getWbits(encoding, data))
+        while True:
+            try:
+                # Input, that would exceed maxBlockSize, is kept in
+                # unconsumed_tail
+                out = decompressor.decompress(data, maxBlockSize)
+            except zlib.error, e:
+                raise DAVError(HTTP_BAD_REQUEST, 
+                               "Invalid %s request body: %s" % (encoding, e))
+            data = decompressor.unconsumed_tail
+            if out:
+                yield _checkSize(out)
+            if not data and len(out) < maxBlockSize:
+                break
+    if decompressor is None or not _isComplete(decompressor):
+        raise DAVError(HTTP_BAD_REQUEST, 
+                       "Incomplete %s request body." % encoding)
+    out = decompressor.flush()
+    if out:
+        yield _checkSize(out)
+
+
+def _isComplete(decompressor):
+    """Return True, if decompressor has seen the end of the stream."""
+    # Input after the end of the stream is stored in unused_data (Python 2 has
+    # no decompressor.eof)
+    probe = decompressor.copy()
+    try:
+        probe.decompress("\0")
+    except zlib.error:
+        return False
+    return probe.unused_data.endswith("\0")
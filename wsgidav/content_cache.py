@@ -0,0 +1,152 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Implements `ContentCache`, which keeps the content of small files in memory.
+
+Many GET requests are repeated for the same small files (thumbnails,
+metadata XML, README files in datasets). Without a cache, every request opens
+the file and reads it in 8 kB blocks.
+
+FilesystemProvider and MyTardisProvider create a ContentCache, if
+`contentCacheSize` (max. number of bytes) is set. FileResource.getContent()
+then returns a cStringIO object for files up to `contentCacheMaxFileSize`
+bytes, so range requests are served from memory as well.
+
+Entries are keyed by file path and validated by the ETag (and modification
+time) of the current stat result, which is taken from the provider's
+StatCache. So a file that was changed by another process is read again, as
+soon as the stat cache sees the change (see `statCacheTtl`).
+The least recently used entries are discarded, if the cache holds more than
+`maxBytes`.
+
+Usage::
+
+    addShare("", MyTardisProvider("/var/lib/mytardis/store/", readonly=True,
+                                  contentCacheSize=64*1024*1024))
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html
+"""
+from collections import OrderedDict
+from wsgidav import util
+import os
+import stat
+import threading
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO #@UnusedImport
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+
+
+#===============================================================================
+# ContentCache
+#===============================================================================
+class ContentCache(object):
+    """
+    Byte-capped LRU cache of file contents.
+
+    maxBytes:
+        Max. number of content bytes held by the cache.
+    maxFileSize:
+        Only files up to this size are cached.
+    """
+    def __init__(self, maxBytes=32*1024*1024, maxFileSize=64*1024):
+        self.maxBytes = maxBytes
+        self.maxFileSize = min(maxFileSize, maxBytes)
+        # {filePath: (validator, data)} in LRU order
+        self._cache = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._count_hits = 0
+        self._count_misses = 0
+
+
+    def __repr__(self):
+        return "ContentCache(%s entries, %s bytes)" % (len(self._cache),
+                                                       self._bytes)
+
+
+    def getStats(self):
+        """Return dictionary with cache statistics."""
+        return {"entries": len(self._cache),
+                "bytes": self._bytes,
+                "hits": self._count_hits,
+                "misses": self._count_misses,
+                }
+
+
+    def _getValidator(self, filePath, filestat):
+        return (util.getETag(filePath, filestat), filestat.st_mtime)
+
+
+    def getContent(self, filePath, filestat):
+        """Return a file-like object with the content of filePath.
+
+        filestat is the current stat result of filePath. Returns None, if the
+        file is too big to be cached (the caller should open the file then).
+        """
+        size = filestat[stat.ST_SIZE]
+        if size > self.maxFileSize or not stat.S_ISREG(filestat.st_mode):
+            return None
+        validator = self._getValidator(filePath, filestat)
+        self._lock.acquire()
+        try:
+            entry = self._cache.pop(filePath, None)
+            if entry is not None:
+                if entry[0] == validator:
+                    self._cache[filePath] = entry
+                    self._count_hits += 1
+                    return StringIO(entry[1])
+                self._bytes -= len(entry[1])
+            self._count_misses += 1
+        finally:
+            self._lock.release()
+
+        f = open(filePath, "rb")
+        try:
+            data = f.read(size + 1)
+            st = os.fstat(f.fileno())
+        finally:
+            f.close()
+        # Only cache the data, if the file was not changed since filestat
+        if len(data) == size and self._getValidator(filePath, st) == validator:
+            self._store(filePath, validator, data)
+        return StringIO(data)
+
+
+    def _store(self, filePath, validator, data):
+        self._lock.acquire()
+        try:
+            old = self._cache.pop(filePath, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._cache[filePath] = (validator, data)
+            self._bytes += len(data)
+            while self._bytes > self.maxBytes:
+                _path, (_validator, oldData) = self._cache.popitem(last=False)
+                self._bytes -= len(oldData)
+        finally:
+            self._lock.release()
+
+
+    def invalidate(self, filePath=None):
+        """Discard the entry for filePath and its descendants (None: all)."""
+        self._lock.acquire()
+        try:
+            if filePath is None:
+                self._cache.clear()
+                self._bytes = 0
+                return
+            prefix = filePath.rstrip(os.sep) + os.sep
+            for path in self._cache.keys():
+                if path == filePath or path.startswith(prefix):
+                    self._bytes -= len(self._cache.pop(path)[1])
+        finally:
+            self._lock.release()
@@ -90,6 +90,7 @@ ERROR_DESCRIPTIONS = {
     HTTP_NOT_FOUND: "404 Not Found",
     HTTP_CONFLICT: "409 Conflict",
     HTTP_PRECONDITION_FAILED: "412 Precondition Failed",
+    HTTP_REQUEST_ENTITY_TOO_LARGE: "413 Request Entity Too Large",
     HTTP_RANGE_NOT_SATISFIABLE: "416 Range Not Satisfiable",
     HTTP_MEDIATYPE_NOT_SUPPORTED: "415 Media Type Not Supported",
     HTTP_LOCKED: "423 Locked",
@@ -162,6 +162,10 @@ class _DAVResource(object):
     See also DAVProvider.getResourceInst().
     """
 
+    # Resource instances are created for every member of a listing, so they
+    # don't carry a __dict__ (subclasses should define __slots__ as well)
+    __slots__ = ("provider", "path", "isCollection", "environ", "name")
+
     def __init__(self, path, isCollection, environ):
         assert path=="" or path.startswith("/")
         self.provider = environ["wsgidav.provider"]
@@ -735,9 +739,21 @@ class _DAVResource(object):
 
 
     def removeAllProperties(self, recursive):
-        """Remove all associated dead properties."""
-        if self.provider.propManager:
-            self.provider.propManager.removeProperties(self.getRefUrl())
+        """Remove all associated dead properties.
+        
+        If recursive is True, the properties of collection members are removed 
+        as well, with one call if the property manager supports 
+        SUBTREE_OPERATIONS.
+        Nothing is done, if environ["wsgidav.subtree_properties"] is set (the 
+        caller removes the properties of the whole tree).
+        """
+        propMan = self.provider.propManager
+        if not propMan or self.environ.get("wsgidav.subtree_properties"):
+            return
+        if recursive and self.isCollection and getattr(propMan, "SUBTREE_OPERATIONS", False):
+            propMan.removeProperties(self.getRefUrl(), withChildren=True)
+        else:
+            propMan.removeProperties(self.getRefUrl())
 
 
 
@@ -967,7 +983,9 @@ class _DAVResource(object):
             E.g. displayname should be copied, but creationdate should be
             reset if the target did not exist before.
             See http://www.webdav.org/specs/rfc4918.html#dav.properties
-          - SHOULD copy dead properties.
+          - SHOULD copy dead properties, unless 
+            environ["wsgidav.subtree_properties"] is set (then the caller 
+            copies the dead properties of the whole tree with one call).
           - raises HTTP_FORBIDDEN for read-only providers
           - raises HTTP_INTERNAL_ERROR on error
 
@@ -1095,6 +1113,8 @@ class DAVNonCollection(_DAVResource):
     
     See also _DAVResource
     """
+    __slots__ = ()
+
     def __init__(self, path, environ):
         _DAVResource.__init__(self, path, False, environ)
 
@@ -1123,11 +1143,25 @@ class DAVNonCollection(_DAVResource):
         Returns a file-like object / stream containing the contents of the
         resource specified.
         The application will close() the stream.      
+
+        If the stream is a real file (i.e. it has a working fileno() method),
+        GET responses are sent with the server's wsgi.file_wrapper, so servers
+        may use sendfile(). Note that the file position must be honored.
          
         This method MUST be implemented by all providers.
         """
         raise NotImplementedError()
 
+    def getFilePath(self):
+        """Return the path of the content in the local file system, or None.
+
+        If this returns a path, GET requests may be answered by a front-end 
+        server (see the `file_offload` option).
+        
+        This default implementation returns None.
+        """
+        return None
+
     def supportRanges(self):
         """Return True, if this non-resource supports Range on GET requests.
 
@@ -1175,6 +1209,8 @@ class DAVCollection(_DAVResource):
 
     See also _DAVResource
     """
+    __slots__ = ()
+
     def __init__(self, path, environ):
         _DAVResource.__init__(self, path, True, environ)
 
@@ -1342,8 +1378,14 @@ class DAVProvider(object):
 
         self._count_getResourceInst = 0
         self._count_getResourceInstInit = 0
+        self._count_resourceCacheHits = 0
 #        self.caseSensitiveUrls = True
 
+        # Route all calls of the provider's getResourceInst() implementation
+        # through the per-request resource cache
+        self._getResourceInstUncached = self.getResourceInst
+        self.getResourceInst = self._getCachedResourceInst
+
     def __repr__(self):
         return self.__class__.__name__
 
@@ -1398,9 +1440,49 @@ class DAVProvider(object):
         See _DAVResource for details.
 
         This method MUST be implemented.
+        
+        Results are memoized for the duration of a request (see 
+        invalidateResourceCache()).
         """
         raise NotImplementedError()
 
+    def _getCachedResourceInst(self, path, environ):
+        """Return getResourceInst(path, environ), memoized in environ.
+
+        Request handlers and lock checks resolve the same paths several times
+        per request. Resource instances (or None, for unmapped paths) are
+        stored in environ["wsgidav.resourceCache"], so only the first lookup
+        hits the provider implementation.
+        """
+        if not environ or environ.get("wsgidav.provider") is not self:
+            return self._getResourceInstUncached(path, environ)
+        cache = environ.setdefault("wsgidav.resourceCache", {})
+        if path in cache:
+            self._count_resourceCacheHits += 1
+            return cache[path]
+        res = self._getResourceInstUncached(path, environ)
+        cache[path] = res
+        return res
+
+    def invalidateResourceCache(self, environ, path=None):
+        """Discard resource instances that were memoized for this request.
+
+        Must be called, when the request modifies <path>. This removes <path>,
+        its descendants and its parent collection from the cache.
+        If <path> is None, the whole cache is cleared.
+        """
+        cache = environ.get("wsgidav.resourceCache")
+        if not cache:
+            return
+        if path is None:
+            cache.clear()
+            return
+        parent = util.getUriParent(path)
+        for p in cache.keys():
+            if util.isEqualOrChildUri(path, p) or (
+                parent and p.rstrip("/") == parent.rstrip("/")):
+                del cache[p]
+
     def exists(self, path, environ):
         """Return True, if path maps to an existing resource.
 
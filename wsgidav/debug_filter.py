@@ -57,6 +57,7 @@ See `Developers info`_ for more information about the WsgiDAV architecture.
 from wsgidav import util
 import sys
 import threading
+import types
 
 __docformat__ = "reStructuredText"
 
@@ -160,9 +161,17 @@ class WsgiDavDebugFilter(object):
             environ["wsgidav.response_headers"] = response_headers
             return start_response(status, response_headers, exc_info)
 
+        appIter = self._application(environ, start_response_wrapper)
+        if not dumpResponse and not isinstance(appIter, (types.GeneratorType, list)):
+            # Pass a wsgi.file_wrapper to the server, so it can use sendfile()
+            return appIter
+        return self._iterate(appIter, environ, method, dumpResponse)
+
+
+    def _iterate(self, appIter, environ, method, dumpResponse):
         nbytes = 0
         firstyield = True
-        for v in iter(self._application(environ, start_response_wrapper)):
+        for v in iter(appIter):
             # Dump response headers
             if firstyield and dumpResponse:
                 print >> self.out, "<%s> --- %s Response(%s): ---" % (threading._get_ident(), 
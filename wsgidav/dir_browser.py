@@ -10,6 +10,7 @@ See `Developers info`_ for more information about the WsgiDAV architecture.
 """
 from wsgidav.dav_error import DAVError, HTTP_OK, HTTP_MEDIATYPE_NOT_SUPPORTED
 from wsgidav.version import __version__
+from wsgidav import compression
 import sys
 import urllib
 import util
@@ -221,8 +222,15 @@ class WsgiDavDirBrowser(object):
 
         body = "\n".join(html) 
 
-        start_response("200 OK", [("Content-Type", "text/html"), 
-                                  ("Content-Length", str(len(body))),
-                                  ("Date", util.getRfc1123Time()),
-                                  ])
+        headers = [("Content-Type", "text/html"), 
+                   ("Date", util.getRfc1123Time()),
+                   ]
+        encoding = compression.getContentEncoding(environ, len(body))
+        if encoding:
+            body = compression.gzipString(environ, body)
+            headers += [("Content-Encoding", encoding),
+                        ("Vary", "Accept-Encoding"),
+                        ]
+        headers.append(("Content-Length", str(len(body))))
+        start_response("200 OK", headers)
         return [ body ] 
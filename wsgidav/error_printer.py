@@ -16,9 +16,16 @@ from dav_error import DAVError, getHttpStatusString, asDAVError,\
     HTTP_INTERNAL_ERROR, HTTP_NOT_MODIFIED, HTTP_NO_CONTENT
 import traceback
 import sys
+import types
 
 _logger = util.getModuleLogger(__name__)
 
+
+def _raiseLater(exc_info):
+    """Generator that re-raises exc_info, when it is iterated."""
+    raise exc_info[0], exc_info[1], exc_info[2]
+    yield ""
+
 #===============================================================================
 # ErrorPrinter
 #===============================================================================
@@ -30,12 +37,22 @@ class ErrorPrinter(object):
         self._catch_all_exceptions = catchall
 
     def __call__(self, environ, start_response):      
+        try:
+            appIter = self._application(environ, start_response)
+        except Exception:
+            appIter = _raiseLater(sys.exc_info())
+        # Generators may raise errors while they are iterated, so we must 
+        # iterate them here. Other responses (lists, or a wsgi.file_wrapper 
+        # that the server sends with sendfile()) are returned unchanged.
+        if not isinstance(appIter, types.GeneratorType):
+            return appIter
+        return self._iterate(appIter, environ, start_response)
+
+
+    def _iterate(self, appIter, environ, start_response):      
         try:
             try:
-                # request_server app may be a generator (for example the GET handler)
-                # So we must iterate - not return self._application(..)!
-                # Otherwise the we could not catch exceptions here. 
-                for v in self._application(environ, start_response):
+                for v in appIter:
                     yield v
             except DAVError, e:
                 _logger.debug("re-raising %s" % e)
@@ -0,0 +1,321 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Implements `FileHandleCache`, which keeps read-only file descriptors open
+across requests.
+
+Windows MiniRedir and davfs2 read large files as hundreds of sequential Range
+GETs. Without a cache, every request opens the file, seeks and closes it
+again (which is expensive on network file systems).
+
+FilesystemProvider and MyTardisProvider create a FileHandleCache, if
+`fileHandleCacheSize` (max. number of open files) is set.
+FileResource.getContent() then returns a `PreadFile` for the cached
+descriptor. Every PreadFile has its own position and reads with pread(), so
+concurrent requests can share the descriptor. os.pread() is used, if
+available (Python 3.3+), otherwise pread64() is called through ctypes on
+Linux. On other platforms lseek() and read() are called while holding a lock.
+
+Descriptors are keyed by path, device, inode and modification time, so a
+modified or replaced file is opened again. Descriptors that were not used
+for `idleTimeout` seconds are closed by a background thread, and the least
+recently used ones are closed, if more than `maxHandles` are open (unless
+they are in use).
+
+Usage::
+
+    addShare("", MyTardisProvider("/var/lib/mytardis/store/", readonly=True,
+                                  fileHandleCacheSize=64))
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html
+"""
+from collections import OrderedDict
+from wsgidav import util
+import ctypes
+import ctypes.util
+import errno
+import os
+import sys
+import threading
+import time
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+
+def _loadPread():
+    """Return pread(fd, count, offset), or None if not available."""
+    if hasattr(os, "pread"):
+        return os.pread
+    libName = ctypes.util.find_library("c")
+    if not sys.platform.startswith("linux") or not libName:
+        return None
+    libc = ctypes.CDLL(libName, use_errno=True)
+    if not hasattr(libc, "pread64"):
+        return None
+    libc.pread64.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                             ctypes.c_int64]
+    libc.pread64.restype = ctypes.c_ssize_t
+
+    def _pread(fd, count, offset):
+        buf = ctypes.create_string_buffer(count)
+        while True:
+            n = libc.pread64(fd, buf, count, offset)
+            if n >= 0:
+                return buf.raw[:n]
+            e = ctypes.get_errno()
+            if e != errno.EINTR:
+                raise OSError(e, os.strerror(e))
+    return _pread
+
+try:
+    _pread = _loadPread()
+except OSError:
+    _pread = None
+
+
+
+#===============================================================================
+# _FileHandle
+#===============================================================================
+class _FileHandle(object):
+    """An open file descriptor, shared by PreadFile objects."""
+    def __init__(self, key, fd):
+        self.key = key
+        self.fd = fd
+        self.users = 0
+        self.lastUsed = time.time()
+        # Only used if pread() is not available
+        self.lock = threading.Lock()
+
+
+    def pread(self, count, offset):
+        if _pread is not None:
+            return _pread(self.fd, count, offset)
+        self.lock.acquire()
+        try:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, count)
+        finally:
+            self.lock.release()
+
+
+
+#===============================================================================
+# PreadFile
+#===============================================================================
+class PreadFile(object):
+    """
+    Read-only file object for a cached file descriptor.
+
+    The position is private to this object (i.e. the position of the shared
+    descriptor is not used). close() returns the descriptor to the cache.
+    """
+    def __init__(self, cache, handle, name):
+        self._cache = cache
+        self._handle = handle
+        self._pos = 0
+        self.name = name
+        self.closed = False
+
+
+    def __repr__(self):
+        return "PreadFile(%r, pos=%s)" % (self.name, self._pos)
+
+
+    def fileno(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        return self._handle.fd
+
+
+    def tell(self):
+        return self._pos
+
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self._handle.fd).st_size
+        if offset < 0:
+            raise IOError(errno.EINVAL, "Invalid argument")
+        self._pos = offset
+
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None or size < 0:
+            size = max(0, os.fstat(self._handle.fd).st_size - self._pos)
+        data = self._handle.pread(size, self._pos)
+        self._pos += len(data)
+        return data
+
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._cache._release(self._handle)
+
+
+    def __del__(self):
+        # Responses that were not iterated to the end may not be closed
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+
+#===============================================================================
+# FileHandleCache
+#===============================================================================
+class FileHandleCache(object):
+    """
+    LRU cache of read-only file descriptors.
+
+    maxHandles:
+        Max. number of open descriptors that are not in use.
+    idleTimeout:
+        Close descriptors that were not used for this many seconds.
+    """
+    def __init__(self, maxHandles=64, idleTimeout=30):
+        self.maxHandles = maxHandles
+        self.idleTimeout = idleTimeout
+        # {key: _FileHandle} in LRU order
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self._count_hits = 0
+        self._count_opens = 0
+
+
+    def __repr__(self):
+        return "FileHandleCache(%s open)" % len(self._handles)
+
+
+    def getStats(self):
+        """Return dictionary with cache statistics."""
+        return {"open": len(self._handles),
+                "hits": self._count_hits,
+                "opens": self._count_opens,
+                }
+
+
+    def _getKey(self, filePath, st):
+        return (filePath, st.st_dev, st.st_ino, st.st_mtime)
+
+
+    def open(self, filePath, filestat):
+        """Return a PreadFile for filePath.
+
+        filestat is the current stat result of filePath. Raises IOError, if
+        the file cannot be opened.
+        """
+        key = self._getKey(filePath, filestat)
+        self._lock.acquire()
+        try:
+            handle = self._handles.pop(key, None)
+            if handle is not None:
+                self._handles[key] = handle
+                handle.users += 1
+                self._count_hits += 1
+                return PreadFile(self, handle, filePath)
+        finally:
+            self._lock.release()
+
+        try:
+            fd = os.open(filePath, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        except OSError, e:
+            raise IOError(e.errno, e.strerror, filePath)
+        # Key by the opened file (it may have changed since filestat)
+        handle = _FileHandle(self._getKey(filePath, os.fstat(fd)), fd)
+        handle.users = 1
+        self._lock.acquire()
+        try:
+            self._count_opens += 1
+            if handle.key in self._handles:
+                # Opened concurrently: keep the cached one open
+                handle.key = None
+            else:
+                self._handles[handle.key] = handle
+                self._evict()
+            self._startSweeper()
+        finally:
+            self._lock.release()
+        return PreadFile(self, handle, filePath)
+
+
+    def _release(self, handle):
+        self._lock.acquire()
+        try:
+            handle.users -= 1
+            handle.lastUsed = time.time()
+            if handle.key is None or self._handles.get(handle.key) is not handle:
+                # Not (or no longer) cached
+                if handle.users == 0:
+                    os.close(handle.fd)
+                return
+            self._evict()
+        finally:
+            self._lock.release()
+
+
+    def _evict(self, idleSince=None):
+        """Close unused descriptors, if more than maxHandles are cached, or
+        if they were not used after idleSince (lock must be held)."""
+        unused = [ h for h in self._handles.itervalues() if h.users == 0 ]
+        excess = len(unused) - self.maxHandles
+        for handle in unused:
+            if excess > 0 or (idleSince is not None and handle.lastUsed < idleSince):
+                del self._handles[handle.key]
+                handle.key = None
+                os.close(handle.fd)
+                excess -= 1
+
+
+    def _startSweeper(self):
+        """Start the thread, that closes idle descriptors (lock must be held)."""
+        if self._sweeper is None and self.idleTimeout:
+            self._sweeper = threading.Thread(target=self._sweep,
+                                             name="FileHandleCache")
+            self._sweeper.setDaemon(True)
+            self._sweeper.start()
+
+
+    def _sweep(self):
+        while True:
+            time.sleep(max(0.1, self.idleTimeout / 2.0))
+            self._lock.acquire()
+            try:
+                self._evict(time.time() - self.idleTimeout)
+                if not self._handles:
+                    self._sweeper = None
+                    return
+            finally:
+                self._lock.release()
+
+
+    def invalidate(self, filePath=None):
+        """Close unused descriptors for filePath and its descendants (None: all).
+
+        Descriptors in use are closed, when they are released.
+        """
+        self._lock.acquire()
+        try:
+            prefix = None
+            if filePath is not None:
+                prefix = filePath.rstrip(os.sep) + os.sep
+            for key, handle in self._handles.items():
+                path = key[0]
+                if prefix is None or path == filePath or path.startswith(prefix):
+                    del self._handles[key]
+                    handle.key = None
+                    if handle.users == 0:
+                        os.close(handle.fd)
+        finally:
+            self._lock.release()
@@ -0,0 +1,283 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Implements `FileWrapper`, the ``wsgi.file_wrapper`` of the bundled servers.
+
+When a resource's getContent() returns a real file (i.e. an object with a
+working fileno()), RequestServer returns ``environ["wsgi.file_wrapper"]``
+for GET requests, instead of reading the file in 8 kB blocks and passing every
+block through all middleware layers.
+
+The bundled servers (cherrypy_wsgiserver, ext_wsgiutils_server) recognize
+FileWrapper responses and call FileWrapper.sendTo(), which copies the file to
+the socket with sendfile() in the kernel. os.sendfile() is used, if available
+(Python 3.3+), otherwise sendfile64() is called through ctypes on Linux.
+If sendfile() is not available, or not supported for the file or socket (for
+example SSL connections), the content is sent in large blocks
+(`FALLBACK_BLOCK_SIZE`).
+
+Other WSGI servers may pass their own ``wsgi.file_wrapper`` (see PEP 333).
+Those are only used for complete responses, since the standard interface has
+no way to limit the length. FileWrapper accepts an additional `length`
+argument, so it is also used for single range responses.
+
+RequestServer may pass a page_cache.StreamAdvisor (`advisor`), which gives the
+kernel read-ahead and drop-behind hints while the file is sent.
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html
+"""
+from wsgidav import util
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import sys
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+# Block size for sending files without sendfile()
+FALLBACK_BLOCK_SIZE = 256 * 1024
+# Max. number of bytes per sendfile() call
+SENDFILE_BLOCK_SIZE = 0x7ffff000
+
+
+def _loadSendfile():
+    """Return sendfile(outFd, inFd, offset, count), or None if not available."""
+    if hasattr(os, "sendfile"):
+        return os.sendfile
+    libName = ctypes.util.find_library("c")
+    if not sys.platform.startswith("linux") or not libName:
+        return None
+    libc = ctypes.CDLL(libName, use_errno=True)
+    if not hasattr(libc, "sendfile64"):
+        return None
+    libc.sendfile64.argtypes = [ctypes.c_int, ctypes.c_int,
+                                ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    libc.sendfile64.restype = ctypes.c_ssize_t
+
+    def _sendfile(outFd, inFd, offset, count):
+        off = ctypes.c_int64(offset)
+        n = libc.sendfile64(outFd, inFd, ctypes.byref(off), count)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        return n
+    return _sendfile
+
+try:
+    _sendfile = _loadSendfile()
+except OSError:
+    _sendfile = None
+
+
+def isPlainSocket(sock):
+    """Return True, if data can be written to sock's file descriptor.
+
+    This is not the case for SSL sockets (ssl.SSLSocket is a subclass).
+    """
+    return type(sock) in (socket.socket, socket.SocketType)
+
+
+
+#===============================================================================
+# FileWrapper
+#===============================================================================
+class FileWrapper(object):
+    """
+    Iterable over a file-like object, that can be sent with sendfile().
+
+    filelike:
+        The file to send, starting at the current position. It is closed by
+        close().
+    blksize:
+        Size of the first block, if the response is iterated. The following
+        blocks grow up to `FALLBACK_BLOCK_SIZE`.
+    length:
+        Max. number of bytes to send (None: up to EOF). This argument is an
+        extension to PEP 333 (see `acceptsLength`).
+    parts:
+        Send a body that consists of several parts of the file, e.g. a 
+        multipart/byteranges response (see util.getMultipartByteranges()).
+        A list of strings, that are sent as they are, and (offset, length) 
+        tuples, that are sent from the file. `length` is ignored. This 
+        argument is an extension to PEP 333 (see `acceptsParts`).
+    advisor:
+        A page_cache.StreamAdvisor for filelike, that is updated while the
+        file is sent. This argument is an extension to PEP 333 (see
+        `acceptsAdvisor`).
+    """
+    # RequestServer passes a `length` argument only to wrappers with this flag
+    acceptsLength = True
+    # ... and `parts` only to wrappers with this flag
+    acceptsParts = True
+    # ... and `advisor` only to wrappers with this flag
+    acceptsAdvisor = True
+
+    def __init__(self, filelike, blksize=8192, length=None, parts=None,
+                 advisor=None):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.length = length
+        self.parts = parts
+        self.advisor = advisor
+
+
+    def __repr__(self):
+        if self.parts is not None:
+            return "FileWrapper(%r, %s parts)" % (self.filelike, len(self.parts))
+        return "FileWrapper(%r, length=%s)" % (self.filelike, self.length)
+
+
+    def __iter__(self):
+        if self.parts is None:
+            return self._iterRange(self.length)
+        return self._iterParts()
+
+
+    def _iterRange(self, length):
+        """Yield max. length bytes (None: up to EOF) in blocks."""
+        advisor = self.advisor
+        if advisor is not None:
+            pos = self.filelike.tell()
+            advisor.begin(pos, length)
+        blockSizes = util.iterBlockSizes(self.blksize, 
+                                         max(self.blksize, FALLBACK_BLOCK_SIZE))
+        while length is None or length > 0:
+            n = blockSizes.next()
+            if length is not None:
+                n = min(n, length)
+            data = self.filelike.read(n)
+            if not data:
+                break
+            if length is not None:
+                length -= len(data)
+            if advisor is not None:
+                pos += len(data)
+                advisor.update(pos)
+            yield data
+        if advisor is not None:
+            advisor.end(pos)
+
+
+    def _iterParts(self):
+        for part in self.parts:
+            if isinstance(part, str):
+                yield part
+            else:
+                offset, length = part
+                self.filelike.seek(offset)
+                for data in self._iterRange(length):
+                    yield data
+
+
+    def close(self):
+        if hasattr(self.filelike, "close"):
+            self.filelike.close()
+
+
+    def sendTo(self, sock, length=None):
+        """Send the (remaining) content to sock and return the number of bytes.
+
+        sock:
+            A socket, or an object with a sendall() method (e.g. the
+            server's SSL connection). sendfile() is only used for plain
+            sockets (see isPlainSocket()).
+        length:
+            Max. number of bytes to send (e.g. the Content-Length).
+        """
+        if self.parts is None:
+            if length is None or (self.length is not None and self.length < length):
+                length = self.length
+            return self._sendRange(sock, length)
+        sent = 0
+        for part in self.parts:
+            if isinstance(part, str):
+                sock.sendall(part)
+                sent += len(part)
+            else:
+                offset, partLength = part
+                self.filelike.seek(offset)
+                sent += self._sendRange(sock, partLength)
+        return sent
+
+
+    def _sendRange(self, sock, length):
+        """Send max. length bytes (None: up to EOF) from the current position."""
+        sent = 0
+        advisor = self.advisor
+        if advisor is not None:
+            offset = self.filelike.tell()
+            advisor.begin(offset, length)
+        if _sendfile is not None and isPlainSocket(sock):
+            try:
+                inFd = self.filelike.fileno()
+                offset = self.filelike.tell()
+            except (AttributeError, IOError, OSError, ValueError):
+                inFd = None
+            if inFd is not None:
+                if length is None:
+                    length = max(0, os.fstat(inFd).st_size - offset)
+                sent = self._sendfile(sock, inFd, offset, length)
+                # sendfile() does not move the file position
+                self.filelike.seek(offset + sent)
+        while length is None or sent < length:
+            n = FALLBACK_BLOCK_SIZE
+            if length is not None:
+                n = min(n, length - sent)
+            data = self.filelike.read(n)
+            if not data:
+                break
+            sock.sendall(data)
+            sent += len(data)
+            if advisor is not None:
+                advisor.update(offset + sent)
+        if advisor is not None:
+            advisor.end(offset + sent)
+        return sent
+
+
+    def _sendfile(self, sock, inFd, offset, length):
+        """Send with sendfile() and return the number of bytes sent.
+
+        Returns 0, if sendfile() is not supported for these files.
+        """
+        outFd = sock.fileno()
+        timeout = sock.gettimeout()
+        advisor = self.advisor
+        blockSize = SENDFILE_BLOCK_SIZE
+        if advisor is not None:
+            # Send in windows, so the advisor can keep ahead of the socket
+            blockSize = advisor.window
+        sent = 0
+        while sent < length:
+            try:
+                n = _sendfile(outFd, inFd, offset + sent,
+                              min(length - sent, blockSize))
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                elif e.errno == errno.EAGAIN:
+                    # Socket has a timeout, so it is non-blocking
+                    _r, w, _x = select.select([], [outFd], [], timeout)
+                    if not w:
+                        raise socket.timeout("timed out")
+                    continue
+                elif sent == 0 and e.errno in (errno.EINVAL, errno.ENOSYS,
+                                               errno.EOPNOTSUPP):
+                    _logger.debug("sendfile() not supported: %s" % e)
+                    return 0
+                # Let the servers handle EPIPE, ECONNRESET, ...
+                raise socket.error(e.errno, e.strerror)
+            if n == 0:
+                # File was truncated
+                break
+            sent += n
+            if advisor is not None:
+                advisor.update(offset + sent)
+        return sent
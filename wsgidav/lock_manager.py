@@ -5,10 +5,11 @@
 Implements the `LockManager` object that provides the locking functionality.
 
 The LockManager requires a LockStorage object to implement persistence.  
-Two alternative lock storage classes are defined in the lock_storage module:
+Three alternative lock storage classes are defined in the lock_storage module:
 
 - wsgidav.lock_storage.LockStorageDict
 - wsgidav.lock_storage.LockStorageShelve
+- wsgidav.lock_storage.LockStorageSQLite
 
 
 The lock data model is a dictionary with these fields:
@@ -44,7 +45,7 @@ import sys
 import util
 import random
 import time
-from rw_lock import ReadWriteLock
+from striped_lock import StripedReadWriteLock
 
 __docformat__ = "reStructuredText"
 
@@ -68,6 +69,11 @@ def normalizeLockRoot(path):
     return path
 
 
+def getTopSegment(path):
+    """Return the top-level segment of a path ('' for the root)."""
+    return path.lstrip("/").split("/", 1)[0]
+
+
 def isLockExpired(lock):
     expire = float(lock["expire"])
     return expire >= 0 and expire < time.time()
@@ -116,8 +122,11 @@ class LockManager(object):
     """
     Implements locking functionality using a custom storage layer.
     
+    Lock checks and lock creation are serialized per top-level folder by a
+    StripedReadWriteLock (see striped_lock for the rules).
     """
     LOCK_TIME_OUT_DEFAULT = 604800 # 1 week, in seconds
+    STRIPE_COUNT = 16
 
     def __init__(self, storage):
         """
@@ -125,7 +134,7 @@ class LockManager(object):
             LockManagerStorage object
         """
         assert hasattr(storage, "getLockList")
-        self._lock = ReadWriteLock()
+        self._lock = StripedReadWriteLock(self.STRIPE_COUNT)
         self.storage = storage
         self.storage.open()
 
@@ -172,6 +181,58 @@ class LockManager(object):
             pprint(ownerDict, indent=4, width=255, stream=out)
 
 
+    def _stripePaths(self, url, depth):
+        """Return paths that select the stripes for an operation on <url>.
+
+        Depth-infinity operations on the root folder need all stripes.
+        """
+        if depth == "infinity" and url.strip("/") == "":
+            return ()
+        return (url, )
+
+
+    def _getLockLists(self, url, withChildren):
+        """Return ([(u, lockList), ...] for <url> and its parents, childLocks).
+
+        childLocks are the locks below <url> (None, if withChildren is False).
+        Storages with getLockLists() answer all queries with one call (one 
+        round trip for remote storages).
+        """
+        urls = []
+        u = url
+        while u:
+            urls.append(u)
+            u = util.getUriParent(u)
+        queries = [ (u, True, False, False) for u in urls ]
+        if withChildren:
+            queries.append((url, False, True, False))
+        getLockLists = getattr(self.storage, "getLockLists", None)
+        if getLockLists is not None:
+            results = getLockLists(queries)
+        else:
+            results = [ self.storage.getLockList(*q) for q in queries ]
+        childLocks = None
+        if withChildren:
+            childLocks = results.pop()
+        return zip(urls, results), childLocks
+
+
+    def hasLocks(self, url=None, depth="0"):
+        """Return False, if no lock can affect <url> (or no lock exists at all).
+
+        This is a fast check, that makes a single storage call (one round 
+        trip for remote storages): only locks on <url>, its ancestors and 
+        (if depth is 'infinity') its descendants can affect <url>.
+        Storages without hasAffectingLocks() always return True.
+        """
+        hasAffectingLocks = getattr(self.storage, "hasAffectingLocks", None)
+        if hasAffectingLocks is None:
+            return True
+        if url is None:
+            return hasAffectingLocks("/", True)
+        return hasAffectingLocks(url, depth == "infinity")
+
+
     def _generateLock(self, principal, 
                       locktype, lockscope, lockdepth, lockowner, path, timeout):
         """Acquire lock and return lockDict.
@@ -219,13 +280,23 @@ class LockManager(object):
         On error raise a DAVError with an embedded DAVErrorCondition.
         """
         url = normalizeLockRoot(url)
-        self._lock.acquireWrite()
+        # Storages that are shared by multiple processes may provide a 
+        # transaction, so checking and creating is atomic across processes
+        exclusive = hasattr(self.storage, "beginExclusive")
+        stripePaths = self._stripePaths(url, lockdepth)
+        self._lock.acquireWrite(*stripePaths)
         try:
-            # Raises DAVError on conflict:
-            self._checkLockPermission(url, locktype, lockscope, lockdepth, tokenList, principal)
-            return self._generateLock(principal, locktype, lockscope, lockdepth, lockowner, url, timeout)
+            if exclusive:
+                self.storage.beginExclusive()
+            try:
+                # Raises DAVError on conflict:
+                self._checkLockPermission(url, locktype, lockscope, lockdepth, tokenList, principal)
+                return self._generateLock(principal, locktype, lockscope, lockdepth, lockowner, url, timeout)
+            finally:
+                if exclusive:
+                    self.storage.endExclusive()
         finally:
-            self._lock.release()
+            self._lock.release(*stripePaths)
         
 
     def refresh(self, token, timeout=None):
@@ -268,6 +339,8 @@ class LockManager(object):
         Side effect: expired locks for this url are purged.
         """
         url = normalizeLockRoot(url)
+        if not self.hasLocks(url):
+            return []
         lockList = self.storage.getLockList(url, includeRoot=True, 
                                             includeChildren=False, 
                                             tokenOnly=False)
@@ -282,11 +355,10 @@ class LockManager(object):
         """   
         url = normalizeLockRoot(url)
         lockList = []
-        u = url 
-        while u:
-            ll = self.storage.getLockList(u, includeRoot=True, 
-                                          includeChildren=False, 
-                                          tokenOnly=False)
+        if not self.hasLocks(url):
+            return lockList
+        parentLocks, _ = self._getLockLists(url, False)
+        for u, ll in parentLocks:
             for l in ll:
                 if u != url and l["depth"] != "infinity":
                     continue  # We only consider parents with Depth: infinity
@@ -295,7 +367,6 @@ class LockManager(object):
 #                    continue  # Only compatible with shared locks by other users 
                 if principal is None or principal == l["principal"]:
                     lockList.append(l)
-            u = util.getUriParent(u)
         return lockList
 
 
@@ -312,13 +383,14 @@ class LockManager(object):
 
 
     def removeAllLocksFromUrl(self, url):
-        self._lock.acquireWrite()
+        url = normalizeLockRoot(url)
+        self._lock.acquireWrite(url)
         try:
             lockList = self.getUrlLockList(url)
             for lock in lockList:
                 self.release(lock["token"])
         finally:
-            self._lock.release()               
+            self._lock.release(url)               
 
 
     def _checkLockPermission(self, url, locktype, lockscope, lockdepth, 
@@ -364,12 +436,12 @@ class LockManager(object):
         # Error precondition to collect conflicting URLs
         errcond = DAVErrorCondition(PRECONDITION_CODE_LockConflict)
         
-        self._lock.acquireRead()
+        stripePaths = self._stripePaths(url, lockdepth)
+        self._lock.acquireRead(*stripePaths)
         try:
+            parentLocks, childLocks = self._getLockLists(url, lockdepth == "infinity")
             # Check url and all parents for conflicting locks
-            u = url 
-            while u:
-                ll = self.getUrlLockList(u)
+            for u, ll in parentLocks:
                 for l in ll:
                     _logger.debug("    check parent %s, %s" % (u, lockString(l)))
                     if u != url and l["depth"] != "infinity":
@@ -381,22 +453,16 @@ class LockManager(object):
                     # Lock conflict
                     _logger.debug(" -> DENIED due to locked parent %s" % lockString(l))
                     errcond.add_href(l["root"])
-                u = util.getUriParent(u)
     
             if lockdepth == "infinity":
                 # Check child URLs for conflicting locks
-                childLocks = self.storage.getLockList(url, 
-                                                      includeRoot=False, 
-                                                      includeChildren=True, 
-                                                      tokenOnly=False)
-
                 for l in childLocks:
                     assert util.isChildUri(url, l["root"])
 #                    if util.isChildUri(url, l["root"]): 
                     _logger.debug(" -> DENIED due to locked child %s" % lockString(l))
                     errcond.add_href(l["root"])
         finally:
-            self._lock.release()
+            self._lock.release(*stripePaths)
 
         # If there were conflicts, raise HTTP_LOCKED for <url>, and pass
         # conflicting resource with 'no-conflicting-lock' precondition 
@@ -436,15 +502,19 @@ class LockManager(object):
         assert depth in ("0", "infinity")
         _logger.debug("checkWritePermission(%s, %s, %s, %s)" % (url, depth, tokenList, principal))
 
+        # Fast path: most requests run without any active locks
+        if not self.hasLocks(url, depth):
+            return
+
         # Error precondition to collect conflicting URLs
         errcond = DAVErrorCondition(PRECONDITION_CODE_LockConflict)
 
-        self._lock.acquireRead()
+        stripePaths = self._stripePaths(url, depth)
+        self._lock.acquireRead(*stripePaths)
         try:
+            parentLocks, childLocks = self._getLockLists(url, depth == "infinity")
             # Check url and all parents for conflicting locks
-            u = url 
-            while u:
-                ll = self.getUrlLockList(u)
+            for u, ll in parentLocks:
                 _logger.debug("  checking %s" % u)
                 for l in ll:
                     _logger.debug("     l=%s" % lockString(l))
@@ -458,22 +528,16 @@ class LockManager(object):
                         # Token is owned by principal, but not passed with lock list
                         _logger.debug(" -> DENIED due to locked parent %s" % lockString(l))
                         errcond.add_href(l["root"])
-                u = util.getUriParent(u)
     
             if depth == "infinity":
                 # Check child URLs for conflicting locks
-                childLocks = self.storage.getLockList(url, 
-                                                      includeRoot=False, 
-                                                      includeChildren=True, 
-                                                      tokenOnly=False)
-
                 for l in childLocks:
                     assert util.isChildUri(url, l["root"])
 #                    if util.isChildUri(url, l["root"]): 
                     _logger.debug(" -> DENIED due to locked child %s" % lockString(l))
                     errcond.add_href(l["root"])
         finally:
-            self._lock.release()               
+            self._lock.release(*stripePaths)               
 
         # If there were conflicts, raise HTTP_LOCKED for <url>, and pass
         # conflicting resource with 'no-conflicting-lock' precondition 
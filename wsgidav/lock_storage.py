@@ -2,10 +2,11 @@
 # Original PyFileServer (c) 2005 Ho Chun Wei.
 # Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
 """
-Implements two storage providers for `LockManager`.
+Implements three storage providers for `LockManager`.
  
-Two alternative lock storage classes are defined here: one in-memory 
-(dict-based), and one persistent low performance variant using shelve.
+Three alternative lock storage classes are defined here: one in-memory 
+(dict-based), one persistent low performance variant using shelve, and a
+persistent variant using SQLite that may be shared by multiple processes.
 
 See wsgidav.lock_manager.LockManager
 
@@ -14,12 +15,17 @@ See `Developers info`_ for more information about the WsgiDAV architecture.
 .. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html  
 """
 from wsgidav.lock_manager import normalizeLockRoot, lockString,\
-    generateLockToken, validateLock
+    generateLockToken, validateLock, getTopSegment
 import os
 import util
 import shelve
+import sqlite3
 import time
+import heapq
 from rw_lock import ReadWriteLock
+from striped_lock import StripedReadWriteLock
+import threading
+from write_behind import WriteBehindShelf
 
 __docformat__ = "reStructuredText"
 
@@ -38,6 +44,102 @@ _logger = util.getModuleLogger(__name__)
 # (pickles aren't particularly readable)
 
 
+#===============================================================================
+# LockRootIndex
+#===============================================================================
+class LockRootIndex(object):
+    """
+    A path-segment trie over all locked root paths.
+    
+    The lock dictionary is keyed by token and 'URL2TOKEN:<path>', so finding
+    the locks below a path would require a scan of all keys.
+    This index stores every path that has at least one direct lock, so child
+    queries only visit the nodes on the path and the matching sub tree, i.e.
+    they cost O(depth + matches).
+
+    The index is kept in memory only and rebuilt from the lock dictionary when
+    the storage is opened.
+
+    A node is a 2-item list: [<dict of child segment -> node>, <is locked>]
+    """
+    def __init__(self):
+        self._root = [{}, False]
+
+
+    def _segments(self, path):
+        return [ s for s in path.split("/") if s ]
+
+
+    def clear(self):
+        self._root = [{}, False]
+
+
+    def add(self, path):
+        """Mark <path> as a lock root."""
+        node = self._root
+        for seg in self._segments(path):
+            node = node[0].setdefault(seg, [{}, False])
+        node[1] = True
+
+    
+    def remove(self, path):
+        """Unmark <path> and prune empty branches."""
+        trail = [] # list of (parent node, segment) 
+        node = self._root
+        for seg in self._segments(path):
+            child = node[0].get(seg)
+            if child is None:
+                return
+            trail.append((node, seg))
+            node = child
+        node[1] = False
+        # Remove nodes that neither are locked nor have children  
+        while trail and not node[1] and not node[0]:
+            parent, seg = trail.pop()
+            del parent[0][seg]
+            node = parent
+
+    
+    def hasLockedPath(self, path, includeChildren=False):
+        """Return True, if <path> or one of its ancestors is locked (or one of
+        its descendants, if includeChildren is True).
+        
+        This costs O(depth): empty branches are pruned, so any node below 
+        <path> leads to a locked path.
+        """
+        node = self._root
+        if node[1]:
+            return True
+        for seg in self._segments(path):
+            node = node[0].get(seg)
+            if node is None:
+                return False
+            elif node[1]:
+                return True
+        return includeChildren and bool(node[0])
+
+    
+    def getChildPaths(self, path):
+        """Return a list of locked paths below <path> (not including <path>)."""
+        node = self._root
+        for seg in self._segments(path):
+            node = node[0].get(seg)
+            if node is None:
+                return []
+        res = []
+        # Iterative depth-first walk, so deep trees don't hit recursion limits
+        stack = [ (path.rstrip("/"), node) ]
+        while stack:
+            prefix, node = stack.pop()
+            for seg, child in node[0].iteritems():
+                childPath = prefix + "/" + seg
+                if child[1]:
+                    res.append(childPath)
+                if child[0]:
+                    stack.append((childPath, child))
+        return res
+
+
 #===============================================================================
 # LockStorageDict
 #===============================================================================
@@ -45,7 +147,10 @@ class LockStorageDict(object):
     """
     An in-memory lock manager storage implementation using a dictionary.
     
-    R/W access is guarded by a thread.lock object.
+    R/W access is guarded by a StripedReadWriteLock, so requests for 
+    different top-level folders don't block each other (see striped_lock for
+    the rules). Structures that are shared by all stripes (index, expiry heap,
+    counters) are guarded by an additional short-term threading.Lock.
     
     Also, to make it work with a Shelve dictionary, modifying dictionary
     members is done by re-assignment and we call a _flush() method.
@@ -57,6 +162,13 @@ class LockStorageDict(object):
         expire is stored as expiration date in seconds since epoch (not in
         seconds until expiration).
 
+        Expired locks are reaped using an in-memory min-heap of 
+        (expire, token) tuples: every create() and refresh() purges up to 
+        REAP_BATCH_SIZE expired locks (O(log n) each), and cleanup() purges 
+        all of them. Refreshed locks leave stale heap entries, which are 
+        skipped when popped. 
+        See getStats() for the number of live and reaped locks.
+
     The dictionary is built like::
     
         { 'URL2TOKEN:/temp/litmus/lockme': ['opaquelocktoken:0x1d7b86...', 
@@ -83,16 +195,35 @@ class LockStorageDict(object):
     """
     LOCK_TIME_OUT_DEFAULT = 604800 # 1 week, in seconds
     LOCK_TIME_OUT_MAX = 4 * 604800 # 1 month, in seconds
+    REAP_BATCH_SIZE = 100 # Max. number of expired locks purged per write
+    STRIPE_COUNT = 16
 
     def __init__(self):
         self._dict = None
-        self._lock = ReadWriteLock()
+        self._lock = StripedReadWriteLock(self.STRIPE_COUNT)
+        self._sharedLock = threading.Lock()
+        self._index = LockRootIndex()
+        self._expiryHeap = [] # [ (expire, token), ... ]
+        self._liveCount = 0
+        self._segmentCounts = {} # { <top-level segment>: <lock count> }
+        self._reapedCount = 0
 
 
     def __repr__(self):
         return self.__class__.__name__
 
 
+    def _countLock(self, root, delta):
+        """Update live counters. Must be called with _sharedLock held."""
+        seg = getTopSegment(root)
+        count = self._segmentCounts.get(seg, 0) + delta
+        if count > 0:
+            self._segmentCounts[seg] = count
+        else:
+            self._segmentCounts.pop(seg, None)
+        self._liveCount += delta
+
+
     def __del__(self):
         pass   
 
@@ -101,6 +232,96 @@ class LockStorageDict(object):
         """Overloaded by Shelve implementation."""
         pass
 
+
+    def _peek(self, token):
+        """Return lock dictionary for token without acquiring a stripe.
+
+        This is used to find the lock root (and thus the stripe) for token 
+        based methods. The result must be re-checked after acquiring the 
+        stripe. Single dict lookups are atomic, but the Shelve implementation 
+        has to overload this.
+        """
+        return self._dict.get(token)
+
+
+    def _buildIndex(self):
+        """Rebuild lock root index, expiry heap and counters from _dict."""
+        self._index.clear()
+        self._expiryHeap = []
+        self._liveCount = 0
+        self._segmentCounts = {}
+        for key in self._dict.keys():
+            if key.startswith("URL2TOKEN:"):
+                self._index.add(key[len("URL2TOKEN:"):])
+            else:
+                self._countLock(self._dict[key]["root"], 1)
+                expire = float(self._dict[key]["expire"])
+                if expire >= 0:
+                    self._expiryHeap.append((expire, key))
+        heapq.heapify(self._expiryHeap)
+
+
+    def _scheduleExpiry(self, lock):
+        """Push lock expiration onto the reaper heap."""
+        expire = float(lock["expire"])
+        if expire < 0:
+            return
+        self._sharedLock.acquire()
+        try:
+            heapq.heappush(self._expiryHeap, (expire, lock["token"]))
+            # Refreshed locks leave stale entries: compact, if they dominate.
+            # (We are called with a stripe held, so we don't use _peek() here: 
+            # single dict lookups are atomic, and shelves have one stripe only.)
+            if len(self._expiryHeap) > 2 * self._liveCount + 64:
+                heap = []
+                for (_expire, tok) in self._expiryHeap:
+                    l = self._dict.get(tok)
+                    if l is not None and float(l["expire"]) == _expire:
+                        heap.append((_expire, tok))
+                heapq.heapify(heap)
+                self._expiryHeap = heap
+        finally:
+            self._sharedLock.release()
+
+
+    def _reapExpired(self, maxCount=None):
+        """Delete up to <maxCount> expired locks (all, if None).
+        
+        Every lock is deleted while holding its stripe, so this must not be 
+        called while holding a stripe other than all of them.
+        Returns number of purged locks.
+        """
+        now = time.time()
+        reaped = 0
+        while maxCount is None or reaped < maxCount:
+            self._sharedLock.acquire()
+            try:
+                if not self._expiryHeap or self._expiryHeap[0][0] >= now:
+                    break
+                expire, token = heapq.heappop(self._expiryHeap)
+            finally:
+                self._sharedLock.release()
+            lock = self._peek(token)
+            if lock is None:
+                continue
+            root = lock["root"]
+            self._lock.acquireWrite(root)
+            try:
+                lock = self._dict.get(token)
+                if lock is None or float(lock["expire"]) != expire:
+                    # Already deleted or refreshed meanwhile
+                    continue
+                _logger.debug("Lock reaped(%s): %s" % (expire, lockString(lock)))
+                self._delete(token)
+                self._flush()
+                reaped += 1
+            finally:
+                self._lock.release(root)
+        self._sharedLock.acquire()
+        self._reapedCount += reaped
+        self._sharedLock.release()
+        return reaped
+
     
     def open(self):
         """Called before first use.
@@ -109,6 +330,7 @@ class LockStorageDict(object):
         """
         assert self._dict is None
         self._dict = {}
+        self._buildIndex()
 
     
     def close(self):
@@ -117,8 +339,69 @@ class LockStorageDict(object):
 
     
     def cleanup(self):
-        """Purge expired locks (optional)."""
-        pass
+        """Purge expired locks (optional).
+        
+        Returns the number of purged locks.
+        """
+        self._lock.acquireWrite()
+        try:
+            return self._reapExpired()
+        finally:
+            self._lock.release()
+
+
+    def getLockCount(self, path=None):
+        """Return the number of stored locks.
+        
+        The result may include expired locks that have not yet been reaped,
+        but it is never too low, so 0 means 'there are no locks'.
+
+        path:
+            If given, only locks in the top-level folder of <path> are counted
+            (i.e. per share, for shares that are mounted at '/<name>').
+            Locks on the root '/' itself are counted for path '/'.
+        """
+        self._sharedLock.acquire()
+        try:
+            if path is None:
+                return self._liveCount
+            return self._segmentCounts.get(getTopSegment(path), 0)
+        finally:
+            self._sharedLock.release()
+
+
+    def hasAffectingLocks(self, path, includeChildren=False):
+        """Return True, if a lock exists on <path> or one of its ancestors (or
+        one of its descendants, if includeChildren is True).
+
+        This is the fast check used by LockManager.hasLocks() (one call, so
+        remote storages need one round trip). The result may include expired
+        locks that have not yet been reaped, so False means 'no lock can 
+        affect <path>'.
+        """
+        self._sharedLock.acquire()
+        try:
+            return self._index.hasLockedPath(normalizeLockRoot(path), includeChildren)
+        finally:
+            self._sharedLock.release()
+
+
+    def getStats(self):
+        """Return a dictionary with lock counters.
+        
+        live:
+            Number of locks currently stored (may include expired locks that
+            have not yet been reaped).
+        reaped:
+            Number of expired locks purged by the reaper since open().
+        """
+        self._sharedLock.acquire()
+        try:
+            return {"live": self._liveCount,
+                    "reaped": self._reapedCount,
+                    }
+        finally:
+            self._sharedLock.release()
 
     
     def get(self, token):
@@ -133,22 +416,27 @@ class LockStorageDict(object):
 
         Side effect: if lock is expired, it will be purged and None is returned.
         """
-        self._lock.acquireRead()
+        lock = self._peek(token)
+        if lock is None:
+            return None
+        root = lock["root"]
+        self._lock.acquireRead(root)
         try:
             lock = self._dict.get(token)
             if lock is None: 
-                # Lock not found: purge dangling URL2TOKEN entries
-                _logger.debug("Lock purged dangling: %s" % token)
-                self.delete(token)      
                 return None
             expire = float(lock["expire"])
-            if expire >= 0 and expire < time.time():
-                _logger.debug("Lock timed-out(%s): %s" % (expire, lockString(lock)))
-                self.delete(token)   
-                return None
-            return lock
+            if expire < 0 or expire >= time.time():
+                return lock
         finally:
-            self._lock.release()
+            self._lock.release(root)
+        # Delete after releasing the read lock, so we don't need an upgrade
+        _logger.debug("Lock timed-out(%s): %s" % (expire, lockString(lock)))
+        if self.delete(token):
+            self._sharedLock.acquire()
+            self._reapedCount += 1
+            self._sharedLock.release()
+        return None
     
     
     def create(self, path, lock):
@@ -167,18 +455,21 @@ class LockStorageDict(object):
         - lock['timeout'] may be normalized and shorter than requested
         - lock['token'] is added
         """
-        self._lock.acquireWrite()
+        # We expect only a lock definition, not an existing lock
+        assert lock.get("token") is None
+        assert lock.get("expire") is None, "Use timeout instead of expire"
+        assert path and "/" in path
+
+        # Amortized purging of expired locks (before acquiring our stripe)
+        self._reapExpired(self.REAP_BATCH_SIZE)
+
+        # Normalize root: /foo/bar 
+        org_path = path
+        path = normalizeLockRoot(path)
+        lock["root"] = path
+
+        self._lock.acquireWrite(path)
         try:
-            # We expect only a lock definition, not an existing lock
-            assert lock.get("token") is None
-            assert lock.get("expire") is None, "Use timeout instead of expire"
-            assert path and "/" in path
-    
-            # Normalize root: /foo/bar 
-            org_path = path
-            path = normalizeLockRoot(path)
-            lock["root"] = path
-    
             # Normalize timeout from ttl to expire-date
             timeout = float(lock.get("timeout"))
             if timeout is None:
@@ -196,11 +487,18 @@ class LockStorageDict(object):
             
             # Store lock
             self._dict[token] = lock
+            self._sharedLock.acquire()
+            self._countLock(path, 1)
+            self._sharedLock.release()
+            self._scheduleExpiry(lock)
             
             # Store locked path reference
             key = "URL2TOKEN:%s" % path
             if not key in self._dict:
                 self._dict[key] = [ token ]
+                self._sharedLock.acquire()
+                self._index.add(path)
+                self._sharedLock.release()
             else:
                 # Note: Shelve dictionary returns copies, so we must reassign values: 
                 tokList = self._dict[key] 
@@ -211,7 +509,7 @@ class LockStorageDict(object):
 #            print("LockStorageDict.set(%r): %s" % (org_path, lockString(lock)))
             return lock
         finally:
-            self._lock.release()         
+            self._lock.release(path)         
     
     
     def refresh(self, token, timeout):
@@ -226,21 +524,25 @@ class LockStorageDict(object):
             Lock dictionary. 
             Raises ValueError, if token is invalid. 
         """
-        assert token in self._dict, "Lock must exist"
+        lock = self._peek(token)
+        assert lock is not None, "Lock must exist"
         assert timeout == -1 or timeout > 0
         if timeout < 0 or timeout > LockStorageDict.LOCK_TIME_OUT_MAX:
             timeout = LockStorageDict.LOCK_TIME_OUT_MAX
 
-        self._lock.acquireWrite()
+        root = lock["root"]
+        self._lock.acquireWrite(root)
         try:
             # Note: shelve dictionary returns copies, so we must reassign values: 
             lock = self._dict[token]
             lock["timeout"] = timeout
             lock["expire"] = time.time() + timeout
             self._dict[token] = lock
+            self._scheduleExpiry(lock)
             self._flush()
         finally:
-            self._lock.release()         
+            self._lock.release(root)         
+        self._reapExpired(self.REAP_BATCH_SIZE)
         return lock
 
     
@@ -249,29 +551,48 @@ class LockStorageDict(object):
         
         Returns True on success. False, if token does not exist, or is expired.
         """
-        self._lock.acquireWrite()
+        lock = self._peek(token)
+        if lock is None:
+            return False
+        root = lock["root"]
+        self._lock.acquireWrite(root)
         try:
-            lock = self._dict.get(token)
-            _logger.debug("delete %s" % lockString(lock))
-            if lock is None:
+            if not self._delete(token):
                 return False
-            # Remove url to lock mapping
-            key = "URL2TOKEN:%s" % lock.get("root")
-            if key in self._dict:
-#                _logger.debug("    delete token %s from url %s" % (token, lock.get("root")))
-                tokList = self._dict[key]
-                if len(tokList) > 1:
-                    # Note: shelve dictionary returns copies, so we must reassign values: 
-                    tokList.remove(token)
-                    self._dict[key] = tokList
-                else:
-                    del self._dict[key]     
-            # Remove the lock
-            del self._dict[token]       
-
             self._flush()
         finally:
-            self._lock.release()
+            self._lock.release(root)
+        return True
+
+
+    def _delete(self, token):
+        """Remove lock and URL2TOKEN entry without flushing.
+        
+        Must be called with the stripe of the lock root held for writing.
+        """
+        lock = self._dict.get(token)
+        _logger.debug("delete %s" % lockString(lock))
+        if lock is None:
+            return False
+        # Remove url to lock mapping
+        key = "URL2TOKEN:%s" % lock.get("root")
+        if key in self._dict:
+#            _logger.debug("    delete token %s from url %s" % (token, lock.get("root")))
+            tokList = self._dict[key]
+            if len(tokList) > 1:
+                # Note: shelve dictionary returns copies, so we must reassign values: 
+                tokList.remove(token)
+                self._dict[key] = tokList
+            else:
+                del self._dict[key]     
+                self._sharedLock.acquire()
+                self._index.remove(lock.get("root"))
+                self._sharedLock.release()
+        # Remove the lock
+        del self._dict[token]       
+        self._sharedLock.acquire()
+        self._countLock(lock["root"], -1)
+        self._sharedLock.release()
         return True
     
     
@@ -295,34 +616,52 @@ class LockStorageDict(object):
         """
         assert path and path.startswith("/")
         assert includeRoot or includeChildren
+        now = time.time()
+        lockList = []
+        expiredList = []
         def __appendLocks(toklist):
-            # Since we can do this quickly, we use self.get() even if 
-            # tokenOnly is set, so expired locks are purged.
+            # We check the expiration even if tokenOnly is set, so expired 
+            # locks are purged.
             for token in toklist:
-                lock = self.get(token)
-                if lock:
-                    if tokenOnly:
-                        lockList.append(lock["token"])
-                    else:
-                        lockList.append(lock)
+                lock = self._dict.get(token)
+                if lock is None:
+                    continue
+                expire = float(lock["expire"])
+                if expire >= 0 and expire < now:
+                    expiredList.append(token)
+                elif tokenOnly:
+                    lockList.append(lock["token"])
+                else:
+                    lockList.append(lock)
 
         path = normalizeLockRoot(path)
-        self._lock.acquireRead()
+        # Children of the root folder may live in any stripe
+        if includeChildren and path == "/":
+            stripePaths = ()
+        else:
+            stripePaths = (path, )
+        self._lock.acquireRead(*stripePaths)
         try:
             key = "URL2TOKEN:%s" % path
             tokList = self._dict.get(key, [])
-            lockList = []
             if includeRoot:
                 __appendLocks(tokList)
                     
             if includeChildren:
-                for u, ltoks in self._dict.items():
-                    if util.isChildUri(key, u): 
-                        __appendLocks(ltoks)
-            
-            return lockList
+                # Use the index instead of scanning all keys. We collect the
+                # paths first, because expired locks may be purged meanwhile
+                for u in self._index.getChildPaths(path):
+                    __appendLocks(self._dict.get("URL2TOKEN:%s" % u, []))
         finally:
-            self._lock.release()        
+            self._lock.release(*stripePaths)        
+
+        # Purge expired locks after releasing the read lock
+        for token in expiredList:
+            if self.delete(token):
+                self._sharedLock.acquire()
+                self._reapedCount += 1
+                self._sharedLock.release()
+        return lockList
     
 
 #===============================================================================
@@ -332,16 +671,33 @@ class LockStorageDict(object):
 class LockStorageShelve(LockStorageDict):
     """
     A low performance lock manager implementation using shelve.
+
+    By default, the shelf is synced after every mutation. Pass 
+    flushInterval > 0 to enable write-behind mode (see 
+    write_behind.WriteBehindShelf): mutations are then written after 
+    flushInterval seconds, or when maxDirty mutations are pending.
     """
-    def __init__(self, storagePath):
+    STRIPE_COUNT = 1 # The shelf must not be accessed concurrently
+
+    def __init__(self, storagePath, flushInterval=0, maxDirty=100):
         super(LockStorageShelve, self).__init__()
         self._storagePath = os.path.abspath(storagePath)
+        self._flushInterval = flushInterval
+        self._maxDirty = maxDirty
 
 
     def __repr__(self):
         return "LockStorageShelve(%r)" % self._storagePath
         
 
+    def _peek(self, token):
+        self._lock.acquireRead()
+        try:
+            return self._dict.get(token)
+        finally:
+            self._lock.release()         
+
+
     def _flush(self):
         """Write persistent dictionary to disc."""
         _logger.debug("_flush()")
@@ -357,6 +713,13 @@ class LockStorageShelve(LockStorageDict):
         # Open with writeback=False, which is faster, but we have to be 
         # careful to re-assign values to _dict after modifying them
         self._dict = shelve.open(self._storagePath, writeback=False)
+        if self._flushInterval > 0:
+            self._dict = WriteBehindShelf(self._dict, self._flushInterval, 
+                                          self._maxDirty)
+        self._buildIndex()
+        # Purge locks that expired while we were down (e.g. abandoned by
+        # crashed clients)
+        self.cleanup()
 #        if __debug__ and self._verbose >= 2:
 ##                self._check("After shelve.open()")
 #            self._dump("After shelve.open()")
@@ -373,6 +736,355 @@ class LockStorageShelve(LockStorageDict):
             self._lock.release()         
 
 
+#===============================================================================
+# LockStorageSQLite
+#===============================================================================
+
+class LockStorageSQLite(object):
+    """
+    A persistent lock storage implementation using SQLite.
+    
+    Implements the same interface as LockStorageDict, but locks are stored in
+    a single table, with indexes on the root path and expiration columns:
+    
+    - Child locks are found with a range query on the root index, i.e. all
+      roots >= '<path>/' and < '<path>0' ('0' is the character after '/').
+    - Expired locks are purged with a range query on the expire index.
+    
+    The database is opened in WAL mode, so readers don't block the writer.
+    Since all state lives in the database, several server processes may share 
+    the same file. LockManager.acquire() calls beginExclusive() and 
+    endExclusive(), so checking for conflicts and creating the lock happens in
+    one 'BEGIN IMMEDIATE' transaction (i.e. atomic across processes).
+    
+    All access to the shared connection is serialized by a ReadWriteLock 
+    object (in write mode, since a connection must not be used concurrently).
+    """
+    LOCK_TIME_OUT_DEFAULT = LockStorageDict.LOCK_TIME_OUT_DEFAULT
+    LOCK_TIME_OUT_MAX = LockStorageDict.LOCK_TIME_OUT_MAX
+    BUSY_TIMEOUT = 30 # Seconds to wait for a database lock held by other processes
+    _COLUMNS = ("token", "root", "type", "scope", "depth", "owner", 
+                "principal", "timeout", "expire")
+
+    def __init__(self, storagePath):
+        self._storagePath = os.path.abspath(storagePath)
+        self._conn = None
+        self._lock = ReadWriteLock()
+        self._txDepth = 0
+        self._reapedCount = 0
+
+
+    def __repr__(self):
+        return "LockStorageSQLite(%r)" % self._storagePath
+
+
+    def __del__(self):
+        pass   
+
+
+    def _rowToLock(self, row):
+        return dict(zip(self._COLUMNS, row))
+
+
+    def _childRange(self, path):
+        """Return (low, high) bounds for roots below <path>."""
+        prefix = path.rstrip("/") + "/"
+        return prefix, prefix[:-1] + "0"
+
+    
+    def beginExclusive(self):
+        """Start a write transaction (nestable).
+        
+        Takes the thread lock and the database RESERVED lock, so other 
+        threads and processes cannot write until endExclusive() is called.
+        """
+        self._lock.acquireWrite()
+        try:
+            if self._txDepth == 0:
+                self._conn.execute("BEGIN IMMEDIATE")
+            self._txDepth += 1
+        except:
+            self._lock.release()
+            raise
+
+
+    def endExclusive(self, commit=True):
+        """Finish a transaction started by beginExclusive()."""
+        try:
+            self._txDepth -= 1
+            if self._txDepth == 0:
+                if commit:
+                    self._conn.execute("COMMIT")
+                else:
+                    self._conn.execute("ROLLBACK")
+        finally:
+            self._lock.release()
+
+
+    def _reapExpired(self):
+        """Delete all expired locks. Must be called inside a transaction."""
+        cur = self._conn.execute("DELETE FROM locks WHERE expire >= 0 AND expire < ?",
+                                 (time.time(), ))
+        reaped = max(cur.rowcount, 0)
+        self._reapedCount += reaped
+        return reaped
+
+    
+    def open(self):
+        """Called before first use."""
+        _logger.debug("open(%r)" % self._storagePath)
+        assert self._conn is None
+        # Autocommit mode (isolation_level=None): we issue BEGIN/COMMIT ourselves.
+        # check_same_thread=False: the connection is shared by all request 
+        # threads and serialized by self._lock.
+        self._conn = sqlite3.connect(self._storagePath, 
+                                     timeout=self.BUSY_TIMEOUT,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        # Return (and accept) utf8 encoded str instead of unicode
+        self._conn.text_factory = str
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS locks (
+                                token TEXT PRIMARY KEY,
+                                root TEXT NOT NULL,
+                                type TEXT, 
+                                scope TEXT, 
+                                depth TEXT,
+                                owner TEXT, 
+                                principal TEXT, 
+                                timeout REAL,
+                                expire REAL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS locks_root ON locks(root)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS locks_expire ON locks(expire)")
+        # Purge locks that expired while we were down
+        self.cleanup()
+
+    
+    def close(self):
+        """Called on shutdown."""
+        _logger.debug("close()")
+        self._lock.acquireWrite()
+        try:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        finally:
+            self._lock.release()
+
+    
+    def cleanup(self):
+        """Purge expired locks.
+        
+        Returns the number of purged locks.
+        """
+        self.beginExclusive()
+        try:
+            reaped = self._reapExpired()
+        except:
+            self.endExclusive(False)
+            raise
+        self.endExclusive()
+        return reaped
+
+
+    def getLockCount(self, path=None):
+        """Return the number of stored locks (see LockStorageDict)."""
+        if path is None:
+            sql, args = "SELECT COUNT(*) FROM locks", ()
+        else:
+            seg = getTopSegment(path)
+            if seg:
+                low, high = self._childRange("/" + seg)
+                sql = "SELECT COUNT(*) FROM locks WHERE root = ? OR (root >= ? AND root < ?)"
+                args = ("/" + seg, low, high)
+            else:
+                sql, args = "SELECT COUNT(*) FROM locks WHERE root = '/'", ()
+        self._lock.acquireWrite()
+        try:
+            return self._conn.execute(sql, args).fetchone()[0]
+        finally:
+            self._lock.release()
+
+
+    def hasAffectingLocks(self, path, includeChildren=False):
+        """Return True, if a lock can affect <path> (see LockStorageDict)."""
+        path = normalizeLockRoot(path)
+        # <path> and its ancestors
+        roots = ["/"]
+        for seg in path.strip("/").split("/"):
+            if seg:
+                roots.append(roots[-1].rstrip("/") + "/" + seg)
+        sql = "root IN (%s)" % ", ".join("?" * len(roots))
+        args = roots
+        if includeChildren:
+            sql += " OR (root >= ? AND root < ?)"
+            args.extend(self._childRange(path))
+        sql = ("SELECT 1 FROM locks WHERE (%s) AND (expire < 0 OR expire >= ?) LIMIT 1" 
+               % sql)
+        args.append(time.time())
+        self._lock.acquireWrite()
+        try:
+            return self._conn.execute(sql, args).fetchone() is not None
+        finally:
+            self._lock.release()
+
+
+    def getStats(self):
+        """Return a dictionary with lock counters (see LockStorageDict)."""
+        self._lock.acquireWrite()
+        try:
+            live = self._conn.execute("SELECT COUNT(*) FROM locks").fetchone()[0]
+            return {"live": live,
+                    "reaped": self._reapedCount,
+                    }
+        finally:
+            self._lock.release()
+
+    
+    def get(self, token):
+        """Return a lock dictionary for a token.
+        
+        If the lock does not exist or is expired, None is returned.
+
+        Side effect: if lock is expired, it will be purged and None is returned.
+        """
+        self._lock.acquireWrite()
+        try:
+            row = self._conn.execute("SELECT %s FROM locks WHERE token = ?" 
+                                     % ", ".join(self._COLUMNS), 
+                                     (token, )).fetchone()
+            if row is None:
+                return None
+            lock = self._rowToLock(row)
+            expire = float(lock["expire"])
+            if expire >= 0 and expire < time.time():
+                _logger.debug("Lock timed-out(%s): %s" % (expire, lockString(lock)))
+                if self.delete(token):
+                    self._reapedCount += 1
+                return None
+            return lock
+        finally:
+            self._lock.release()
+    
+    
+    def create(self, path, lock):
+        """Create a direct lock for a resource path (see LockStorageDict)."""
+        assert lock.get("token") is None
+        assert lock.get("expire") is None, "Use timeout instead of expire"
+        assert path and "/" in path
+
+        org_path = path
+        path = normalizeLockRoot(path)
+        lock["root"] = path
+
+        timeout = lock.get("timeout")
+        if timeout is None:
+            timeout = self.LOCK_TIME_OUT_DEFAULT
+        timeout = float(timeout)
+        if timeout < 0 or timeout > self.LOCK_TIME_OUT_MAX:
+            timeout = self.LOCK_TIME_OUT_MAX     
+        lock["timeout"] = timeout
+        lock["expire"] = time.time() + timeout
+        
+        validateLock(lock)
+        lock["token"] = generateLockToken()
+
+        self.beginExclusive()
+        try:
+            # Purging is a cheap range delete on the expire index
+            self._reapExpired()
+            self._conn.execute("INSERT INTO locks (%s) VALUES (%s)" 
+                               % (", ".join(self._COLUMNS), 
+                                  ", ".join("?" * len(self._COLUMNS))),
+                               [ lock[k] for k in self._COLUMNS ])
+        except:
+            self.endExclusive(False)
+            raise
+        self.endExclusive()
+        _logger.debug("LockStorageSQLite.set(%r): %s" % (org_path, lockString(lock)))
+        return lock
+    
+    
+    def refresh(self, token, timeout):
+        """Modify an existing lock's timeout (see LockStorageDict).
+        
+        Returns:
+            Lock dictionary. 
+            Raises ValueError, if token is invalid. 
+        """
+        assert timeout == -1 or timeout > 0
+        if timeout < 0 or timeout > self.LOCK_TIME_OUT_MAX:
+            timeout = self.LOCK_TIME_OUT_MAX
+
+        self.beginExclusive()
+        try:
+            expire = time.time() + timeout
+            cur = self._conn.execute("UPDATE locks SET timeout = ?, expire = ? WHERE token = ?",
+                                     (timeout, expire, token))
+            if cur.rowcount < 1:
+                raise ValueError("Lock must exist: %s" % token)
+            row = self._conn.execute("SELECT %s FROM locks WHERE token = ?" 
+                                     % ", ".join(self._COLUMNS), 
+                                     (token, )).fetchone()
+        except:
+            self.endExclusive(False)
+            raise
+        self.endExclusive()
+        return self._rowToLock(row)
+
+    
+    def delete(self, token):
+        """Delete lock.
+        
+        Returns True on success. False, if token does not exist, or is expired.
+        """
+        self.beginExclusive()
+        try:
+            cur = self._conn.execute("DELETE FROM locks WHERE token = ?", (token, ))
+        except:
+            self.endExclusive(False)
+            raise
+        self.endExclusive()
+        return cur.rowcount > 0
+    
+    
+    def getLockList(self, path, includeRoot, includeChildren, tokenOnly):
+        """Return a list of direct locks for <path> (see LockStorageDict).
+
+        Expired locks are *not* returned (but may be purged later).
+        """
+        assert path and path.startswith("/")
+        assert includeRoot or includeChildren
+        path = normalizeLockRoot(path)
+        where = []
+        args = []
+        if includeRoot:
+            where.append("root = ?")
+            args.append(path)
+        if includeChildren:
+            # The range for "/" contains "/" itself
+            where.append("(root >= ? AND root < ? AND root <> ?)")
+            args.extend(self._childRange(path))
+            args.append(path)
+        if tokenOnly:
+            cols = ("token", )
+        else:
+            cols = self._COLUMNS
+        sql = ("SELECT %s FROM locks WHERE (%s) AND (expire < 0 OR expire >= ?)" 
+               % (", ".join(cols), " OR ".join(where)))
+        args.append(time.time())
+
+        self._lock.acquireWrite()
+        try:
+            rows = self._conn.execute(sql, args).fetchall()
+        finally:
+            self._lock.release()        
+        if tokenOnly:
+            return [ row[0] for row in rows ]
+        return [ self._rowToLock(row) for row in rows ]
+    
+
 #===============================================================================
 # test
 #===============================================================================
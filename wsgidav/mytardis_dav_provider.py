@@ -15,8 +15,12 @@ See `Developers info`_ for more information about the WsgiDAV architecture.
 
 .. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html  
 """
-from wsgidav.dav_error import DAVError, HTTP_FORBIDDEN
+from wsgidav.dav_error import DAVError, HTTP_FORBIDDEN, HTTP_NOT_FOUND
 from wsgidav.dav_provider import DAVProvider, DAVCollection, DAVNonCollection
+from wsgidav.stat_cache import StatCache
+from wsgidav.content_cache import ContentCache
+from wsgidav.file_handle_cache import FileHandleCache
+from wsgidav import page_cache
 
 import util
 import os
@@ -48,13 +52,33 @@ class FileResource(DAVNonCollection):
 
     See also _DAVResource, DAVNonCollection, and FilesystemProvider.
     """
-    def __init__(self, path, environ, filePath):
+    __slots__ = ("_filePath", "_filestat", "_name")
+
+    def __init__(self, path, environ, filePath, filestat=None):
         super(FileResource, self).__init__(path, environ)
         self._filePath = filePath
-        self.filestat = os.stat(self._filePath)
-        # Setting the name from the file path should fix the case on Windows
-        self.name = os.path.basename(self._filePath)
-        self.name = self.name.encode("utf8")
+        # Metadata is loaded on first access, so listings that only need the
+        # href (e.g. PROPFIND propname, lock checks) don't stat the file
+        self._filestat = filestat
+        self._name = None
+
+    def _getFilestat(self):
+        if self._filestat is None:
+            self._filestat = self.provider.statCache.stat(self._filePath,
+                                                          self.environ)
+            if self._filestat is None:
+                raise DAVError(HTTP_NOT_FOUND)
+        return self._filestat
+    filestat = property(_getFilestat)
+
+    def _getName(self):
+        if self._name is None:
+            # Setting the name from the file path should fix the case on Windows
+            self._name = os.path.basename(self._filePath).encode("utf8")
+        return self._name
+    def _setName(self, name):
+        self._name = name
+    name = property(_getName, _setName)
 
     # Getter methods for standard live properties     
     def getContentLength(self):
@@ -69,7 +93,7 @@ class FileResource(DAVNonCollection):
     def getDisplayName(self):
         return self.name
     def getEtag(self):
-        return util.getETag(self._filePath)
+        return util.getETag(self._filePath, self.filestat)
     def getLastModified(self):
         return self.filestat[stat.ST_MTIME]
     def supportEtag(self):
@@ -89,9 +113,33 @@ class FileResource(DAVNonCollection):
 #        mime = self.getContentType()
 #        if mime.startswith("text"):
 #            return file(self._filePath, "r", BUFFER_SIZE)
-        return file(self._filePath, "rb", BUFFER_SIZE)
+        contentCache = self.provider.contentCache
+        if contentCache is not None:
+            # Small files are served from memory
+            fileobj = contentCache.getContent(self._filePath, self.filestat)
+            if fileobj is not None:
+                return fileobj
+        fileHandleCache = self.provider.fileHandleCache
+        if fileHandleCache is not None:
+            # Reuse open file descriptors (e.g. for sequential range requests)
+            return fileHandleCache.open(self._filePath, self.filestat)
+        fileobj = file(self._filePath, "rb", BUFFER_SIZE)
+        if self.filestat[stat.ST_SIZE] > page_cache.MIN_STREAM_SIZE:
+            # The descriptor is not shared: let the kernel read ahead in
+            # larger windows (RequestServer adds hints for the sent range)
+            page_cache.fadvise(fileobj.fileno(), 0, 0,
+                               page_cache.POSIX_FADV_SEQUENTIAL)
+        return fileobj
    
 
+    def getFilePath(self):
+        """Return the path of the file in the local file system.
+         
+        See DAVNonCollection.getFilePath()
+        """
+        return self._filePath
+
+
     def beginWrite(self, contentType=None):
         """Open content as a stream for writing.
          
@@ -136,13 +184,40 @@ class FolderResource(DAVCollection):
 
     See also _DAVResource, DAVCollection, and FilesystemProvider.
     """
-    def __init__(self, path, environ, filePath):
+    __slots__ = ("_filePath", "_filestat", "_name", "_memberTypes")
+
+    def __init__(self, path, environ, filePath, filestat=None):
         super(FolderResource, self).__init__(path, environ)
         self._filePath = filePath
 #        self._dict = None
-        self.filestat = os.stat(self._filePath)
+        # Metadata is loaded on first access (see FileResource)
+        self._filestat = filestat
+        self._name = None
+        # Member name -> True for folders (set by getMemberNames())
+        self._memberTypes = {}
+
+    def _getFilestat(self):
+        if self._filestat is None:
+            self._filestat = self.provider.statCache.stat(self._filePath,
+                                                          self.environ)
+            if self._filestat is None:
+                raise DAVError(HTTP_NOT_FOUND)
+        return self._filestat
+    filestat = property(_getFilestat)
+
+    def _getName(self):
+        if self._name is None:
+            self._computeName()
+        return self._name
+    def _setName(self, name):
+        self._name = name
+    name = property(_getName, _setName)
+
+    def _computeName(self):
+        """Set the display name (including the experiment title or dataset
+        description, which are queried from the database)."""
         # Setting the name from the file path should fix the case on Windows
-        self.name = os.path.basename(self._filePath)
+        name = os.path.basename(self._filePath)
 
         #print "path = " + path
         #print "self.path = " + self.path
@@ -150,20 +225,20 @@ class FolderResource(DAVCollection):
         pathComponents = self.path.strip("/").split("/")
         #print "pathComponents[0] = " + pathComponents[0]
         #print "self.name = " + self.name
-        if self.name==pathComponents[0].split(" - ")[0]:
+        if name==pathComponents[0].split(" - ")[0]:
             #print "self.name==pathComponents[0].split(\" - \")[0]"
-            experiment_id = self.name
-            self.name = experiment_id + " - " + getExperimentTitleFromId(experiment_id)
+            experiment_id = name
+            name = experiment_id + " - " + getExperimentTitleFromId(experiment_id)
             #print "self.name = " + self.name
-        elif len(pathComponents)>=2 and self.name==pathComponents[1].split(" - ")[0]:
+        elif len(pathComponents)>=2 and name==pathComponents[1].split(" - ")[0]:
             #print "self.name==pathComponents[1].split(\" - \")[0]"
-            dataset_id = self.name
-            self.name = dataset_id + " - " + getDatasetDescriptionFromId(dataset_id) 
+            dataset_id = name
+            name = dataset_id + " - " + getDatasetDescriptionFromId(dataset_id) 
             #print "self.name = " + self.name
         #else:
             #print "self.name != pathComponents[0].split(\" - \")[0] and self.name!=pathComponents[1].split(\" - \")[0]"
 
-        self.name = self.name.encode("utf8")
+        self._name = name.encode("utf8")
         
 
     # Getter methods for standard live properties     
@@ -196,15 +271,14 @@ class FolderResource(DAVCollection):
         pathComponents = self.environ['PATH_INFO'].strip("/").split("/")
 
         nameList = []
-        # self._filePath is unicode, so os.listdir returns unicode as well
+        self._memberTypes = {}
+        # self._filePath is unicode, so listDir returns unicode as well
         assert isinstance(self._filePath, unicode) 
-        for name in os.listdir(self._filePath):
+        # Non files (mount points, ...) are skipped. The types are taken from
+        # the directory entries, so members are not stat'ed
+        statCache = self.provider.statCache
+        for name, isDir in statCache.listDir(self._filePath, self.environ):
             assert isinstance(name, unicode)
-            # Skip non files (links and mount points)
-            fp = os.path.join(self._filePath, name)
-            if not os.path.isdir(fp) and not os.path.isfile(fp):
-                _logger.debug("Skipping non-file %s" % fp)
-                continue
             # If browsing the root directory of the share, i.e.
             # /opt/mytardis/current/var/store/
             # then only display experiment folders, belonging 
@@ -226,30 +300,65 @@ class FolderResource(DAVCollection):
                         continue
             name = name.encode("utf8")
             nameList.append(name)
+            self._memberTypes[name] = isDir
         return nameList
 
+    def _getMemberFilePath(self, name):
+        pathComponents = self.path.strip("/").split("/")
+        if len(pathComponents)<=1:
+            return os.path.join(self._filePath, name.split(" - ")[0].decode("utf8"))
+        return os.path.join(self._filePath, name.decode("utf8"))
+
     def getMember(self, name):
         """Return direct collection member (DAVResource or derived).
         
         See DAVCollection.getMember()
         """
 
-        pathComponents = self.path.strip("/").split("/")
-        if len(pathComponents)<=1:
-            fp = os.path.join(self._filePath, name.split(" - ")[0].decode("utf8"))
-        else:
-            fp = os.path.join(self._filePath, name.decode("utf8"))
+        fp = self._getMemberFilePath(name)
         name = name.encode("utf8")
         path = util.joinUri(self.path, name)
-        if os.path.isdir(fp):
-            res = FolderResource(path, self.environ, fp)
-        elif os.path.isfile(fp):
-            res = FileResource(path, self.environ, fp)
+        isDir = self._memberTypes.get(name)
+        st = None
+        if isDir is None:
+            st = self.provider.statCache.stat(fp, self.environ)
+            if st is not None and stat.S_ISDIR(st.st_mode):
+                isDir = True
+            elif st is not None and stat.S_ISREG(st.st_mode):
+                isDir = False
+        if isDir is True:
+            res = FolderResource(path, self.environ, fp, st)
+        elif isDir is False:
+            res = FileResource(path, self.environ, fp, st)
         else:
             _logger.debug("Skipping non-file %s" % fp)
             res = None
         return res
 
+    def getMemberList(self):
+        """Return list of direct collection members (DAVResource or derived).
+
+        Members are stat'ed concurrently, if the provider was created with
+        prefetchThreads. The files of a dataset are prefetched into the page
+        cache, if the provider was created with listingPrefetchSize.
+
+        See DAVCollection.getMemberList()
+        """
+        names = self.getMemberNames()
+        self.provider.statCache.prefetch(
+            [self._getMemberFilePath(name) for name in names], self.environ)
+        memberList = []
+        for name in names:
+            member = self.getMember(name)
+            assert member is not None
+            memberList.append(member)
+        filePrefetcher = self.provider.filePrefetcher
+        # Experiment folders only contain datasets
+        if filePrefetcher is not None and len(self.path.strip("/").split("/")) >= 2:
+            filePrefetcher.prefetch([ m.getFilePath() for m in memberList 
+                                      if not m.isCollection ])
+        return memberList
+
 
 
     # --- Read / write ---------------------------------------------------------
@@ -302,12 +411,42 @@ class FolderResource(DAVCollection):
 #===============================================================================
 class MyTardisProvider(DAVProvider):
 
-    def __init__(self, rootFolderPath, readonly=False):
+    def __init__(self, rootFolderPath, readonly=False, statCacheTtl=0,
+                 prefetchThreads=0, prefetchThreadsPerRequest=4,
+                 contentCacheSize=0, contentCacheMaxFileSize=64*1024,
+                 fileHandleCacheSize=0, fileHandleTimeout=30,
+                 dropBehindSize=0, listingPrefetchSize=0):
         if not rootFolderPath or not os.path.exists(rootFolderPath):
             raise ValueError("Invalid root path: %s" % rootFolderPath)
         super(MyTardisProvider, self).__init__()
         self.rootFolderPath = os.path.abspath(rootFolderPath)
         self.readonly = readonly
+        # Stat results are memoized per request, and shared across requests
+        # for statCacheTtl seconds. Folder members are stat'ed by up to
+        # prefetchThreads threads (0: sequentially)
+        self.statCache = StatCache(ttl=statCacheTtl,
+                                   prefetchThreads=prefetchThreads,
+                                   prefetchThreadsPerRequest=prefetchThreadsPerRequest)
+        # Contents of files up to contentCacheMaxFileSize bytes are kept in
+        # memory (max. contentCacheSize bytes; 0: disabled)
+        self.contentCache = None
+        if contentCacheSize:
+            self.contentCache = ContentCache(contentCacheSize,
+                                             contentCacheMaxFileSize)
+        # Up to fileHandleCacheSize files are kept open for reading, until
+        # they were not used for fileHandleTimeout seconds (0: disabled)
+        self.fileHandleCache = None
+        if fileHandleCacheSize:
+            self.fileHandleCache = FileHandleCache(fileHandleCacheSize,
+                                                   fileHandleTimeout)
+        # Pages of files larger than dropBehindSize bytes are dropped from the
+        # page cache, after they were sent (0: disabled)
+        self.dropBehindSize = dropBehindSize
+        # The first listingPrefetchSize bytes of the files in a dataset are
+        # read into the page cache, when the dataset is listed (0: disabled)
+        self.filePrefetcher = None
+        if listingPrefetchSize:
+            self.filePrefetcher = page_cache.FilePrefetcher(listingPrefetchSize)
 
         
     def __repr__(self):
@@ -332,6 +471,22 @@ class MyTardisProvider(DAVProvider):
 #        print "_locToFilePath(%s): %s" % (path, r)
         return r  
 
+
+    def invalidateResourceCache(self, environ, path=None):
+        """Discard memoized resources and stat results for path.
+
+        See DAVProvider.invalidateResourceCache()
+        """
+        super(MyTardisProvider, self).invalidateResourceCache(environ, path)
+        filePath = None
+        if path is not None:
+            filePath = self._locToFilePath(path)
+        self.statCache.invalidate(filePath, environ)
+        if self.contentCache is not None:
+            self.contentCache.invalidate(filePath)
+        if self.fileHandleCache is not None:
+            self.fileHandleCache.invalidate(filePath)
+
     
     def getResourceInst(self, path, environ):
         """Return info dictionary for path.
@@ -349,12 +504,13 @@ class MyTardisProvider(DAVProvider):
 
         self._count_getResourceInst += 1
         fp = self._locToFilePath(path)
-        if not os.path.exists(fp):
+        st = self.statCache.stat(fp, environ)
+        if st is None:
             return None
 
-        if os.path.isdir(fp):
-            return FolderResource(path, environ, fp)
-        return FileResource(path, environ, fp)
+        if stat.S_ISDIR(st.st_mode):
+            return FolderResource(path, environ, fp, st)
+        return FileResource(path, environ, fp, st)
 
 def getExperimentIDs(webdav_username):
 
@@ -0,0 +1,262 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Page cache hints (posix_fadvise()) for streamed files.
+
+Large GET responses are read sequentially, and most of them are not read
+again soon. Without hints, the kernel reads ahead in small windows, and keeps
+the pages of a multi-GB download in memory, evicting pages of small files, that
+are requested often (which is expensive on network file systems).
+
+`StreamAdvisor` is used by RequestServer while a file range is streamed (or
+sent with sendfile()). It requests the next `READAHEAD_WINDOW` bytes with
+POSIX_FADV_WILLNEED, and optionally drops the pages behind the current
+position with POSIX_FADV_DONTNEED. FilesystemProvider and MyTardisProvider
+enable dropping for files larger than `dropBehindSize` bytes.
+
+`FilePrefetcher` reads the beginning of files into the page cache in a
+background thread. MyTardisProvider uses it for the files of a listed dataset
+(see `listingPrefetchSize`), because clients usually open some of them next.
+
+os.posix_fadvise() is used, if available (Python 3.3+), otherwise
+posix_fadvise64() is called through ctypes on Linux. On other platforms no
+hints are given (FilePrefetcher reads the data instead).
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html
+"""
+from wsgidav import util
+import ctypes
+import ctypes.util
+import os
+import sys
+import threading
+import Queue
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+# Advice values (Linux)
+POSIX_FADV_NORMAL = 0
+POSIX_FADV_RANDOM = 1
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# Number of bytes that are requested ahead of the current position
+READAHEAD_WINDOW = 4 * 1024 * 1024
+# Ranges up to this size are left to the kernel's read-ahead
+MIN_STREAM_SIZE = 256 * 1024
+
+
+def _loadFadvise():
+    """Return posix_fadvise(fd, offset, length, advice), or None if not available."""
+    if hasattr(os, "posix_fadvise"):
+        return os.posix_fadvise
+    libName = ctypes.util.find_library("c")
+    if not sys.platform.startswith("linux") or not libName:
+        return None
+    libc = ctypes.CDLL(libName, use_errno=True)
+    if not hasattr(libc, "posix_fadvise64"):
+        return None
+    libc.posix_fadvise64.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                     ctypes.c_int64, ctypes.c_int]
+    libc.posix_fadvise64.restype = ctypes.c_int
+
+    def _fadvise(fd, offset, length, advice):
+        # Returns the error number (errno is not set)
+        e = libc.posix_fadvise64(fd, offset, length, advice)
+        if e != 0:
+            raise OSError(e, os.strerror(e))
+    return _fadvise
+
+try:
+    _fadvise = _loadFadvise()
+except OSError:
+    _fadvise = None
+
+
+def isAvailable():
+    """Return True, if posix_fadvise() is available on this platform."""
+    return _fadvise is not None
+
+
+def fadvise(fd, offset, length, advice):
+    """Give the kernel an access hint for a range of fd (length 0: up to EOF).
+
+    Returns False, if the hint was not applied (hints are never required, so
+    errors are only logged).
+    """
+    if _fadvise is None:
+        return False
+    try:
+        _fadvise(fd, offset, length, advice)
+    except OSError, e:
+        _logger.debug("posix_fadvise(%s, %s, %s, %s) failed: %s"
+                      % (fd, offset, length, advice, e))
+        return False
+    return True
+
+
+
+#===============================================================================
+# StreamAdvisor
+#===============================================================================
+class StreamAdvisor(object):
+    """
+    Read-ahead and drop-behind hints for a file, that is read sequentially.
+
+    fd:
+        File descriptor of the streamed file.
+    dropBehind:
+        Drop the pages, that were read, from the page cache (POSIX_FADV_DONTNEED).
+    window:
+        Number of bytes that are requested ahead of the current position
+        (POSIX_FADV_WILLNEED), and dropped behind it at once.
+
+    Call begin() before a range is read, update() with the current position,
+    and end() when the range is done. Ranges up to `MIN_STREAM_SIZE` get no
+    hints.
+    """
+    def __init__(self, fd, dropBehind=False, window=READAHEAD_WINDOW):
+        self.fd = fd
+        self.dropBehind = dropBehind
+        self.window = window
+        self._active = False
+        self._end = 0
+        self._advisedTo = 0
+        self._droppedTo = 0
+
+
+    def __repr__(self):
+        return "StreamAdvisor(fd=%s, dropBehind=%s)" % (self.fd, self.dropBehind)
+
+
+    @classmethod
+    def forFile(cls, fileobj, dropBehind=False, window=READAHEAD_WINDOW):
+        """Return a StreamAdvisor for fileobj, or None if no hints can be given
+        (e.g. no posix_fadvise(), or not a real file)."""
+        if _fadvise is None:
+            return None
+        try:
+            fd = fileobj.fileno()
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+        return cls(fd, dropBehind, window)
+
+
+    def begin(self, offset, length=None):
+        """Start a range of length bytes (None: up to EOF) at offset."""
+        if length is None or length < 0:
+            length = max(0, os.fstat(self.fd).st_size - offset)
+        self._active = length > MIN_STREAM_SIZE
+        self._end = offset + length
+        self._advisedTo = self._droppedTo = offset
+        if self._active:
+            self.update(offset)
+
+
+    def update(self, pos):
+        """Request the next window, and drop the pages before pos, if enabled."""
+        if not self._active:
+            return
+        if self._advisedTo < self._end and pos + self.window // 2 >= self._advisedTo:
+            start = max(pos, self._advisedTo)
+            length = min(self.window, self._end - start)
+            fadvise(self.fd, start, length, POSIX_FADV_WILLNEED)
+            self._advisedTo = start + length
+        if self.dropBehind and pos - self._droppedTo >= self.window:
+            fadvise(self.fd, self._droppedTo, pos - self._droppedTo,
+                    POSIX_FADV_DONTNEED)
+            self._droppedTo = pos
+
+
+    def end(self, pos):
+        """Finish the range at pos (drop the remaining pages, if enabled)."""
+        if self._active and self.dropBehind and pos > self._droppedTo:
+            fadvise(self.fd, self._droppedTo, pos - self._droppedTo,
+                    POSIX_FADV_DONTNEED)
+            self._droppedTo = pos
+        self._active = False
+
+
+
+#===============================================================================
+# FilePrefetcher
+#===============================================================================
+class FilePrefetcher(object):
+    """
+    Read the beginning of files into the page cache in a background thread.
+
+    maxBytes:
+        Number of bytes that are prefetched per file.
+    maxQueue:
+        Max. number of pending files (more are discarded, so a large listing
+        cannot delay the prefetching of the next one for long).
+    """
+    def __init__(self, maxBytes=1024*1024, maxQueue=1000):
+        self.maxBytes = maxBytes
+        self._queue = Queue.Queue(maxQueue)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._count_prefetched = 0
+        self._count_discarded = 0
+
+
+    def __repr__(self):
+        return "FilePrefetcher(%s bytes, %s pending)" % (self.maxBytes,
+                                                        self._queue.qsize())
+
+
+    def getStats(self):
+        """Return dictionary with prefetch statistics."""
+        return {"pending": self._queue.qsize(),
+                "prefetched": self._count_prefetched,
+                "discarded": self._count_discarded,
+                }
+
+
+    def prefetch(self, filePaths):
+        """Queue filePaths for prefetching (returns immediately)."""
+        for filePath in filePaths:
+            try:
+                self._queue.put_nowait(filePath)
+            except Queue.Full:
+                self._count_discarded += 1
+        self._lock.acquire()
+        try:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="FilePrefetcher")
+                self._thread.setDaemon(True)
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+
+    def _run(self):
+        while True:
+            filePath = self._queue.get()
+            try:
+                self._prefetchFile(filePath)
+                self._count_prefetched += 1
+            except (IOError, OSError), e:
+                _logger.debug("Could not prefetch %r: %s" % (filePath, e))
+
+
+    def _prefetchFile(self, filePath):
+        fd = os.open(filePath, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        try:
+            if fadvise(fd, 0, self.maxBytes, POSIX_FADV_WILLNEED):
+                return
+            # No hints: read the data, so it is in the page cache
+            remaining = self.maxBytes
+            while remaining > 0:
+                data = os.read(fd, min(remaining, 64 * 1024))
+                if not data:
+                    break
+                remaining -= len(data)
+        finally:
+            os.close(fd)
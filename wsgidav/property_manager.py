@@ -2,8 +2,9 @@
 # Original PyFileServer (c) 2005 Ho Chun Wei.
 # Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
 """
-Implements two property managers: one in-memory (dict-based), and one 
-persistent low performance variant using shelve.
+Implements three property managers: one in-memory (dict-based), one 
+persistent low performance variant using shelve, and a persistent variant 
+using SQLite that may be shared by multiple processes.
 
 The properties dictionaray is built like::
 
@@ -23,7 +24,10 @@ from wsgidav import util
 import os
 import sys
 import shelve
-from rw_lock import ReadWriteLock
+import sqlite3
+import threading
+from striped_lock import StripedReadWriteLock
+from write_behind import WriteBehindShelf
 
 # TODO: comment's from Ian Bicking (2005)
 #@@: Use of shelve means this is only really useful in a threaded environment.
@@ -51,12 +55,24 @@ class PropertyManager(object):
     An in-memory property manager implementation using a dictionary.
     
     This is obviously not persistent, but should be enough in some cases.
-    For a persistent implementation, see property_manager.ShelvePropertyManager().
+    For persistent implementations, see property_manager.ShelvePropertyManager()
+    and property_manager.SQLitePropertyManager().
+
+    R/W access is guarded by a StripedReadWriteLock, so requests for 
+    different top-level folders don't block each other (see striped_lock for
+    the rules).
+
+    copyProperties() and removeProperties() accept `withChildren`, to process
+    a sub tree with one call (SUBTREE_OPERATIONS). RequestServer uses this for
+    COPY and DELETE of collections.
     """
+    STRIPE_COUNT = 16
+    SUBTREE_OPERATIONS = True # copy/removeProperties() accept withChildren
+
     def __init__(self):
         self._dict = None
         self._loaded = False      
-        self._lock = ReadWriteLock()
+        self._lock = StripedReadWriteLock(self.STRIPE_COUNT)
         self._verbose = 2
 
 
@@ -74,6 +90,9 @@ class PropertyManager(object):
         _logger.debug("_lazyOpen()")
         self._lock.acquireWrite()
         try:
+            # Test again within the critical section
+            if self._loaded:
+                return
             self._dict = {}
             self._loaded = True
         finally:
@@ -137,25 +156,26 @@ class PropertyManager(object):
 
     def getProperties(self, normurl):
         _logger.debug("getProperties(%s)" % normurl)
-        self._lock.acquireRead()
+        # Open before acquiring the stripe (opening needs all stripes)
+        if not self._loaded:
+            self._lazyOpen()        
+        self._lock.acquireRead(normurl)
         try:
-            if not self._loaded:
-                self._lazyOpen()        
             returnlist = []
             if normurl in self._dict:
                 for propdata in self._dict[normurl].keys():
                     returnlist.append(propdata)
             return returnlist
         finally:
-            self._lock.release()
+            self._lock.release(normurl)
 
 
     def getProperty(self, normurl, propname):
         _logger.debug("getProperty(%s, %s)" % (normurl, propname))
-        self._lock.acquireRead()
+        if not self._loaded:
+            self._lazyOpen()
+        self._lock.acquireRead(normurl)
         try:
-            if not self._loaded:
-                self._lazyOpen()
             if normurl not in self._dict:
                 return None
             # TODO: sometimes we get exceptions here: (catch or otherwise make more robust?)
@@ -166,7 +186,7 @@ class PropertyManager(object):
                 raise
             return resourceprops.get(propname)
         finally:
-            self._lock.release()
+            self._lock.release(normurl)
 
 
     def writeProperty(self, normurl, propname, propertyvalue, dryRun=False):
@@ -179,10 +199,10 @@ class PropertyManager(object):
         if dryRun:
             return  # TODO: can we check anything here?
         
-        self._lock.acquireWrite()
+        if not self._loaded:
+            self._lazyOpen()
+        self._lock.acquireWrite(normurl)
         try:
-            if not self._loaded:
-                self._lazyOpen()
             if normurl in self._dict:
                 locatordict = self._dict[normurl] 
             else:
@@ -194,7 +214,7 @@ class PropertyManager(object):
             if __debug__ and self._verbose >= 2:
                 self._check()         
         finally:
-            self._lock.release()
+            self._lock.release(normurl)
 
 
     def removeProperty(self, normurl, propname, dryRun=False):
@@ -205,10 +225,10 @@ class PropertyManager(object):
         if dryRun:
             # TODO: can we check anything here?
             return  
-        self._lock.acquireWrite()
+        if not self._loaded:
+            self._lazyOpen()
+        self._lock.acquireWrite(normurl)
         try:
-            if not self._loaded:
-                self._lazyOpen()
             if normurl in self._dict:      
                 locatordict = self._dict[normurl] 
                 if propname in locatordict:
@@ -219,47 +239,75 @@ class PropertyManager(object):
             if __debug__ and self._verbose >= 2:
                 self._check()         
         finally:
-            self._lock.release()         
+            self._lock.release(normurl)         
 
 
-    def removeProperties(self, normurl):
-        _logger.debug("removeProperties(%s)" % normurl)
-        self._lock.acquireWrite()
+    def removeProperties(self, normurl, withChildren=False):
+        _logger.debug("removeProperties(%s, %s)" % (normurl, withChildren))
+        if not self._loaded:
+            self._lazyOpen()
+        # Members of the root folder may live in any stripe 
+        if withChildren and normurl.strip("/") == "":
+            stripePaths = ()
+        else:
+            stripePaths = (normurl, )
+        self._lock.acquireWrite(*stripePaths)
         try:
-            if not self._loaded:
-                self._lazyOpen()
-            if normurl in self._dict:      
-                del self._dict[normurl] 
+            if withChildren:
+                urls = [ url for url in self._dict.keys() 
+                         if util.isEqualOrChildUri(normurl, url) ]
+            else:
+                urls = [ url for url in (normurl, ) if url in self._dict ]
+            for url in urls:
+                del self._dict[url] 
+            if urls:
                 self._sync()
         finally:
-            self._lock.release()         
+            self._lock.release(*stripePaths)         
 
 
-    def copyProperties(self, srcurl, desturl):
-        _logger.debug("copyProperties(%s, %s)" % (srcurl, desturl))
-        self._lock.acquireWrite()
+    def copyProperties(self, srcurl, desturl, withChildren=False):
+        _logger.debug("copyProperties(%s, %s, %s)" % (srcurl, desturl, withChildren))
+        if not self._loaded:
+            self._lazyOpen()
+        if withChildren and srcurl.strip("/") == "":
+            stripePaths = ()
+        else:
+            stripePaths = (srcurl, desturl)
+        self._lock.acquireWrite(*stripePaths)
         try:
             if __debug__ and self._verbose >= 2:
                 self._check()         
-            if not self._loaded:
-                self._lazyOpen()
-            if srcurl in self._dict:      
+            if withChildren:
+                # Copy srcurl\*
+                base = srcurl.rstrip("/")
+                for url in self._dict.keys():
+                    if util.isEqualOrChildUri(srcurl, url):
+                        d = desturl.rstrip("/") + url[len(base):]
+                        self._dict[d] = self._dict[url].copy()
+                self._sync()
+            elif srcurl in self._dict:      
                 self._dict[desturl] = self._dict[srcurl].copy() 
                 self._sync()
             if __debug__ and self._verbose >= 2:
                 self._check("after copy")         
         finally:
-            self._lock.release()         
+            self._lock.release(*stripePaths)         
 
 
     def moveProperties(self, srcurl, desturl, withChildren):
         _logger.debug("moveProperties(%s, %s, %s)" % (srcurl, desturl, withChildren))
-        self._lock.acquireWrite()
+        if not self._loaded:
+            self._lazyOpen()
+        # Members of the root folder may live in any stripe 
+        if withChildren and srcurl.strip("/") == "":
+            stripePaths = ()
+        else:
+            stripePaths = (srcurl, desturl)
+        self._lock.acquireWrite(*stripePaths)
         try:
             if __debug__ and self._verbose >= 2:
                 self._check()         
-            if not self._loaded:
-                self._lazyOpen()
             if withChildren:
                 # Move srcurl\*      
                 for url in self._dict.keys():
@@ -276,7 +324,7 @@ class PropertyManager(object):
             if __debug__ and self._verbose >= 2:
                 self._check("after move")         
         finally:
-            self._lock.release()         
+            self._lock.release(*stripePaths)         
 
 
 #===============================================================================
@@ -286,9 +334,18 @@ class PropertyManager(object):
 class ShelvePropertyManager(PropertyManager):
     """
     A low performance property manager implementation using shelve
+    
+    By default, the shelf is synced after every mutation. Pass 
+    flushInterval > 0 to enable write-behind mode (see 
+    write_behind.WriteBehindShelf): mutations are then written after 
+    flushInterval seconds, or when maxDirty mutations are pending.
     """
-    def __init__(self, storagePath):
+    STRIPE_COUNT = 1 # The shelf must not be accessed concurrently
+
+    def __init__(self, storagePath, flushInterval=0, maxDirty=100):
         self._storagePath = os.path.abspath(storagePath)
+        self._flushInterval = flushInterval
+        self._maxDirty = maxDirty
         super(ShelvePropertyManager, self).__init__()
 
 
@@ -307,6 +364,9 @@ class ShelvePropertyManager(PropertyManager):
             # careful to re-assign values to _dict after modifying them
             self._dict = shelve.open(self._storagePath, 
                                      writeback=False)
+            if self._flushInterval > 0:
+                self._dict = WriteBehindShelf(self._dict, self._flushInterval, 
+                                              self._maxDirty)
             self._loaded = True
             if __debug__ and self._verbose >= 2:
                 self._check("After shelve.open()")
@@ -337,3 +397,307 @@ class ShelvePropertyManager(PropertyManager):
         finally:
             self._lock.release()         
 
+
+
+
+#===============================================================================
+# SQLitePropertyManager
+#===============================================================================
+
+class SQLitePropertyManager(PropertyManager):
+    """
+    A persistent property manager implementation using SQLite.
+    
+    Properties are stored in one table with a (url, propname) primary key.
+    The key index is ordered by url, so it also serves as prefix index: 
+    the members of a sub tree are found by the range 
+    url >= '<base>/' AND url < '<base>0' ('0' is the character after '/').
+    This way moveProperties(withChildren=True) is a single UPDATE statement,
+    and copyProperties() / removeProperties() accept an optional 
+    `withChildren` argument to process a sub tree with one statement as well.
+
+    The database is opened in WAL mode and may be shared by multiple 
+    processes.
+    
+    Writes are group committed: mutations are queued in memory and executed 
+    in one short transaction after `commitBatch` writes, or `commitInterval` 
+    seconds after the first pending write, whichever comes first (and before 
+    reads and on close, so reads see all writes of this process).
+    Other processes see changes after the commit. The database write lock is
+    only held while a group is executed, so they don't wait for the interval.
+    Pass commitInterval=0 to commit every single write.
+    """
+    STRIPE_COUNT = 1      # The connection must not be used concurrently
+    COMMIT_INTERVAL = 0.5 # Max. seconds a write stays uncommitted
+    COMMIT_BATCH = 100    # Max. number of uncommitted writes
+    BUSY_TIMEOUT = 30     # Seconds to wait for a database lock held by other processes
+
+    def __init__(self, storagePath, commitInterval=None, commitBatch=None):
+        self._storagePath = os.path.abspath(storagePath)
+        if commitInterval is None:
+            commitInterval = self.COMMIT_INTERVAL
+        if commitBatch is None:
+            commitBatch = self.COMMIT_BATCH
+        self._commitInterval = commitInterval
+        self._commitBatch = commitBatch
+        self._conn = None
+        # Queued mutations [(sql, args), ...]
+        self._pending = []
+        self._timer = None
+        super(SQLitePropertyManager, self).__init__()
+
+
+    def __repr__(self):
+        return "SQLitePropertyManager(%s)" % self._storagePath
+
+
+    def _subtreeRange(self, url):
+        """Return (base, low, high) for url and its members."""
+        base = url.rstrip("/")
+        return base, base + "/", base + "0"
+        
+
+    def _lazyOpen(self):
+        _logger.debug("_lazyOpen(%s)" % self._storagePath)
+        self._lock.acquireWrite()
+        try:
+            # Test again within the critical section
+            if self._loaded:
+                return True
+            # Autocommit mode (isolation_level=None): we issue BEGIN/COMMIT 
+            # ourselves. The connection is shared by all threads and 
+            # serialized by self._lock.
+            self._conn = sqlite3.connect(self._storagePath, 
+                                         timeout=self.BUSY_TIMEOUT,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            # Return (and accept) utf8 encoded str instead of unicode
+            self._conn.text_factory = str
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS props (
+                                    url TEXT NOT NULL,
+                                    propname TEXT NOT NULL,
+                                    value TEXT,
+                                    PRIMARY KEY (url, propname))""")
+            self._loaded = True
+        finally:
+            self._lock.release()         
+
+
+    def _write(self, sql, args):
+        """Queue a mutation and commit, if the group is complete (write lock 
+        must be held)."""
+        if not self._loaded:
+            self._lazyOpen()
+        self._pending.append((sql, args))
+        if len(self._pending) >= self._commitBatch or self._commitInterval <= 0:
+            self._commit()
+        elif self._timer is None:
+            self._timer = threading.Timer(self._commitInterval, self._onTimer)
+            self._timer.setDaemon(True)
+            self._timer.start()
+
+
+    def _commit(self):
+        """Execute queued mutations in one transaction (write lock must be held)."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending = self._pending
+        self._pending = []
+        _logger.debug("_commit(%s)" % len(pending))
+        try:
+            self._conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError:
+            # Locked by other processes for BUSY_TIMEOUT: keep the queue
+            self._pending[:0] = pending
+            raise
+        try:
+            for sql, args in pending:
+                self._conn.execute(sql, args)
+        except:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+
+    def _onTimer(self):
+        self._lock.acquireWrite()
+        try:
+            self._timer = None
+            self._commit()
+        finally:
+            self._lock.release()         
+
+
+    def _close(self):
+        _logger.debug("_close()")
+        self._lock.acquireWrite()
+        try:
+            if self._loaded:
+                self._commit()
+                self._conn.close()
+                self._conn = None
+                self._loaded = False
+        finally:
+            self._lock.release()         
+
+
+    def _check(self, msg=""):
+        try:
+            if not self._loaded:
+                return True
+            self._lock.acquireWrite()
+            try:
+                res = self._conn.execute("PRAGMA quick_check").fetchone()[0]
+            finally:
+                self._lock.release()         
+            if res != "ok":
+                raise RuntimeError(res)
+            return True
+        except Exception:
+            _logger.exception("%s _check: ERROR %s" % (self.__class__.__name__, msg))
+            return False
+
+
+    def _dump(self, msg="", out=None):
+        if out is None:
+            out = sys.stdout
+        print >>out, "%s(%s): %s" % (self.__class__.__name__, self.__repr__(), msg)
+        if not self._loaded:
+            self._lazyOpen()
+        self._lock.acquireWrite()
+        try:
+            self._commit()
+            url = None
+            for u, name, value in self._conn.execute("SELECT url, propname, value FROM props ORDER BY url"):
+                if u != url:
+                    print >>out, "    ", u
+                    url = u
+                print >>out, "        %s: '%s'" % (name, value)
+            out.flush()
+        except Exception, e:
+            util.warn("SQLitePropertyManager._dump()  ERROR: %s" % e)
+        finally:
+            self._lock.release()
+
+
+    def getProperties(self, normurl):
+        _logger.debug("getProperties(%s)" % normurl)
+        if not self._loaded:
+            self._lazyOpen()        
+        self._lock.acquireWrite()
+        try:
+            self._commit()
+            cur = self._conn.execute("SELECT propname FROM props WHERE url = ?", 
+                                     (normurl, ))
+            return [ row[0] for row in cur ]
+        finally:
+            self._lock.release()
+
+
+    def getProperty(self, normurl, propname):
+        _logger.debug("getProperty(%s, %s)" % (normurl, propname))
+        if not self._loaded:
+            self._lazyOpen()        
+        self._lock.acquireWrite()
+        try:
+            self._commit()
+            row = self._conn.execute("SELECT value FROM props WHERE url = ? AND propname = ?", 
+                                     (normurl, propname)).fetchone()
+            if row is None:
+                return None
+            return row[0]
+        finally:
+            self._lock.release()
+
+
+    def writeProperty(self, normurl, propname, propertyvalue, dryRun=False):
+        assert normurl and normurl.startswith("/")
+        assert propname
+        assert propertyvalue is not None
+        
+        _logger.debug("writeProperty(%s, %s, dryRun=%s):\n\t%s" % (normurl, propname, dryRun, propertyvalue))
+        if dryRun:
+            return
+        
+        self._lock.acquireWrite()
+        try:
+            self._write("INSERT OR REPLACE INTO props (url, propname, value) VALUES (?, ?, ?)",
+                        (normurl, propname, propertyvalue))
+        finally:
+            self._lock.release()
+
+
+    def removeProperty(self, normurl, propname, dryRun=False):
+        """
+        Specifying the removal of a property that does not exist is NOT an error.
+        """
+        _logger.debug("removeProperty(%s, %s, dryRun=%s)" % (normurl, propname, dryRun))
+        if dryRun:
+            return  
+        self._lock.acquireWrite()
+        try:
+            self._write("DELETE FROM props WHERE url = ? AND propname = ?",
+                        (normurl, propname))
+        finally:
+            self._lock.release()         
+
+
+    def removeProperties(self, normurl, withChildren=False):
+        _logger.debug("removeProperties(%s, %s)" % (normurl, withChildren))
+        self._lock.acquireWrite()
+        try:
+            if withChildren:
+                base, low, high = self._subtreeRange(normurl)
+                self._write("""DELETE FROM props 
+                               WHERE url = ? OR (url >= ? AND url < ?)""",
+                            (base, low, high))
+            else:
+                self._write("DELETE FROM props WHERE url = ?", (normurl, ))
+        finally:
+            self._lock.release()         
+
+
+    def copyProperties(self, srcurl, desturl, withChildren=False):
+        _logger.debug("copyProperties(%s, %s, %s)" % (srcurl, desturl, withChildren))
+        self._lock.acquireWrite()
+        try:
+            if withChildren:
+                base, low, high = self._subtreeRange(srcurl)
+                # len() counts bytes of the utf8 encoded URL, so substr() must 
+                # too (it counts characters of TEXT values)
+                self._write("""INSERT OR REPLACE INTO props (url, propname, value)
+                               SELECT ? || substr(CAST(url AS BLOB), ?), propname, value FROM props 
+                               WHERE url = ? OR (url >= ? AND url < ?)""",
+                            (desturl.rstrip("/"), len(base) + 1, 
+                             base, low, high))
+            else:
+                self._write("""INSERT OR REPLACE INTO props (url, propname, value)
+                               SELECT ?, propname, value FROM props WHERE url = ?""",
+                            (desturl, srcurl))
+        finally:
+            self._lock.release()         
+
+
+    def moveProperties(self, srcurl, desturl, withChildren):
+        _logger.debug("moveProperties(%s, %s, %s)" % (srcurl, desturl, withChildren))
+        self._lock.acquireWrite()
+        try:
+            if withChildren:
+                # Move srcurl\* with one statement. Like the dict
+                # implementation, existing destination entries are replaced
+                # (substr() counts bytes, see copyProperties())
+                base, low, high = self._subtreeRange(srcurl)
+                self._write("""UPDATE OR REPLACE props SET url = ? || substr(CAST(url AS BLOB), ?)
+                               WHERE url = ? OR (url >= ? AND url < ?)""",
+                            (desturl.rstrip("/"), len(base) + 1, base, low, high))
+            else:
+                # Move srcurl only
+                self._write("UPDATE OR REPLACE props SET url = ? WHERE url = ?",
+                            (desturl, srcurl))
+        finally:
+            self._lock.release()         
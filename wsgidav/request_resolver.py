@@ -176,8 +176,7 @@ class RequestResolver(object):
                                       ("Server", "DAV/2"),
                                       ("Date", util.getRfc1123Time()),
                                       ])
-            yield ""        
-            return
+            return [""]
    
         provider = environ["wsgidav.provider"]
         if provider is None:
@@ -186,6 +185,4 @@ class RequestResolver(object):
 
         # Let the appropriate resource provider for the realm handle the request
         app = RequestServer(provider)
-        for v in app(environ, start_response):
-            yield v
-        return
+        return app(environ, start_response)
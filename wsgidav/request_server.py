@@ -11,8 +11,13 @@ See `Developers info`_ for more information about the WsgiDAV architecture.
 from urlparse import urlparse
 from wsgidav.dav_error import HTTP_OK, HTTP_LENGTH_REQUIRED
 from wsgidav import xml_tools
+from wsgidav import compression
+from wsgidav.chunked_input import ChunkedInput
+from wsgidav.page_cache import StreamAdvisor
 import util
 import urllib
+import os
+import sys
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -38,7 +43,25 @@ __docformat__ = "reStructuredText"
 
 _logger = util.getModuleLogger(__name__)
 
+# Block size for the first block of a transfer (and for wsgi.file_wrapper)
 BLOCK_SIZE = 8192
+# Blocks grow up to this size in long transfers (see util.iterBlockSizes())
+MAX_BLOCK_SIZE = 1024 * 1024
+# Coalesce requested ranges that are separated by less than this (RFC 7233, 
+# 4.1): about the overhead of an additional multipart/byteranges part
+RANGE_COALESCE_GAP = 128
+# Content without a file descriptor (e.g. from ContentCache) up to this size is
+# returned as one block
+SINGLE_BLOCK_SIZE = 256 * 1024
+
+
+def _hasFileno(fileobj):
+    """Return True, if fileobj is a real file (e.g. not a StringIO)."""
+    try:
+        fileobj.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        return False
+    return True
 
 
 
@@ -89,14 +112,21 @@ class RequestServer(object):
             res = profile.runcall(method, environ, start_response)
             # sort: 0:"calls",1:"time", 2: "cumulative"
             profile.print_stats(sort=2)
-            for v in res:
-                yield v
-            return
+            return res
   
-        for v in method(environ, start_response):
-            yield v
-        return
-#        return method(environ, start_response)
+        # Not iterated here, so a wsgi.file_wrapper is passed to the server
+        return method(environ, start_response)
+
+
+    def _iterBlockSizes(self, environ):
+        """Return an iterator over the block sizes for a GET or PUT transfer.
+        
+        The sizes are configured by the `block_size` option (see 
+        wsgidav.conf).
+        """
+        opts = environ.get("wsgidav.config", {}).get("block_size") or {}
+        return util.iterBlockSizes(opts.get("min", BLOCK_SIZE), 
+                                   opts.get("max", MAX_BLOCK_SIZE))
 
 
     def _fail(self, value, contextinfo=None, srcexception=None, errcondition=None):
@@ -150,6 +180,10 @@ class RequestServer(object):
             return True
 
         refUrl = res.getRefUrl()
+
+        # Fast path: skip If header parsing, if no lock can affect refUrl
+        if hasattr(lockMan, "hasLocks") and not lockMan.hasLocks(refUrl, depth):
+            return True
         
         if "wsgidav.conditions.if" not in environ:
             util.parseIfHeaderDict(environ)
@@ -399,6 +433,7 @@ class RequestServer(object):
         else:
             # Dry-run succeeded: set properties again, this time in 'real' mode
             # In theory, there should be no exceptions thrown here, but this is real live... 
+            self._davProvider.invalidateResourceCache(environ, path)
             for (propname, propvalue) in propupdatelist:
                 try:
                     res.setPropertyValue(propname, propvalue, dryRun=False)
@@ -454,6 +489,7 @@ class RequestServer(object):
         # Check for write permissions on the PARENT
         self._checkWritePermission(parentRes, "0", environ)
 
+        provider.invalidateResourceCache(environ, path)
         parentRes.createCollection(util.getUriName(path))
 
         return util.sendStatusResponse(environ, start_response, HTTP_CREATED)
@@ -516,6 +552,7 @@ class RequestServer(object):
         # Errors in deletion; [ (<ref-url>, <DAVError>), ... ]
         errorList = []  
 
+        provider.invalidateResourceCache(environ, path)
         try:
             handled = res.handleDelete()
             assert handled in (True, False) or type(handled) is list
@@ -558,6 +595,14 @@ class RequestServer(object):
 
         # --- Implement file-by-file processing --------------------------------
         
+        # Dead properties of the tree are removed with one call after the loop,
+        # if the property manager supports it (see removeAllProperties())
+        propMan = provider.propManager
+        subtreeProps = res.isCollection and getattr(propMan, "SUBTREE_OPERATIONS", False)
+        if subtreeProps:
+            environ["wsgidav.subtree_properties"] = True
+        deletedList = []
+
         # Hidden paths (ancestors of failed deletes) {<path>: True, ...}
         ignoreDict = {}  
         for childRes in reverseChildList:
@@ -572,6 +617,8 @@ class RequestServer(object):
                 self._evaluateIfHeaders(childRes, environ)
                 self._checkWritePermission(childRes, "0", environ)
                 childRes.delete()
+                deletedList.append(childRes)
+                provider.invalidateResourceCache(environ, childRes.path)
                 # Double-check, if deletion succeeded
                 if provider.exists(childRes.path, environ):
                     raise DAVError(HTTP_INTERNAL_ERROR, 
@@ -580,6 +627,14 @@ class RequestServer(object):
                 errorList.append( (childRes.getHref(), asDAVError(e)) )
                 ignoreDict[util.getUriParent(childRes.path)] = True
 
+        if subtreeProps:
+            del environ["wsgidav.subtree_properties"]
+            if not errorList:
+                propMan.removeProperties(res.getRefUrl(), withChildren=True)
+            else:
+                for childRes in deletedList:
+                    propMan.removeProperties(childRes.getRefUrl())
+
         # --- Send response ----------------------------------------------------
 
         return self._sendResponse(environ, start_response, 
@@ -600,9 +655,8 @@ class RequestServer(object):
         isnewfile = res is None
 
         ## Test for unsupported stuff
-        if "HTTP_CONTENT_ENCODING" in environ:
-            self._fail(HTTP_NOT_IMPLEMENTED,
-                       "Content-encoding header is not supported.")
+        # gzip and deflate encoded bodies are decoded (415 for other codings)
+        encoding = compression.getRequestEncoding(environ)
         if "HTTP_CONTENT_RANGE" in environ:
             self._fail(HTTP_NOT_IMPLEMENTED,
                        "Content-range header is not supported.")
@@ -616,9 +670,11 @@ class RequestServer(object):
 
         if isnewfile:
             self._checkWritePermission(parentRes, "0", environ)
+            provider.invalidateResourceCache(environ, path)
             res = parentRes.createEmptyResource(util.getUriName(path))
         else:
             self._checkWritePermission(res, "0", environ)
+            provider.invalidateResourceCache(environ, path)
 
         ## Start Content Processing
         # Content-Length may be 0 or greater. (Set to -1 if missing or invalid.) 
@@ -643,68 +699,17 @@ class RequestServer(object):
                            "PUT request with invalid Content-Length: (%s)" % environ.get("CONTENT_LENGTH"))
         
         hasErrors = False
+        blockSizes = self._iterBlockSizes(environ)
         try:      
             fileobj = res.beginWrite(contentType=environ.get("CONTENT_TYPE"))
 
-            if environ.get("HTTP_TRANSFER_ENCODING", "").lower() == "chunked":
-                buf = environ["wsgi.input"].readline()
-                if buf == '':
-                    l = 0
-                else:
-                    l = int(buf, 16)
-
-                environ["wsgidav.some_input_read"] = 1
-                while l > 0:
-                    buf = environ["wsgi.input"].read(l)
-                    fileobj.write(buf)
-                    environ["wsgi.input"].readline()
-                    buf = environ["wsgi.input"].readline()
-                    if buf == '':
-                        l = 0
-                    else:
-                        l = int(buf, 16)
-                environ["wsgidav.all_input_read"] = 1
-                    
-            elif contentlength == 0:
-                # TODO: review this
-                # XP and Vista MiniRedir submit PUT with Content-Length 0, 
-                # before LOCK and the real PUT. So we have to accept this. 
-                _logger.info("PUT: Content-Length == 0. Creating empty file...")
-                
-#            elif contentlength < 0:
-#                # TODO: review this
-#                # If CONTENT_LENGTH is invalid, we may try to workaround this
-#                # by reading until the end of the stream. This may block however!
-#                # The iterator produced small chunks of varying size, but not
-#                # sure, if we always get everything before it times out.
-#                _logger.warning("PUT with invalid Content-Length (%s). Trying to read all (this may timeout)..." % environ.get("CONTENT_LENGTH"))
-#                nb = 0
-#                try:
-#                    for s in environ["wsgi.input"]:
-#                        environ["wsgidav.some_input_read"] = 1
-#                        _logger.debug("PUT: read from wsgi.input.__iter__, len=%s" % len(s))
-#                        fileobj.write(s)
-#                        nb += len (s)
-#                except socket.timeout:
-#                    _logger.warning("PUT: input timed out after writing %s bytes" % nb)
-#                    hasErrors = True                    
-            else:
-                assert contentlength > 0
-                contentremain = contentlength
-                while contentremain > 0:
-                    n = min(contentremain, BLOCK_SIZE)
-                    readbuffer = environ["wsgi.input"].read(n)
-                    # This happens with litmus expect-100 test:
-#                    assert len(readbuffer) > 0, "input.read(%s) returned %s bytes" % (n, len(readbuffer))
-                    if not len(readbuffer) > 0:
-                        util.warn("input.read(%s) returned 0 bytes" % n)
-                        break
-                    environ["wsgidav.some_input_read"] = 1
-                    fileobj.write(readbuffer)
-                    contentremain -= len(readbuffer)
-                
-                if contentremain == 0:
-                    environ["wsgidav.all_input_read"] = 1
+            data = self._iterRequestBody(environ, contentlength, blockSizes)
+            if encoding:
+                # Decompressed with bounded memory (see compression.decodeIter())
+                data = compression.decodeIter(environ, data, encoding, 
+                                              MAX_BLOCK_SIZE)
+            for buf in data:
+                fileobj.write(buf)
                      
             fileobj.close()
 
@@ -720,6 +725,66 @@ class RequestServer(object):
         return util.sendStatusResponse(environ, start_response, HTTP_NO_CONTENT)
 
 
+    def _iterRequestBody(self, environ, contentlength, blockSizes):
+        """Yield the blocks of a PUT request body (still encoded, if a 
+        Content-Encoding was sent).
+        
+        The body is sent with chunked transfer coding or contentlength bytes.
+        blockSizes is an iterator over the block sizes (see _iterBlockSizes()).
+        """
+        if environ.get("HTTP_TRANSFER_ENCODING", "").lower() == "chunked":
+            # Small chunks are coalesced into blocks of the requested size
+            body = ChunkedInput(environ["wsgi.input"])
+            environ["wsgidav.some_input_read"] = 1
+            while True:
+                buf = body.read(blockSizes.next())
+                if not buf:
+                    break
+                yield buf
+            environ["wsgidav.all_input_read"] = 1
+                
+        elif contentlength == 0:
+            # TODO: review this
+            # XP and Vista MiniRedir submit PUT with Content-Length 0, 
+            # before LOCK and the real PUT. So we have to accept this. 
+            _logger.info("PUT: Content-Length == 0. Creating empty file...")
+            
+#        elif contentlength < 0:
+#            # TODO: review this
+#            # If CONTENT_LENGTH is invalid, we may try to workaround this
+#            # by reading until the end of the stream. This may block however!
+#            # The iterator produced small chunks of varying size, but not
+#            # sure, if we always get everything before it times out.
+#            _logger.warning("PUT with invalid Content-Length (%s). Trying to read all (this may timeout)..." % environ.get("CONTENT_LENGTH"))
+#            nb = 0
+#            try:
+#                for s in environ["wsgi.input"]:
+#                    environ["wsgidav.some_input_read"] = 1
+#                    _logger.debug("PUT: read from wsgi.input.__iter__, len=%s" % len(s))
+#                    yield s
+#                    nb += len (s)
+#            except socket.timeout:
+#                _logger.warning("PUT: input timed out after writing %s bytes" % nb)
+#                hasErrors = True                    
+        else:
+            assert contentlength > 0
+            contentremain = contentlength
+            while contentremain > 0:
+                n = min(contentremain, blockSizes.next())
+                readbuffer = environ["wsgi.input"].read(n)
+                # This happens with litmus expect-100 test:
+#                assert len(readbuffer) > 0, "input.read(%s) returned %s bytes" % (n, len(readbuffer))
+                if not len(readbuffer) > 0:
+                    util.warn("input.read(%s) returned 0 bytes" % n)
+                    break
+                environ["wsgidav.some_input_read"] = 1
+                yield readbuffer
+                contentremain -= len(readbuffer)
+            
+            if contentremain == 0:
+                environ["wsgidav.all_input_read"] = 1
+
+
 
 
     def doCOPY(self, environ, start_response):
@@ -855,6 +920,9 @@ class RequestServer(object):
         if destExists:
             successCode = HTTP_NO_CONTENT
 
+        provider.invalidateResourceCache(environ, destPath)
+        if isMove:
+            provider.invalidateResourceCache(environ, srcPath)
         try:
             if isMove:
                 handled = srcRes.handleMove(destPath)
@@ -908,6 +976,7 @@ class RequestServer(object):
                     if not sp in srcPathList:
                         _logger.debug("Remove unmatched dest before copy: %s" % dRes)
                         dRes.delete()
+            provider.invalidateResourceCache(environ, destPath)
         
         # --- Let provider implement recursive move ----------------------------
         # We do this only, if the provider supports it, and no conflicts exist.
@@ -942,6 +1011,16 @@ class RequestServer(object):
         # - the source tree is partially locked
         #   We would have to pass this information to the native provider.  
         
+        # Dead properties of the tree are copied with one call after the loop,
+        # if the property manager supports it (see copyMoveSingle())
+        propMan = provider.propManager
+        subtreeProps = (not isMove and srcRes.isCollection 
+                        and environ["HTTP_DEPTH"] == "infinity"
+                        and getattr(propMan, "SUBTREE_OPERATIONS", False))
+        if subtreeProps:
+            environ["wsgidav.subtree_properties"] = True
+        copiedList = []
+
         # Hidden paths (paths of failed copy/moves) {<src_path>: True, ...}
         ignoreDict = {}
         
@@ -966,6 +1045,7 @@ class RequestServer(object):
                 # Collections are simply created (without members), for
                 # non-collections bytes are copied (overwriting target)
                 sRes.copyMoveSingle(dPath, isMove)
+                copiedList.append( (sRes, dPath) )
                 
                 # If copy succeeded, and it was a non-collection delete it now.
                 # So the source tree shrinks while the destination grows and we 
@@ -983,6 +1063,15 @@ class RequestServer(object):
                 # http://www.webdav.org/specs/rfc4918.html#rfc.section.9.8.5
                 errorList.append( (sRes.getHref(), asDAVError(e)) )
 
+        if subtreeProps:
+            del environ["wsgidav.subtree_properties"]
+            if not errorList:
+                copiedList = [ (srcRes, destPath) ]
+            for sRes, dPath in copiedList:
+                dRes = provider.getResourceInst(dPath, environ)
+                propMan.copyProperties(sRes.getRefUrl(), dRes.getRefUrl(), 
+                                       withChildren=not errorList)
+
         # MOVE: Remove source tree (bottom-up)
         if isMove:
             reverseSrcList = srcList[:]
@@ -1134,6 +1223,7 @@ class RequestServer(object):
             parentRes = provider.getResourceInst(util.getUriParent(path), environ)
             if not parentRes or not parentRes.isCollection:
                 self._fail(HTTP_CONFLICT, "LOCK-0 parent must be a collection")
+            provider.invalidateResourceCache(environ, path)
             res = parentRes.createEmptyResource(util.getUriName(path))
             createdNewResource = True
 
@@ -1329,6 +1419,13 @@ class RequestServer(object):
 
         self._evaluateIfHeaders(res, environ)
 
+        # Let the front-end server send the file, if configured for this share
+        if not isHeadMethod:
+            offloadHeader = self._getFileOffloadHeader(res, environ)
+            if offloadHeader:
+                return self._sendOffloadResponse(res, environ, start_response, 
+                                                 offloadHeader)
+
         filesize = res.getContentLength()
         if filesize is None: 
             filesize = -1 # flag logic to read until EOF
@@ -1353,42 +1450,69 @@ class RequestServer(object):
                 if lastmodified != secstime:
                     doignoreranges = True
             else:
-                # Use as entity tag
+                # Use as entity tag (strong comparison: ranges are never 
+                # compressed, so the tag of a compressed response does not 
+                # match and the full response is sent)
                 ifrange = ifrange.strip("\" ")
                 if entitytag is None or ifrange != entitytag:
                     doignoreranges = True
 
         ispartialranges = False
+        multipartParts = None
         if "HTTP_RANGE" in environ and not doignoreranges:
             ispartialranges = True
-            listRanges, _totallength = util.obtainContentRanges(environ["HTTP_RANGE"], filesize)
+            listRanges, _totallength = util.obtainContentRanges(environ["HTTP_RANGE"], 
+                                                                filesize,
+                                                                RANGE_COALESCE_GAP)
             if len(listRanges) == 0:
                 #No valid ranges present
                 self._fail(HTTP_RANGE_NOT_SATISFIABLE)
 
-            # More than one range present -> take only the first range, since 
-            # multiple range returns require multipart, which is not supported         
-            # obtainContentRanges supports more than one range in case the above 
-            # behaviour changes in future
             (rangestart, rangeend, rangelength) = listRanges[0]
         else:
             (rangestart, rangeend, rangelength) = (0L, filesize - 1, filesize)
 
         ## Content Processing 
         mimetype = res.getContentType()  #provider.getContentType(path)
+        contenttype = mimetype
+
+        if ispartialranges and len(listRanges) > 1:
+            # Several ranges: send multipart/byteranges (RFC 7233, 4.1)
+            contenttype, multipartParts, rangelength = util.getMultipartByteranges(listRanges, 
+                                                                                   filesize, 
+                                                                                   mimetype)
+
+        # Compress text resources, if enabled (not for ranges, which would 
+        # refer to the compressed representation)
+        encoding = None
+        if not ispartialranges and mimetype.startswith("text/"):
+            size = None
+            if filesize >= 0:
+                size = filesize
+            encoding = compression.getContentEncoding(environ, size, isTextGet=True)
+            if encoding and res.supportEtag():
+                entitytag = compression.getEncodedEtag(entitytag, encoding)
 
         responseHeaders = []
-        if res.supportContentLength():
+        if encoding:
+            # The length of the compressed response is not known in advance
+            # (the server sends it chunked, or closes the connection)
+            environ["wsgidav.unsized_response"] = True
+            responseHeaders.append(("Content-Encoding", encoding))
+            responseHeaders.append(("Vary", "Accept-Encoding"))
+        elif res.supportContentLength():
             # Content-length must be of type string (otherwise CherryPy server chokes) 
             responseHeaders.append(("Content-Length", str(rangelength)))
         if res.supportModified():
             responseHeaders.append(("Last-Modified", util.getRfc1123Time(lastmodified)))
-        responseHeaders.append(("Content-Type", mimetype))
+        responseHeaders.append(("Content-Type", contenttype))
         responseHeaders.append(("Date", util.getRfc1123Time()))
         if res.supportEtag():
             responseHeaders.append(("ETag", '"%s"' % entitytag))
  
-        if ispartialranges:
+        if multipartParts:
+            start_response("206 Partial Content", responseHeaders)   
+        elif ispartialranges:
 #            responseHeaders.append(("Content-Ranges", "bytes " + str(rangestart) + "-" + str(rangeend) + "/" + str(rangelength)))
             responseHeaders.append(("Content-Range", "bytes %s-%s/%s" % (rangestart, rangeend, filesize)))
             start_response("206 Partial Content", responseHeaders)   
@@ -1397,25 +1521,178 @@ class RequestServer(object):
 
         # Return empty body for HEAD requests
         if isHeadMethod:
-            yield ""
-            return
+            return [""]
 
         fileobj = res.getContent()
 
         if not doignoreranges:
             fileobj.seek(rangestart)
 
+        if encoding:
+            return compression.gzipIter(environ, 
+                                        self._streamContent(fileobj, rangelength,
+                                                            self._iterBlockSizes(environ)))
+
+        isFile = _hasFileno(fileobj)
+        if not isFile and not multipartParts and 0 <= rangelength <= SINGLE_BLOCK_SIZE:
+            # Probably in memory: don't iterate in blocks
+            try:
+                return [ fileobj.read(rangelength) ]
+            finally:
+                fileobj.close()
+
+        # Read ahead of the client, and drop the pages of large files behind 
+        # it, so they don't evict pages of files that are requested often
+        advisor = None
+        if isFile:
+            dropBehindSize = getattr(self._davProvider, "dropBehindSize", 0)
+            advisor = StreamAdvisor.forFile(fileobj, 
+                                            dropBehindSize > 0 and filesize > dropBehindSize)
+
+        # Let the server send real files with sendfile()
+        fileWrapper = environ.get("wsgi.file_wrapper")
+        if fileWrapper and isFile:
+            kwargs = {}
+            if advisor and getattr(fileWrapper, "acceptsAdvisor", False):
+                kwargs["advisor"] = advisor
+            if multipartParts:
+                if getattr(fileWrapper, "acceptsParts", False):
+                    return fileWrapper(fileobj, BLOCK_SIZE, parts=multipartParts, 
+                                       **kwargs)
+            elif not ispartialranges:
+                return fileWrapper(fileobj, BLOCK_SIZE, **kwargs)
+            elif getattr(fileWrapper, "acceptsLength", False):
+                return fileWrapper(fileobj, BLOCK_SIZE, rangelength, **kwargs)
+
+        blockSizes = self._iterBlockSizes(environ)
+        if multipartParts:
+            return self._streamParts(fileobj, multipartParts, blockSizes, advisor)
+        return self._streamContent(fileobj, rangelength, blockSizes, 
+                                   advisor=advisor)
+
+
+    def _streamParts(self, fileobj, parts, blockSizes, advisor=None):
+        """Yield a body that consists of strings and (offset, length) parts of fileobj."""
+        try:
+            for part in parts:
+                if isinstance(part, str):
+                    yield part
+                else:
+                    offset, length = part
+                    fileobj.seek(offset)
+                    for data in self._streamContent(fileobj, length, blockSizes,
+                                                    close=False, 
+                                                    advisor=advisor):
+                        yield data
+        finally:
+            fileobj.close()
+
+
+    def _getFileOffloadHeader(self, res, environ):
+        """Return (header, value) that lets a front-end server send res.
+
+        Returns None, if `file_offload` is not configured for this share, or 
+        res is not a file in the local file system.
+        
+        Options for the share (see wsgidav.conf):
+        
+        header
+            'X-Accel-Redirect' (nginx, default) or 'X-Sendfile' (Apache 
+            mod_xsendfile, lighttpd).
+        location
+            URI prefix of an internal location, that the front-end server 
+            maps to `root`. If omitted, the value is the absolute file path
+            (URL-quoted for X-Accel-Redirect, since nginx parses it as URI).
+        root
+            Folder that is mapped to `location` (default: the provider's 
+            rootFolderPath).
+        """
+        offloadMap = environ.get("wsgidav.config", {}).get("file_offload")
+        if not offloadMap:
+            return None
+        sharePath = self._davProvider.sharePath or "/"
+        opts = None
+        for share, shareOpts in offloadMap.items():
+            if "/" + share.strip("/") == sharePath:
+                opts = shareOpts
+                break
+        if not opts:
+            return None
+        filePath = res.getFilePath()
+        if filePath is None:
+            return None
+        header = opts.get("header", "X-Accel-Redirect")
+        location = opts.get("location")
+        if isinstance(filePath, unicode):
+            filePath = filePath.encode(sys.getfilesystemencoding())
+        if location is None:
+            if header.lower() == "x-accel-redirect":
+                filePath = urllib.quote(filePath.replace(os.sep, "/"))
+            return (header, filePath)
+
+        root = opts.get("root") or getattr(self._davProvider, "rootFolderPath", None)
+        if root is None:
+            return None
+        if isinstance(root, unicode):
+            root = root.encode(sys.getfilesystemencoding())
+        root = os.path.abspath(root).rstrip(os.sep) + os.sep
+        if not filePath.startswith(root):
+            util.warn("file_offload: %r is not below %r" % (filePath, root))
+            return None
+        relPath = filePath[len(root):].replace(os.sep, "/")
+        return (header, location.rstrip("/") + "/" + urllib.quote(relPath))
+
+
+    def _sendOffloadResponse(self, res, environ, start_response, offloadHeader):
+        """Return an empty response, that tells the front-end server to send res.
+        
+        The front-end server sends the file and handles Range requests, so 
+        Content-Length and Content-Range are set by the front-end server.
+        """
+        responseHeaders = [("Content-Type", res.getContentType()),
+                           ("Content-Length", "0"),
+                           ("Date", util.getRfc1123Time()),
+                           offloadHeader,
+                           ]
+        if res.supportModified():
+            responseHeaders.append(("Last-Modified", 
+                                    util.getRfc1123Time(res.getLastModified())))
+        if res.supportEtag():
+            responseHeaders.append(("ETag", '"%s"' % res.getEtag()))
+        if res.supportRanges():
+            responseHeaders.append(("Accept-Ranges", "bytes"))
+        start_response("200 OK", responseHeaders)
+        return [""]
+
+
+    def _streamContent(self, fileobj, rangelength, blockSizes, close=True, 
+                       advisor=None):
+        """Yield rangelength bytes (-1: until EOF) of fileobj in blocks.
+        
+        blockSizes is an iterator over the block sizes (see _iterBlockSizes()),
+        advisor is a page_cache.StreamAdvisor for fileobj (or None).
+        """
         contentlengthremaining = rangelength
+        if advisor is not None:
+            pos = fileobj.tell()
+            advisor.begin(pos, rangelength)
         while 1:
-            if contentlengthremaining < 0 or contentlengthremaining > BLOCK_SIZE:
-                readbuffer = fileobj.read(BLOCK_SIZE)
+            n = blockSizes.next()
+            if contentlengthremaining < 0 or contentlengthremaining > n:
+                readbuffer = fileobj.read(n)
             else:
                 readbuffer = fileobj.read(contentlengthremaining)
             yield readbuffer
             contentlengthremaining -= len(readbuffer)
+            if advisor is not None:
+                pos += len(readbuffer)
+                advisor.update(pos)
             if len(readbuffer) == 0 or contentlengthremaining == 0:
                 break
-        fileobj.close()
+        if advisor is not None:
+            advisor.end(pos)
+        if close:
+            fileobj.close()
         return
 
 
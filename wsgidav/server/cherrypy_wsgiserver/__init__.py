@@ -99,6 +99,8 @@ from urllib import unquote
 from urlparse import urlparse
 import warnings
 
+from wsgidav.file_wrapper import FileWrapper, isPlainSocket
+
 try:
     from OpenSSL import SSL
     from OpenSSL import crypto
@@ -201,6 +203,16 @@ class SizeCheckWrapper(object):
         self._check_length()
         return data
     
+    def read1(self, size):
+        data = self.rfile.read1(size)
+        self.bytes_read += len(data)
+        self._check_length()
+        return data
+    
+    def unread(self, data):
+        self.rfile.unread(data)
+        self.bytes_read -= len(data)
+    
     def readline(self, size=None):
         if size is not None:
             data = self.rfile.readline(size)
@@ -279,10 +291,14 @@ class HTTPRequest(object):
     chunked_write: if True, output will be encoded with the "chunked"
         transfer-coding. This value is set automatically inside
         send_headers.
+    decode_chunked_input: if True, chunked request bodies are decoded into
+        a StringIO before the application is called. WsgiDAV decodes them
+        itself, while it reads wsgi.input (see wsgidav.chunked_input).
     """
     
     max_request_header_size = 0
     max_request_body_size = 0
+    decode_chunked_input = False
     
     def __init__(self, wfile, environ, wsgi_app):
         self.rfile = environ['wsgi.input']
@@ -522,6 +538,8 @@ class HTTPRequest(object):
         data.seek(0)
         self.environ["wsgi.input"] = data
         self.environ["CONTENT_LENGTH"] = str(cl) or ""
+        # The application must not decode the body again
+        self.environ.pop("HTTP_TRANSFER_ENCODING", None)
         return True
     
     def respond(self):
@@ -548,22 +566,25 @@ class HTTPRequest(object):
             return
     
     def _respond(self):
-        if self.chunked_read:
+        if self.chunked_read and self.decode_chunked_input:
             if not self.decode_chunked():
                 self.close_connection = True
                 return
         
         response = self.wsgi_app(self.environ, self.start_response)
         try:
-            for chunk in response:
-                # "The start_response callable must not actually transmit
-                # the response headers. Instead, it must store them for the
-                # server or gateway to transmit only after the first
-                # iteration of the application return value that yields
-                # a NON-EMPTY string, or upon the application's first
-                # invocation of the write() callable." (PEP 333)
-                if chunk:
-                    self.write(chunk)
+            if isinstance(response, FileWrapper) and self.started_response:
+                self.write_file(response)
+            else:
+                for chunk in response:
+                    # "The start_response callable must not actually transmit
+                    # the response headers. Instead, it must store them for the
+                    # server or gateway to transmit only after the first
+                    # iteration of the application return value that yields
+                    # a NON-EMPTY string, or upon the application's first
+                    # invocation of the write() callable." (PEP 333)
+                    if chunk:
+                        self.write(chunk)
         finally:
             if hasattr(response, "close"):
                 response.close()
@@ -574,6 +595,29 @@ class HTTPRequest(object):
         if self.chunked_write:
             self.wfile.sendall("0\r\n\r\n")
     
+    def write_file(self, response):
+        """Send a wsgi.file_wrapper response, using sendfile() if possible."""
+        if not self.sent_headers:
+            self.sent_headers = True
+            self.send_headers()
+        
+        if self.chunked_write:
+            for chunk in response:
+                if chunk:
+                    self.write(chunk)
+            return
+        
+        length = None
+        for k, v in self.outheaders:
+            if k.lower() == "content-length":
+                length = int(v)
+        self.wfile.flush()
+        sock = self.wfile._sock
+        if not isPlainSocket(sock):
+            # SSL connection: data must pass through SSL_fileobject
+            sock = self.wfile
+        response.sendTo(sock, length)
+    
     def simple_response(self, status, msg=""):
         """Write a simple response back to the client."""
         status = str(status)
@@ -661,6 +705,11 @@ class HTTPRequest(object):
                     # Closing the conn is the only way to determine len.
                     self.close_connection = True
         
+        if (self.chunked_read and not self.decode_chunked_input
+            and not self.environ.get("wsgidav.all_input_read")):
+            # The application did not read the whole chunked body
+            self.close_connection = True
+        
         if "connection" not in hkeys:
             if self.response_protocol == 'HTTP/1.1':
                 # Both server and client are HTTP/1.1 or better
@@ -810,6 +859,26 @@ if not _fileobject_uses_str_type:
                     #assert buf_len == buf.tell()
                 return buf.getvalue()
 
+        def read1(self, size):
+            """Return up to size bytes: buffered data or a single recv()."""
+            buf = self._rbuf
+            buf.seek(0, 2)  # seek end
+            if buf.tell() == 0:
+                return self.recv(size)
+            buf.seek(0)
+            rv = buf.read(size)
+            self._rbuf = StringIO.StringIO()
+            self._rbuf.write(buf.read())
+            return rv
+
+        def unread(self, data):
+            """Push data back, so it is returned by the next read."""
+            buf = self._rbuf
+            buf.seek(0)
+            self._rbuf = StringIO.StringIO()
+            self._rbuf.write(data)
+            self._rbuf.write(buf.read())
+
         def readline(self, size=-1):
             buf = self._rbuf
             buf.seek(0, 2)  # seek end
@@ -970,6 +1039,18 @@ else:
                     buf_len += n
                 return "".join(buffers)
 
+        def read1(self, size):
+            """Return up to size bytes: buffered data or a single recv()."""
+            data = self._rbuf
+            if not data:
+                return self.recv(size)
+            self._rbuf = data[size:]
+            return data[:size]
+
+        def unread(self, data):
+            """Push data back, so it is returned by the next read."""
+            self._rbuf = data + self._rbuf
+
         def readline(self, size=-1):
             data = self._rbuf
             if size < 0:
@@ -1129,6 +1210,10 @@ class HTTPConnection(object):
                "wsgi.multiprocess": False,
                "wsgi.run_once": False,
                "wsgi.errors": sys.stderr,
+               "wsgi.file_wrapper": FileWrapper,
+               # Responses without Content-Length are sent chunked (or the
+               # connection is closed), see HTTPRequest.send_headers()
+               "wsgidav.chunked_response_support": True,
                }
     
     def __init__(self, sock, wsgi_app, environ):
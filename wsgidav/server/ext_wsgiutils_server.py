@@ -64,6 +64,7 @@ import SocketServer, BaseHTTPServer, urlparse
 import sys, logging
 import traceback
 from wsgidav import util
+from wsgidav.file_wrapper import FileWrapper
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -153,6 +154,7 @@ class ExtHandler (BaseHTTPServer.BaseHTTPRequestHandler):
                "wsgi.url_scheme": "http",
                "wsgi.input": self.rfile,
                "wsgi.errors": sys.stderr,
+               "wsgi.file_wrapper": FileWrapper,
                "wsgi.multithread": 1,
                "wsgi.multiprocess": 0,
                "wsgi.run_once": 0,
@@ -180,11 +182,14 @@ class ExtHandler (BaseHTTPServer.BaseHTTPRequestHandler):
             _logger.debug("runWSGIApp application()...")
             result = application (env, self.wsgiStartResponse)
             try:
-                for data in result:
-                    if data:
-                        self.wsgiWriteData(data)
-                    else:
-                        _logger.debug("runWSGIApp empty data")
+                if isinstance(result, FileWrapper) and self.wsgiHeaders:
+                    self.wsgiWriteFile(result)
+                else:
+                    for data in result:
+                        if data:
+                            self.wsgiWriteData(data)
+                        else:
+                            _logger.debug("runWSGIApp empty data")
             finally:
                 _logger.debug("runWSGIApp finally.")
                 if hasattr(result, "close"):
@@ -213,6 +218,23 @@ class ExtHandler (BaseHTTPServer.BaseHTTPRequestHandler):
         self.wsgiHeaders = (response_status, response_headers)
         return self.wsgiWriteData
 
+    def wsgiWriteFile (self, fileWrapper):
+        """Send a wsgi.file_wrapper response, using sendfile() if possible."""
+        # Send headers
+        self.wsgiWriteData("")
+        length = None
+        for header, value in self.wsgiHeaders[1]:
+            if header.lower() == "content-length":
+                length = int(value)
+        self.wfile.flush()
+        try:
+            fileWrapper.sendTo(self.connection, length)
+        except socket.error, e:
+            if e[0] in (10053, 10054):
+                print >>sys.stderr, "*** Caught socket.error: ", e
+            else:  
+                raise
+
     def wsgiWriteData (self, data):
         if not self.wsgiSentHeaders:
             status, headers = self.wsgiHeaders
@@ -218,7 +218,11 @@ def _initConfig():
     if config_file: 
         verbose = cmdLineOpts.get("verbose", 2)
         fileConf = _readConfigFile(config_file, verbose)
-        config.update(fileConf)
+        for key, value in fileConf.items():
+            # Option groups are merged, so omitted options keep their defaults
+            if key in ("block_size", "compression") and isinstance(value, dict):
+                value = dict(DEFAULT_CONFIG[key], **value)
+            config[key] = value
     else:
         if cmdLineOpts["verbose"] >= 2:
             print "Running without configuration file."
@@ -0,0 +1,432 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Implements `StatCache`, which caches stat results of file system paths.
+
+FilesystemProvider and MyTardisProvider used to call os.path.exists(),
+os.path.isdir(), os.stat(), os.path.isfile() and os.stat() again (in
+util.getETag()) for the same file. On network file systems every call is a
+round trip to the server.
+
+StatCache replaces these calls with one os.lstat() per path and request:
+resource type, size, modification time and inode are all taken from this
+result. Results are stored in environ["wsgidav.statCache"], so they live as
+long as the request. Optionally, results are also shared across requests for
+`ttl` seconds. Changes made by other processes may be invisible for that
+long, so the TTL should be short.
+
+The providers discard cached results for modified paths in
+invalidateResourceCache().
+
+Directory listings are read with `scanDir()`, which returns the file type
+reported by the directory entries (d_type), so listing a folder doesn't need
+an os.stat() per member. It uses os.scandir() (Python 3.5+) or the `scandir`
+package, if installed. Otherwise readdir() is called through ctypes on Linux,
+and os.listdir() is used on other platforms.
+
+On network file systems every stat() waits for a round trip to the server.
+With `prefetchThreads`, folder listings stat their members concurrently
+(see StatCache.prefetch()), and the member order is kept.
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html
+"""
+from wsgidav import util
+import ctypes
+import ctypes.util
+import os
+import Queue
+import stat
+import sys
+import threading
+import time
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir  #@UnresolvedImport
+    except ImportError:
+        _scandir = None
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+# File types (see <dirent.h>)
+DT_UNKNOWN = 0
+DT_DIR = 4
+DT_REG = 8
+
+
+class _Dirent64(ctypes.Structure):
+    """struct dirent64 (same layout on all Linux architectures)."""
+    _fields_ = [("d_ino", ctypes.c_uint64),
+                ("d_off", ctypes.c_int64),
+                ("d_reclen", ctypes.c_ushort),
+                ("d_type", ctypes.c_ubyte),
+                ("d_name", ctypes.c_char * 256),
+                ]
+
+
+def _loadLibc():
+    """Return libc with the readdir functions, or None if not available."""
+    libName = ctypes.util.find_library("c")
+    if not sys.platform.startswith("linux") or not libName:
+        return None
+    libc = ctypes.CDLL(libName, use_errno=True)
+    if not hasattr(libc, "readdir64"):
+        return None
+    libc.opendir.argtypes = [ctypes.c_char_p]
+    libc.opendir.restype = ctypes.c_void_p
+    libc.readdir64.argtypes = [ctypes.c_void_p]
+    libc.readdir64.restype = ctypes.POINTER(_Dirent64)
+    libc.closedir.argtypes = [ctypes.c_void_p]
+    return libc
+
+if _scandir is None:
+    try:
+        _libc = _loadLibc()
+    except OSError:
+        _libc = None
+
+
+def statPath(filePath):
+    """Return the stat result for filePath, or None if it does not exist.
+
+    Symbolic links are followed (like os.stat()), but only an additional
+    os.stat() call is made for links.
+    """
+    try:
+        st = os.lstat(filePath)
+        if stat.S_ISLNK(st.st_mode):
+            st = os.stat(filePath)
+    except OSError:
+        return None
+    return st
+
+
+def _readDir(dirPath):
+    """Return list of (name, d_type) tuples, using readdir() through ctypes."""
+    if isinstance(dirPath, unicode):
+        encoding = sys.getfilesystemencoding()
+        encodedPath = dirPath.encode(encoding)
+    else:
+        encoding = None
+        encodedPath = dirPath
+    dirp = _libc.opendir(encodedPath)
+    if not dirp:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), dirPath)
+    entries = []
+    try:
+        while True:
+            ctypes.set_errno(0)
+            ent = _libc.readdir64(dirp)
+            if not ent:
+                e = ctypes.get_errno()
+                if e:
+                    raise OSError(e, os.strerror(e), dirPath)
+                break
+            name = ent.contents.d_name
+            if name in (".", ".."):
+                continue
+            if encoding:
+                # Like os.listdir(): undecodable names are returned as str
+                try:
+                    name = name.decode(encoding)
+                except UnicodeDecodeError:
+                    pass
+            entries.append((name, ent.contents.d_type))
+    finally:
+        _libc.closedir(dirp)
+    return entries
+
+
+def scanDir(dirPath):
+    """Return list of (name, isDir) tuples for the entries of a directory.
+
+    isDir is True or False for directories and regular files, and None if the
+    type is not known without os.stat() (symbolic links, special files, or
+    file systems that don't report the type).
+    Like os.listdir(), names are unicode if dirPath is unicode.
+    """
+    result = []
+    if _scandir is not None:
+        for entry in _scandir(dirPath):
+            isDir = None
+            if not entry.is_symlink():
+                if entry.is_dir():
+                    isDir = True
+                elif entry.is_file():
+                    isDir = False
+            result.append((entry.name, isDir))
+    elif _libc is not None:
+        for name, fileType in _readDir(dirPath):
+            if fileType == DT_DIR:
+                result.append((name, True))
+            elif fileType == DT_REG:
+                result.append((name, False))
+            else:
+                result.append((name, None))
+    else:
+        for name in os.listdir(dirPath):
+            result.append((name, None))
+    return result
+
+
+def _isEqualOrChildPath(parentPath, filePath):
+    return (filePath == parentPath
+            or filePath.startswith(parentPath.rstrip(os.sep) + os.sep))
+
+
+
+#===============================================================================
+# _PrefetchPool
+#===============================================================================
+class _PrefetchPool(object):
+    """A fixed number of daemon threads, that run submitted functions.
+
+    Threads are started on demand.
+    """
+    def __init__(self, numThreads):
+        self.numThreads = numThreads
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+
+    def submit(self, func):
+        self._lock.acquire()
+        try:
+            if len(self._threads) < self.numThreads:
+                t = threading.Thread(target=self._run, name="StatPrefetch")
+                t.setDaemon(True)
+                t.start()
+                self._threads.append(t)
+        finally:
+            self._lock.release()
+        self._queue.put(func)
+
+
+    def _run(self):
+        while True:
+            func = self._queue.get()
+            try:
+                func()
+            except Exception:
+                _logger.exception("Stat prefetch failed")
+
+
+
+#===============================================================================
+# StatCache
+#===============================================================================
+class StatCache(object):
+    """
+    Cache stat results by (absolute) file path.
+
+    ttl:
+        Seconds a result is shared across requests (0: per request only).
+    maxEntries:
+        Max. number of results that are shared across requests, and that are
+        memoized per request (this bounds the memory used by large
+        traversals).
+    prefetchThreads:
+        Max. number of threads, that stat folder members concurrently (for all
+        requests). 0 disables prefetching.
+    prefetchThreadsPerRequest:
+        Max. number of threads used by one request (including the request
+        thread).
+    """
+    def __init__(self, ttl=0, maxEntries=10000, prefetchThreads=0,
+                 prefetchThreadsPerRequest=4):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.prefetchThreads = prefetchThreads
+        self.prefetchThreadsPerRequest = prefetchThreadsPerRequest
+        self._shared = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        if prefetchThreads > 0:
+            self._pool = _PrefetchPool(prefetchThreads)
+        self._count_stat = 0
+
+
+    def __repr__(self):
+        return "StatCache(ttl=%s, %s entries)" % (self.ttl, len(self._shared))
+
+
+    def _getShared(self, filePath):
+        """Return (True, result), if a result is shared, or (False, None)."""
+        if self.ttl <= 0:
+            return False, None
+        self._lock.acquire()
+        try:
+            entry = self._shared.get(filePath)
+            if entry is not None and entry[0] > time.time():
+                return True, entry[1]
+            return False, None
+        finally:
+            self._lock.release()
+
+
+    def stat(self, filePath, environ=None):
+        """Return the stat result for filePath, or None if it does not exist.
+
+        Results are memoized in environ (if passed) and, if `ttl` is set,
+        shared across requests.
+        """
+        requestCache = None
+        if environ is not None:
+            requestCache = environ.setdefault("wsgidav.statCache", {})
+            if filePath in requestCache:
+                return requestCache[filePath]
+            if len(requestCache) >= self.maxEntries:
+                requestCache.clear()
+        found, st = self._getShared(filePath)
+        if not found:
+            self._count_stat += 1
+            st = statPath(filePath)
+            if self.ttl > 0:
+                self._store(filePath, st)
+        if requestCache is not None:
+            requestCache[filePath] = st
+        return st
+
+
+    def prefetch(self, filePaths, environ):
+        """Stat filePaths concurrently and memoize the results in environ.
+
+        This saves round trips on network file systems, where every stat()
+        waits for the server. Does nothing, if `prefetchThreads` is 0.
+        The request thread takes part, so a busy pool slows prefetching down,
+        but never blocks it.
+        """
+        if self._pool is None or environ is None:
+            return
+        requestCache = environ.setdefault("wsgidav.statCache", {})
+        todo = []
+        for filePath in filePaths:
+            if filePath in requestCache:
+                continue
+            found, st = self._getShared(filePath)
+            if found:
+                requestCache[filePath] = st
+            else:
+                todo.append(filePath)
+        if len(todo) < 2:
+            return
+
+        results = [None] * len(todo)
+        # Index of the next path, and number of finished paths
+        state = [0, 0]
+        cond = threading.Condition()
+
+        def _worker():
+            while True:
+                cond.acquire()
+                try:
+                    i = state[0]
+                    if i >= len(todo):
+                        return
+                    state[0] += 1
+                finally:
+                    cond.release()
+                try:
+                    results[i] = statPath(todo[i])
+                finally:
+                    cond.acquire()
+                    try:
+                        state[1] += 1
+                        if state[1] == len(todo):
+                            cond.notifyAll()
+                    finally:
+                        cond.release()
+
+        numWorkers = min(self.prefetchThreadsPerRequest, len(todo))
+        for _i in range(numWorkers - 1):
+            self._pool.submit(_worker)
+        _worker()
+        # Wait for paths that are still processed by the pool
+        cond.acquire()
+        try:
+            while state[1] < len(todo):
+                cond.wait()
+        finally:
+            cond.release()
+
+        self._count_stat += len(todo)
+        if len(requestCache) + len(todo) > self.maxEntries:
+            requestCache.clear()
+        for filePath, st in zip(todo, results):
+            requestCache[filePath] = st
+            if self.ttl > 0:
+                self._store(filePath, st)
+
+
+    def _store(self, filePath, st):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if len(self._shared) >= self.maxEntries:
+                for fp, entry in self._shared.items():
+                    if entry[0] <= now:
+                        del self._shared[fp]
+                if len(self._shared) >= self.maxEntries:
+                    self._shared.clear()
+            self._shared[filePath] = (now + self.ttl, st)
+        finally:
+            self._lock.release()
+
+
+    def listDir(self, dirPath, environ=None):
+        """Return list of (name, isDir) tuples for the files and folders in
+        dirPath.
+
+        Other entries (broken links, sockets, ...) are skipped. Symbolic links
+        are followed. Only entries of unknown type are passed to stat().
+        """
+        entries = scanDir(dirPath)
+        unknown = [os.path.join(dirPath, name)
+                   for name, isDir in entries if isDir is None]
+        self.prefetch(unknown, environ)
+        result = []
+        for name, isDir in entries:
+            if isDir is None:
+                st = self.stat(os.path.join(dirPath, name), environ)
+                if st is not None and stat.S_ISDIR(st.st_mode):
+                    isDir = True
+                elif st is not None and stat.S_ISREG(st.st_mode):
+                    isDir = False
+                else:
+                    _logger.debug("Skipping non-file %s" % os.path.join(dirPath, name))
+                    continue
+            result.append((name, isDir))
+        return result
+
+
+    def invalidate(self, filePath=None, environ=None):
+        """Discard results for filePath, its descendants and its parent folder.
+
+        Results are removed from environ (if passed) and from the shared cache.
+        If filePath is None, all results are discarded.
+        """
+        caches = [self._shared]
+        if environ is not None and environ.get("wsgidav.statCache"):
+            caches.append(environ["wsgidav.statCache"])
+        if filePath is not None:
+            filePath = filePath.rstrip(os.sep) or os.sep
+            parent = os.path.dirname(filePath)
+        self._lock.acquire()
+        try:
+            for cache in caches:
+                if filePath is None:
+                    cache.clear()
+                    continue
+                for fp in cache.keys():
+                    if fp == parent or _isEqualOrChildPath(filePath, fp):
+                        del cache[fp]
+        finally:
+            self._lock.release()
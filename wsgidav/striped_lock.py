@@ -0,0 +1,99 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Implements `StripedReadWriteLock`, a set of ReadWriteLocks keyed by path.
+
+LockManager, LockStorageDict and PropertyManager used to serialize all
+writers behind one global ReadWriteLock. With lock striping, requests that
+target different top-level folders use different locks and don't wait for
+each other.
+
+Rules:
+
+- An operation on a single path acquires the stripe of the path's top-level
+  segment (e.g. '/dav/a/b' -> 'dav'). The root path '/' itself uses the
+  stripe of the empty segment, which may be shared with a top-level folder
+  (segments are mapped to stripes by hash).
+  Since all members of a folder share its top-level segment, this also
+  covers depth-infinity operations and sub tree queries, except for the
+  root folder.
+- Operations on several paths (e.g. COPY or MOVE) pass all paths, so all
+  involved stripes are acquired.
+- Operations that span the whole name space (e.g. depth-infinity operations
+  on '/', cleanup or close) pass no path and acquire all stripes.
+- Stripes are always acquired in ascending order, so operations spanning
+  several stripes cannot deadlock. As a consequence, code that holds a
+  stripe must not acquire a different set of stripes before releasing it.
+  Re-acquiring held stripes is OK, since ReadWriteLock is re-entrant.
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html
+"""
+from rw_lock import ReadWriteLock
+
+__docformat__ = "reStructuredText"
+
+
+#===============================================================================
+# StripedReadWriteLock
+#===============================================================================
+class StripedReadWriteLock(object):
+    """
+    A list of ReadWriteLock objects, selected by the top-level path segment.
+
+    stripeCount:
+        Number of locks. 1 is equivalent to a single ReadWriteLock.
+    """
+    def __init__(self, stripeCount=16):
+        assert stripeCount >= 1
+        self._stripes = [ ReadWriteLock() for _ in xrange(stripeCount) ]
+        self._all = range(stripeCount)
+
+
+    def __repr__(self):
+        return "StripedReadWriteLock(%s)" % len(self._stripes)
+
+
+    def getStripes(self, paths):
+        """Return sorted list of stripe indexes for a list of paths.
+
+        An empty list means 'all stripes'.
+        """
+        count = len(self._stripes)
+        if not paths or count == 1:
+            return self._all
+        return sorted(set([ hash(p.lstrip("/").split("/", 1)[0]) % count
+                            for p in paths ]))
+
+
+    def acquireRead(self, *paths):
+        """Acquire a read lock for the stripes of paths (all, if none)."""
+        acquired = []
+        try:
+            for i in self.getStripes(paths):
+                self._stripes[i].acquireRead()
+                acquired.append(i)
+        except:
+            for i in reversed(acquired):
+                self._stripes[i].release()
+            raise
+
+
+    def acquireWrite(self, *paths):
+        """Acquire a write lock for the stripes of paths (all, if none)."""
+        acquired = []
+        try:
+            for i in self.getStripes(paths):
+                self._stripes[i].acquireWrite()
+                acquired.append(i)
+        except:
+            for i in reversed(acquired):
+                self._stripes[i].release()
+            raise
+
+
+    def release(self, *paths):
+        """Release the stripes of paths (must match the acquire call)."""
+        for i in reversed(self.getStripes(paths)):
+            self._stripes[i].release()
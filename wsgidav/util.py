@@ -13,6 +13,8 @@ from wsgidav.dav_error import DAVError, HTTP_PRECONDITION_FAILED, HTTP_NOT_MODIF
     HTTP_NO_CONTENT, HTTP_CREATED, getHttpStatusString, HTTP_BAD_REQUEST,\
     HTTP_OK
 from wsgidav.xml_tools import xmlToString, makeSubElement
+from wsgidav import compression
+from wsgidav.chunked_input import ChunkedInput
 import urllib
 import socket
 
@@ -518,6 +520,19 @@ def readAndDiscardInput(environ):
             warn("--> wsgi_input.read(): %s" % sys.exc_info())
 
 
+def iterBlockSizes(minSize, maxSize):
+    """Yield the sizes of consecutive blocks of a transfer.
+
+    The first block has minSize bytes, so the first bytes are sent with low
+    latency. The size is doubled for every following block up to maxSize, so
+    long transfers need few loop iterations and system calls.
+    """
+    size = max(1, min(minSize, maxSize))
+    while True:
+        yield size
+        size = min(2 * size, maxSize)
+
+
 
 #===============================================================================
 # URLs
@@ -625,7 +640,8 @@ def parseXmlBody(environ, allowEmpty=False):
     At least it locked, when I tried it with a request that had a missing 
     content-type and no body.
     
-    Current approach: if CONTENT_LENGTH is
+    Current approach: bodies with chunked transfer coding (passed undecoded by 
+    the server) are decoded with ChunkedInput. Otherwise, if CONTENT_LENGTH is
     
     - valid and >0:
       read body (exactly <CONTENT_LENGTH> bytes) and parse the result.  
@@ -642,7 +658,12 @@ def parseXmlBody(environ, allowEmpty=False):
     # 
     clHeader = environ.get("CONTENT_LENGTH", "").strip() 
 #    contentLength = -1 # read all of stream
-    if clHeader == "":
+    if environ.get("HTTP_TRANSFER_ENCODING", "").lower() == "chunked":
+        # Servers may pass chunked bodies undecoded (e.g. the bundled CherryPy)
+        environ["wsgidav.some_input_read"] = 1
+        requestbody = ChunkedInput(environ["wsgi.input"]).read()
+        environ["wsgidav.all_input_read"] = 1
+    elif clHeader == "":
         # No Content-Length given: read to end of stream 
         # TODO: etree.parse() locks, if input is invalid?
 #        pfroot = etree.parse(environ["wsgi.input"]).getroot()
@@ -738,9 +759,17 @@ def sendMultiStatusResponse(environ, start_response, multistatusEL):
     headers = [
         ("Content-Type", "application/xml"),
         ("Date", getRfc1123Time()),
-        ('Content-Length', str(len(xml_data))),
     ]
 
+    # Depth-1 listings of large folders are big and very repetitive
+    encoding = compression.getContentEncoding(environ, len(xml_data))
+    if encoding:
+        xml_data = compression.gzipString(environ, xml_data)
+        headers += [("Content-Encoding", encoding),
+                    ("Vary", "Accept-Encoding"),
+                    ]
+    headers.append(("Content-Length", str(len(xml_data))))
+
 #    if 'keep-alive' in environ.get('HTTP_CONNECTION', '').lower():
 #        headers += [
 #            ('Connection', 'keep-alive'),
@@ -818,7 +847,10 @@ def addPropertyResponse(multistatusEL, href, propList):
 #===============================================================================
 # ETags
 #===============================================================================
-def getETag(filePath):
+# Default for getETag(statResult), since None means 'file does not exist'
+_MISSING = object()
+
+def getETag(filePath, statResult=_MISSING):
     """Return a strong Entity Tag for a (file)path.
     
     http://www.webdav.org/specs/rfc4918.html#etag
@@ -828,6 +860,9 @@ def getETag(filePath):
         Non-file - md5(pathname)
         Win32 - md5(pathname)-lastmodifiedtime-filesize
         Others - inode-lastmodifiedtime-filesize
+
+    If the caller already has the stat result for filePath (or None, if the
+    file does not exist), it may pass it as statResult to save the lookup.
     """
     # (At least on Vista) os.path.exists returns False, if a file name contains 
     # special characters, even if it is correctly UTF-8 encoded.
@@ -838,14 +873,17 @@ def getETag(filePath):
     else:
         unicodeFilePath = toUnicode(filePath)
         
-    if not os.path.isfile(unicodeFilePath):
+    if statResult is _MISSING:
+        try:
+            statResult = os.stat(unicodeFilePath)
+        except OSError:
+            statResult = None
+    if statResult is None or not stat.S_ISREG(statResult.st_mode):
         return md5(filePath).hexdigest()   
     if sys.platform == "win32":
-        statresults = os.stat(unicodeFilePath)
-        return md5(filePath).hexdigest() + "-" + str(statresults[stat.ST_MTIME]) + "-" + str(statresults[stat.ST_SIZE])
+        return md5(filePath).hexdigest() + "-" + str(statResult[stat.ST_MTIME]) + "-" + str(statResult[stat.ST_SIZE])
     else:
-        statresults = os.stat(unicodeFilePath)
-        return str(statresults[stat.ST_INO]) + "-" + str(statresults[stat.ST_MTIME]) + "-" + str(statresults[stat.ST_SIZE])
+        return str(statResult[stat.ST_INO]) + "-" + str(statResult[stat.ST_MTIME]) + "-" + str(statResult[stat.ST_SIZE])
 
 
 #===============================================================================
@@ -856,13 +894,15 @@ def getETag(filePath):
 reByteRangeSpecifier = re.compile("(([0-9]+)\-([0-9]*))")
 reSuffixByteRangeSpecifier = re.compile("(\-([0-9]+))")
 
-def obtainContentRanges(rangetext, filesize):
+def obtainContentRanges(rangetext, filesize, gap=0):
     """
    returns tuple (list, value)
 
    list
        content ranges as values to their parsed components in the tuple
-       (seek_position/abs position of first byte, abs position of last byte, num_of_bytes_to_read)
+       (seek_position/abs position of first byte, abs position of last byte, num_of_bytes_to_read),
+       sorted by position. Overlapping ranges, and ranges that are separated 
+       by less than `gap` bytes are coalesced (RFC 7233, 4.1).
    value
        total length for Content-Length
    """
@@ -886,7 +926,7 @@ def obtainContentRanges(rangetext, filesize):
                     matched = True
         if not matched:      
             mObj = reSuffixByteRangeSpecifier.search(subrange)
-            if mObj:
+            if mObj and long(mObj.group(2)) > 0 and filesize > 0:
                 firstpos = filesize - long(mObj.group(2))
                 if firstpos < 0:
                     firstpos = 0
@@ -899,23 +939,44 @@ def obtainContentRanges(rangetext, filesize):
     listReturn.sort()
     listReturn2 = []
     totallength = 0
-    while(len(listReturn) > 0):
-        (rfirstpos, rlastpos) = listReturn.pop()
-        counter = len(listReturn)
-        while counter > 0:
-            (nfirstpos, nlastpos) = listReturn[counter-1]
-            if nlastpos < rfirstpos - 1 or nfirstpos > nlastpos + 1:
-                pass
-            else: 
-                rfirstpos = min(rfirstpos, nfirstpos)
-                rlastpos = max(rlastpos, nlastpos)
-                del listReturn[counter-1]
-            counter = counter - 1
-        listReturn2.append((rfirstpos,rlastpos,rlastpos - rfirstpos + 1 ))            
-        totallength = totallength + rlastpos - rfirstpos + 1
+    for (firstpos, lastpos) in listReturn:
+        if listReturn2 and firstpos <= listReturn2[-1][1] + 1 + gap:
+            (prevfirstpos, prevlastpos, _prevlength) = listReturn2.pop()
+            totallength -= prevlastpos - prevfirstpos + 1
+            firstpos = prevfirstpos
+            lastpos = max(lastpos, prevlastpos)
+        listReturn2.append((firstpos, lastpos, lastpos - firstpos + 1))
+        totallength += lastpos - firstpos + 1
 
     return (listReturn2, totallength)
 
+
+def getMultipartByteranges(listRanges, filesize, contentType, boundary=None):
+    """Return (contentType, parts, contentLength) of a multipart/byteranges body.
+
+    listRanges is a list of (firstpos, lastpos, length) tuples, as returned by
+    obtainContentRanges().
+    parts is a list of strings (part headers and the closing boundary) and
+    (offset, length) tuples for the file content in between (see 
+    file_wrapper.FileWrapper). contentLength is the exact size of the body.
+    """
+    if boundary is None:
+        boundary = os.urandom(16).encode("hex")
+    parts = []
+    contentLength = 0
+    for (firstpos, lastpos, length) in listRanges:
+        header = ("\r\n--%s\r\n"
+                  "Content-Type: %s\r\n"
+                  "Content-Range: bytes %s-%s/%s\r\n"
+                  "\r\n" % (boundary, contentType, firstpos, lastpos, filesize))
+        parts.append(header)
+        parts.append((firstpos, length))
+        contentLength += len(header) + length
+    trailer = "\r\n--%s--\r\n" % boundary
+    parts.append(trailer)
+    contentLength += len(trailer)
+    return ("multipart/byteranges; boundary=%s" % boundary, parts, contentLength)
+
 #===============================================================================
 # 
 #===============================================================================
@@ -983,7 +1044,7 @@ def evaluateHTTPConditionals(davres, lastmodified, entitytag, environ):
     if "HTTP_IF_MATCH" in environ and davres.supportEtag(): 
         ifmatchlist = environ["HTTP_IF_MATCH"].split(",")
         for ifmatchtag in ifmatchlist:
-            ifmatchtag = ifmatchtag.strip(" \"\t")
+            ifmatchtag = compression.getIdentityEtag(ifmatchtag.strip(" \"\t"))
             if ifmatchtag == entitytag or ifmatchtag == "*":
                 break   
             raise DAVError(HTTP_PRECONDITION_FAILED,
@@ -1005,7 +1066,7 @@ def evaluateHTTPConditionals(davres, lastmodified, entitytag, environ):
     if "HTTP_IF_NONE_MATCH" in environ and davres.supportEtag():          
         ifmatchlist = environ["HTTP_IF_NONE_MATCH"].split(",")
         for ifmatchtag in ifmatchlist:
-            ifmatchtag = ifmatchtag.strip(" \"\t")
+            ifmatchtag = compression.getIdentityEtag(ifmatchtag.strip(" \"\t"))
             if ifmatchtag == entitytag or ifmatchtag == "*":
                 # ETag matched. If it's a GET request and we don't have an 
                 # conflicting If-Modified header, we return NOT_MODIFIED
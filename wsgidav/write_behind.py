@@ -0,0 +1,219 @@
+# (c) 2009-2011 Martin Wendt and contributors; see WsgiDAV http://wsgidav.googlecode.com/
+# Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+"""
+Implements `WriteBehindShelf`, a write-behind cache for shelve dictionaries.
+
+ShelvePropertyManager and LockStorageShelve call shelf.sync() after every
+mutation. Wrapping the shelf into a WriteBehindShelf turns this into a
+group commit: mutations are collected in memory (repeated writes to the same
+key are coalesced) and written to the shelf after a short delay, or when too
+many mutations are pending.
+
+Pending mutations are flushed by close(), and when the interpreter exits
+normally (atexit; this includes Ctrl-C). Data that was not yet flushed is lost
+if the process is killed (e.g. SIGKILL, or SIGTERM without a handler), so
+`flushInterval` is the durability window.
+
+See `Developers info`_ for more information about the WsgiDAV architecture.
+
+.. _`Developers info`: http://docs.wsgidav.googlecode.com/hg/html/develop.html
+"""
+from wsgidav import util
+import atexit
+import copy
+import threading
+import weakref
+
+__docformat__ = "reStructuredText"
+
+_logger = util.getModuleLogger(__name__)
+
+# Marks a key that was deleted, but not yet removed from the shelf
+_DELETED = object()
+
+
+def _flushAtExit(ref):
+    """Flush a WriteBehindShelf (if it is still alive) on interpreter exit.
+
+    The flush timer is a daemon thread, which does not run at exit.
+    """
+    shelf = ref()
+    if shelf is None:
+        return
+    try:
+        shelf.flush()
+    except Exception:
+        _logger.exception("Could not flush %r at exit" % shelf)
+
+
+#===============================================================================
+# WriteBehindShelf
+#===============================================================================
+class WriteBehindShelf(object):
+    """
+    A dictionary-like wrapper around a shelf, that delays and coalesces writes.
+
+    Like a shelf opened with writeback=False, values are copied when they are
+    stored and retrieved, so callers must re-assign modified values.
+
+    shelf:
+        Opened shelve object.
+    flushInterval:
+        Max. seconds a mutation stays in memory (0: write-through, i.e.
+        sync() writes immediately).
+    maxDirty:
+        Flush as soon as this many mutations are pending.
+    """
+    def __init__(self, shelf, flushInterval, maxDirty=100):
+        self._shelf = shelf
+        self._flushInterval = flushInterval
+        self._maxDirty = maxDirty
+        self._dirty = {}
+        self._mutations = 0
+        self._flushCount = 0
+        self._timer = None
+        self._lock = threading.RLock()
+        # A weak reference, so the shelf can still be garbage collected
+        atexit.register(_flushAtExit, weakref.ref(self))
+
+
+    def __repr__(self):
+        return "WriteBehindShelf(%r, %s)" % (self._shelf, self._flushInterval)
+
+
+    def __contains__(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._dirty:
+                return self._dirty[key] is not _DELETED
+            return key in self._shelf
+        finally:
+            self._lock.release()
+
+
+    def __getitem__(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._dirty:
+                value = self._dirty[key]
+                if value is _DELETED:
+                    raise KeyError(key)
+                return copy.deepcopy(value)
+            return self._shelf[key]
+        finally:
+            self._lock.release()
+
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            self._dirty[key] = copy.deepcopy(value)
+            self._mutations += 1
+        finally:
+            self._lock.release()
+
+
+    def __delitem__(self, key):
+        self._lock.acquire()
+        try:
+            if not key in self:
+                raise KeyError(key)
+            self._dirty[key] = _DELETED
+            self._mutations += 1
+        finally:
+            self._lock.release()
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def keys(self):
+        self._lock.acquire()
+        try:
+            keys = set(self._shelf.keys())
+            for key, value in self._dirty.items():
+                if value is _DELETED:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+            return list(keys)
+        finally:
+            self._lock.release()
+
+
+    def items(self):
+        self._lock.acquire()
+        try:
+            return [ (key, self[key]) for key in self.keys() ]
+        finally:
+            self._lock.release()
+
+
+    def getStats(self):
+        """Return a dictionary with 'pending' mutations and number of 'flushes'."""
+        self._lock.acquire()
+        try:
+            return {"pending": self._mutations,
+                    "flushes": self._flushCount,
+                    }
+        finally:
+            self._lock.release()
+
+
+    def sync(self):
+        """Request a write to disc.
+
+        This is called after every mutation. The write is delayed, unless
+        flushInterval is 0, or maxDirty mutations are pending.
+        """
+        self._lock.acquire()
+        try:
+            if not self._mutations:
+                return
+            if self._flushInterval <= 0 or self._mutations >= self._maxDirty:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self._flushInterval, self.flush)
+                self._timer.setDaemon(True)
+                self._timer.start()
+        finally:
+            self._lock.release()
+
+
+    def flush(self):
+        """Write all pending mutations to the shelf and sync it."""
+        self._lock.acquire()
+        try:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if not self._mutations:
+                return
+            _logger.debug("flush(): %s mutations, %s keys"
+                          % (self._mutations, len(self._dirty)))
+            for key, value in self._dirty.items():
+                if value is _DELETED:
+                    if key in self._shelf:
+                        del self._shelf[key]
+                else:
+                    self._shelf[key] = value
+            self._dirty = {}
+            self._mutations = 0
+            self._flushCount += 1
+            self._shelf.sync()
+        finally:
+            self._lock.release()
+
+
+    def close(self):
+        """Flush pending mutations and close the shelf."""
+        self._lock.acquire()
+        try:
+            self.flush()
+            self._shelf.close()
+        finally:
+            self._lock.release()
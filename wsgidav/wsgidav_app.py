@@ -32,6 +32,9 @@ For every request:
             Configuration dictionary.
         environ["wsgidav.verbose"]
             Debug level [0-3].
+        environ["wsgidav.resourceCache"]
+            Resource instances that were resolved during this request
+            (created on demand by DAVProvider.getResourceInst()).
 
     Log the HTTP request, then pass the request to the first middleware.
 
@@ -104,7 +107,24 @@ DEFAULT_CONFIG = {
         "response_trailer": "",  # Raw HTML code, appended as footer
         "davmount": False,       # Send <dm:mount> response if request URL contains '?davmount'
         "msmount": False,        # Add an 'open as webfolder' link (requires Windows)
-    }
+    },
+
+    "block_size": {
+        "min": 8192,         # Size of the first block of GET and PUT transfers
+        "max": 1024 * 1024,  # Following blocks are doubled up to this size
+    },
+
+    "compression": {
+        "enable": False,     # gzip multistatus and directory listings (if accepted)
+        "text_get": False,   # Also gzip GET responses of text/* resources
+        "min_size": 1024,    # Send smaller responses uncompressed
+        "level": 1,          # zlib level: 1 (fastest) .. 9 (smallest)
+        "decode_put": True,  # Accept gzip/deflate encoded PUT bodies
+        "max_decoded_size": 4 * 1024 * 1024 * 1024,  # Reject larger decoded PUT bodies
+        "max_ratio": 200,    # ... and PUT bodies that expand by more than 200:1
+    },
+
+    "file_offload": {},  # Per share: let a front-end server send file contents
 }
 
 
@@ -315,10 +335,18 @@ class WsgiDAVApp(object):
                                      and not statusCode in (204, 304))  
 #            print environ["REQUEST_METHOD"], statusCode, contentLengthRequired
             if contentLengthRequired and currentContentLength in (None, ""):
-                # A typical case: a GET request on a virtual resource, for which  
-                # the provider doesn't know the length 
-                util.warn("Missing required Content-Length header in %s-response: closing connection" % statusCode)
-                forceCloseConnection = True
+                if environ.get("wsgidav.unsized_response"):
+                    # Sent without length on purpose (e.g. compressed GET 
+                    # responses): servers that support it use chunked transfer 
+                    # coding, otherwise the connection must be closed
+                    if (not environ.get("wsgidav.chunked_response_support")
+                        and headerDict.get("connection") != "close"):
+                        response_headers.append(("Connection", "close"))
+                else:
+                    # A typical case: a GET request on a virtual resource, for which  
+                    # the provider doesn't know the length 
+                    util.warn("Missing required Content-Length header in %s-response: closing connection" % statusCode)
+                    forceCloseConnection = True
             elif not type(currentContentLength) is str:
                 util.warn("Invalid Content-Length header in response (%r): closing connection" % headerDict.get("content-length"))
                 forceCloseConnection = True
@@ -334,7 +362,8 @@ class WsgiDAVApp(object):
 
             # Make sure the socket is not reused, unless we are 100% sure all 
             # current input was consumed
-            if(util.getContentLength(environ) != 0 
+            if((util.getContentLength(environ) != 0
+                or environ.get("HTTP_TRANSFER_ENCODING", "").lower() == "chunked") 
                and not environ.get("wsgidav.all_input_read")):
                 util.warn("Input stream not completely consumed: closing connection")
                 forceCloseConnection = True
@@ -391,6 +420,4 @@ class WsgiDAVApp(object):
             return start_response(status, response_headers, exc_info)
             
         # Call next middleware
-        for v in self._application(environ, _start_response_wrapper):
-            yield v
-        return
+        return self._application(environ, _start_response_wrapper)